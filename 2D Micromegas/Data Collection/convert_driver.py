@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+'''converts every pcapng file in a folder to ROOT with vmm-sdat's convertFile, several files at a time, skipping files that are already converted'''
+
+#settings used when no config file is given, see convert_config.json
+#output is the name of the ROOT file convertFile writes next to the pcapng file ({stem} is the pcapng name without extension, {info} the -info argument), change it if your convertFile names its output differently
+#journal is the file in the pcapng folder where every finished conversion is logged (one JSON line each), used to resume after an interruption
+DEFAULT_CONFIG = {
+    'convertFile' : 'convertFile',
+    'output' : '{stem}_{info}.root',
+    'journal' : 'convert_journal.jsonl',
+    'args' : {},
+}
+
+#load the convertFile path, output naming and conversion parameters (-geo, -cal, -dt, -mst, ...) from a JSON config file
+def loadConfig(configFile):
+    with open(configFile) as f:
+        config = json.load(f)
+    return {**DEFAULT_CONFIG, **config}
+
+#command line for one pcapng file
+def buildArgs(config, pcapngFile):
+    args = [config['convertFile'], '-f', pcapngFile]
+    for flag, value in config['args'].items():
+        args += [flag, str(value)]
+    return args
+
+#path of the ROOT file convertFile writes for a pcapng file
+def outputPath(config, pcapngFile):
+    stem = os.path.splitext(os.path.basename(pcapngFile))[0]
+    name = config['output'].format(stem=stem, info=config['args'].get('-info', ''))
+    return os.path.join(os.path.dirname(pcapngFile), name)
+
+#last journal entry of every pcapng file in the folder
+def readJournal(journalFile):
+    entries = {}
+    if os.path.exists(journalFile):
+        with open(journalFile) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #line cut short by an interruption
+                    continue
+                entries[entry['file']] = entry
+    return entries
+
+#a file is up to date if its last conversion succeeded, the pcapng has not changed since and the ROOT file is still there and not older than the pcapng
+#a ROOT file left behind by an interrupted or failed conversion has a journal entry with a non zero (or None, started but not finished) status, so it is converted again
+#files without a journal entry (converted before the journal existed or by hand) are up to date when their ROOT file is not older than the pcapng
+def isUpToDate(config, pcapngFile, journal):
+    entry = journal.get(os.path.abspath(pcapngFile))
+    stat = os.stat(pcapngFile)
+    rootFile = outputPath(config, pcapngFile)
+    if not os.path.exists(rootFile) or os.stat(rootFile).st_mtime_ns < stat.st_mtime_ns:
+        return False
+    if entry is None:
+        return True
+    return entry['status'] == 0 and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+#journal entry of a file found already converted (its ROOT file is up to date but the journal does not list it)
+def adoptedEntry(config, pcapngFile):
+    stat = os.stat(pcapngFile)
+    return {'file' : os.path.abspath(pcapngFile), 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'status' : 0, 'error' : '',
+        'start' : None, 'seconds' : 0.0, 'output' : outputPath(config, pcapngFile), 'adopted' : True}
+
+#run convertFile on one file, its output goes to <stem>.convert.log next to the pcapng file so parallel conversions do not interleave
+def runConvertFile(args, logFile):
+    with open(logFile, 'w') as log:
+        return subprocess.run(args, stdout=log, stderr=subprocess.STDOUT).returncode
+
+#convert one file and return its journal entry (exit status -1 if convertFile could not be started)
+def convertOne(config, pcapngFile, runner=runConvertFile):
+    stat = os.stat(pcapngFile)
+    logFile = os.path.splitext(pcapngFile)[0] + '.convert.log'
+    start = time.time()
+    error = ''
+    try:
+        status = runner(buildArgs(config, pcapngFile), logFile)
+    except OSError as e:
+        status = -1
+        error = str(e)
+    return {'file' : os.path.abspath(pcapngFile), 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'status' : status, 'error' : error,
+        'start' : start, 'seconds' : round(time.time() - start, 3), 'output' : outputPath(config, pcapngFile)}
+
+#convert every pcapng file in the folder with a pool of max_workers conversions (default: number of cores), skipping up to date files unless force is True
+#every finished conversion is appended to the journal right away, so an interrupted run resumes where it stopped, returns the journal entries of this run
+def convertFolder(pcapngFolder, config, max_workers=None, force=False, runner=runConvertFile, pcapngFiles=None):
+    if pcapngFiles is None:
+        pcapngFiles = sorted(glob.glob(os.path.join(pcapngFolder, "*.pcapng")))
+    journalFile = os.path.join(pcapngFolder, config['journal'])
+    journal = readJournal(journalFile)
+
+    todo = [filePath for filePath in pcapngFiles if force or not isUpToDate(config, filePath, journal)]
+    print(f'{len(pcapngFiles) - len(todo)} of {len(pcapngFiles)} files up to date, converting {len(todo)}')
+    adopted = [filePath for filePath in pcapngFiles if filePath not in todo and os.path.abspath(filePath) not in journal]
+
+    entries = []
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor, open(journalFile, 'a') as journalOut:
+        for filePath in adopted: #so the next run checks them against the journal like any other file
+            journalOut.write(json.dumps(adoptedEntry(config, filePath)) + '\n')
+        for filePath in todo: #marks the ROOT file of a conversion that gets interrupted as unfinished, so it is not adopted as up to date
+            journalOut.write(json.dumps({'file' : os.path.abspath(filePath), 'status' : None}) + '\n')
+        journalOut.flush()
+        futures = [executor.submit(convertOne, config, filePath, runner) for filePath in todo]
+        try:
+            for future in as_completed(futures):
+                entry = future.result()
+                journalOut.write(json.dumps(entry) + '\n')
+                journalOut.flush()
+                entries.append(entry)
+                state = 'ok' if entry['status'] == 0 else f"FAILED (exit status {entry['status']}) {entry['error']}"
+                print(f"{os.path.basename(entry['file'])}: {entry['seconds']:.1f} s {state}")
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+
+    failed = [entry for entry in entries if entry['status'] != 0]
+    if failed:
+        print(f'{len(failed)} conversions failed, see the .convert.log files')
+    return entries
+
+#runs the script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert every pcapng file in a folder to ROOT with convertFile')
+    parser.add_argument('folder', help='folder containing the pcapng files')
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_config.json'), help='JSON config with the convertFile path and parameters')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel conversions (default: number of cores)')
+    parser.add_argument('--force', action='store_true', help='convert files even if they are up to date')
+    options = parser.parse_args()
+
+    entries = convertFolder(options.folder, loadConfig(options.config), max_workers=options.jobs, force=options.force)
+    sys.exit(1 if any(entry['status'] != 0 for entry in entries) else 0)
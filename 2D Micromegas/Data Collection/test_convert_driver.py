@@ -0,0 +1,93 @@
+import os
+import json
+import pytest
+from convert_driver import DEFAULT_CONFIG, convertFolder, readJournal, outputPath
+
+
+'''tests of convert_driver with synthetic pcapng files and a stub converter in place of convertFile, run with python -m pytest'''
+
+CONFIG = {**DEFAULT_CONFIG, 'args' : {'-info' : 'test'}}
+
+#stand-in for runConvertFile: writes the ROOT file convertFile would write and records which files it converted
+#interrupt is the name of a pcapng file whose conversion is cut short (half written ROOT file, then KeyboardInterrupt), failing the name of one whose conversion fails
+class StubConverter:
+    def __init__(self, interrupt=None, failing=None):
+        self.converted = []
+        self.interrupt, self.failing = interrupt, failing
+
+    def __call__(self, args, logFile):
+        pcapngFile = args[args.index('-f') + 1]
+        name = os.path.basename(pcapngFile)
+        with open(outputPath(CONFIG, pcapngFile), 'w') as f:
+            f.write('partial' if name in (self.interrupt, self.failing) else 'converted')
+        if name == self.interrupt:
+            raise KeyboardInterrupt
+        self.converted.append(name)
+        return 2 if name == self.failing else 0
+
+#a folder with n_files small pcapng files, 0.pcapng, 1.pcapng, ...
+def makeCaptures(folder, n_files=3):
+    for i in range(n_files):
+        with open(os.path.join(folder, f'{i}.pcapng'), 'wb') as f:
+            f.write(os.urandom(100))
+    return folder
+
+#move the modification time of a file forward, as if it was written again
+def touch(filePath, seconds=10):
+    stat = os.stat(filePath)
+    os.utime(filePath, ns=(stat.st_atime_ns, stat.st_mtime_ns + int(seconds * 1e9)))
+
+def test_first_pass_converts_everything_and_logs_it(tmp_path):
+    folder = makeCaptures(str(tmp_path))
+    runner = StubConverter()
+    entries = convertFolder(folder, CONFIG, max_workers=2, runner=runner)
+    assert sorted(runner.converted) == ['0.pcapng', '1.pcapng', '2.pcapng']
+    assert all(entry['status'] == 0 for entry in entries)
+    journal = readJournal(os.path.join(folder, CONFIG['journal']))
+    assert sorted(os.path.basename(name) for name in journal) == ['0.pcapng', '1.pcapng', '2.pcapng']
+    assert all(entry['status'] == 0 for entry in journal.values())
+
+def test_resume_after_interruption_converts_only_unfinished_files(tmp_path):
+    folder = makeCaptures(str(tmp_path))
+    with pytest.raises(KeyboardInterrupt):
+        convertFolder(folder, CONFIG, max_workers=1, runner=StubConverter(interrupt='1.pcapng'))
+    journal = readJournal(os.path.join(folder, CONFIG['journal']))
+    assert journal[os.path.abspath(os.path.join(folder, '0.pcapng'))]['status'] == 0
+    assert journal[os.path.abspath(os.path.join(folder, '1.pcapng'))]['status'] is None #its half written ROOT file is not taken as done
+
+    runner = StubConverter()
+    convertFolder(folder, CONFIG, max_workers=1, runner=runner)
+    assert sorted(runner.converted) == ['1.pcapng', '2.pcapng']
+    with open(outputPath(CONFIG, os.path.join(folder, '1.pcapng'))) as f:
+        assert f.read() == 'converted'
+
+    runner = StubConverter()
+    assert convertFolder(folder, CONFIG, max_workers=1, runner=runner) == []
+    assert runner.converted == []
+
+def test_failed_and_changed_files_are_converted_again(tmp_path):
+    folder = makeCaptures(str(tmp_path))
+    convertFolder(folder, CONFIG, runner=StubConverter(failing='2.pcapng'))
+    touch(os.path.join(folder, '0.pcapng'))
+    runner = StubConverter()
+    convertFolder(folder, CONFIG, runner=runner)
+    assert sorted(runner.converted) == ['0.pcapng', '2.pcapng']
+
+def test_files_converted_before_the_journal_are_adopted(tmp_path):
+    folder = makeCaptures(str(tmp_path))
+    for name in ('0.pcapng', '1.pcapng'):
+        pcapngFile = os.path.join(folder, name)
+        with open(outputPath(CONFIG, pcapngFile), 'w') as f:
+            f.write('converted by hand')
+        touch(outputPath(CONFIG, pcapngFile))
+    runner = StubConverter()
+    convertFolder(folder, CONFIG, runner=runner)
+    assert runner.converted == ['2.pcapng']
+    with open(os.path.join(folder, CONFIG['journal'])) as f:
+        adopted = [json.loads(line) for line in f if json.loads(line).get('adopted')]
+    assert sorted(os.path.basename(entry['file']) for entry in adopted) == ['0.pcapng', '1.pcapng']
+
+    touch(os.path.join(folder, '0.pcapng'), seconds=20) #now newer than its ROOT file
+    runner = StubConverter()
+    convertFolder(folder, CONFIG, runner=runner)
+    assert runner.converted == ['0.pcapng']
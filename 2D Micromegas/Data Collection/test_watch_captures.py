@@ -0,0 +1,94 @@
+import os
+import time
+import numpy as np
+import uproot
+from convert_driver import DEFAULT_CONFIG, outputPath
+from watch_captures import MonitorState, closedCaptures, processNewCaptures
+
+
+'''tests of watch_captures with synthetic pcapng captures and a stub converter that writes small ROOT files, run with python -m pytest'''
+
+CONFIG = {**DEFAULT_CONFIG, 'args' : {'-info' : 'test'}}
+N_HITS = 200
+
+#stand-in for runConvertFile: writes a ROOT file with N_HITS hits and clusters (one second of data) for every capture, failing is the name of a capture whose conversion fails
+class StubConverter:
+    def __init__(self, failing=None):
+        self.converted = []
+        self.failing = failing
+
+    def __call__(self, args, logFile):
+        pcapngFile = args[args.index('-f') + 1]
+        name = os.path.basename(pcapngFile)
+        if name == self.failing:
+            return 2
+        self.converted.append(name)
+        rng = np.random.default_rng(len(self.converted))
+        hits = {'plane' : rng.integers(0, 2, N_HITS).astype(np.int32), 'pos' : rng.integers(0, 300, N_HITS).astype(np.int32),
+            'time' : np.linspace(0, 1e9, N_HITS)}
+        clusters = {'pos0' : rng.uniform(10, 300, N_HITS), 'pos1' : rng.uniform(10, 300, N_HITS), 'adc0' : rng.normal(300, 50, N_HITS), 'adc1' : rng.normal(600, 50, N_HITS)}
+        with uproot.recreate(outputPath(CONFIG, pcapngFile)) as f:
+            f['hits/hits'] = hits
+            f['clusters_detector/clusters_detector'] = clusters
+        return 0
+
+#write a capture whose modification time is age seconds in the past
+def writeCapture(folder, name, age):
+    filePath = os.path.join(folder, name)
+    with open(filePath, 'wb') as f:
+        f.write(os.urandom(100))
+    os.utime(filePath, (time.time() - age, time.time() - age))
+    return filePath
+
+def test_newest_capture_is_only_taken_with_include_newest_once_settled(tmp_path):
+    folder = str(tmp_path)
+    for i, age in enumerate((300, 200, 100)):
+        writeCapture(folder, f'{i}.pcapng', age)
+    names = lambda captures: [os.path.basename(filePath) for filePath in captures]
+    assert names(closedCaptures(folder, settle_seconds=60)) == ['0.pcapng', '1.pcapng']
+    assert names(closedCaptures(folder, settle_seconds=60, include_newest=True)) == ['0.pcapng', '1.pcapng', '2.pcapng']
+    assert names(closedCaptures(folder, settle_seconds=600, include_newest=True)) == ['0.pcapng', '1.pcapng']
+
+def test_captures_are_merged_once_across_restarts(tmp_path):
+    folder, stateDir = str(tmp_path / 'captures'), str(tmp_path / 'state')
+    os.makedirs(folder)
+    writeCapture(folder, '0.pcapng', 300)
+    writeCapture(folder, '1.pcapng', 200)
+    runner = StubConverter()
+    state = MonitorState(stateDir)
+    added = processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner)
+    assert [os.path.basename(filePath) for filePath in added] == ['0.pcapng']
+    assert state.hits.counts.sum() == N_HITS
+
+    writeCapture(folder, '2.pcapng', 100) #a new capture closes 1.pcapng
+    state = MonitorState.load(stateDir)
+    added = processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner)
+    assert [os.path.basename(filePath) for filePath in added] == ['1.pcapng']
+    assert state.hits.counts.sum() == 2 * N_HITS
+    assert np.isclose(state.data_duration, 2.0)
+
+    state = MonitorState.load(stateDir)
+    added = processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner, include_newest=True, settle_seconds=60)
+    assert [os.path.basename(filePath) for filePath in added] == ['2.pcapng']
+    assert runner.converted == ['0.pcapng', '1.pcapng', '2.pcapng']
+    state = MonitorState.load(stateDir)
+    assert processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner, include_newest=True) == []
+    assert state.hits.counts.sum() == 3 * N_HITS
+    assert sum(hist.counts.sum() for hist in state.gains.values()) <= 3 * N_HITS
+
+def test_failed_conversion_is_retried_once_the_capture_changes(tmp_path):
+    folder, stateDir = str(tmp_path / 'captures'), str(tmp_path / 'state')
+    os.makedirs(folder)
+    capture = writeCapture(folder, '0.pcapng', 300)
+    writeCapture(folder, '1.pcapng', 200)
+    state = MonitorState(stateDir)
+    assert processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=StubConverter(failing='0.pcapng')) == []
+    runner = StubConverter()
+    state = MonitorState.load(stateDir)
+    assert processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner) == []
+    assert runner.converted == []
+
+    os.utime(capture, (time.time() - 250, time.time() - 250))
+    state = MonitorState.load(stateDir)
+    assert [os.path.basename(filePath) for filePath in processNewCaptures(folder, CONFIG, state, 16.0, 4.5, runner=runner)] == ['0.pcapng']
+    assert state.failed == {}
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from convert_driver import loadConfig, convertFolder, readJournal, isUpToDate, outputPath, runConvertFile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Offline Analysis'))
+from vmm_tools import read_hit, read_cluster, StripHistogram, ClusterMap, GainHistogram, gainHistogramsByRegion, loadGeometry, liveSeconds
+
+
+'''watches the folder run_multiple.sh writes its pcapng captures to, converts every capture once it is closed and adds it to running hit rate, cluster map and gain histograms, re-rendering the summary plots after each new file'''
+
+strip_edges = np.arange(-0.5,499.5,1.0)
+
+#size and modification time of a file, to tell whether it changed since it was last looked at
+def fileStamp(filePath):
+    stat = os.stat(filePath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+#counts and edges of a histogram as arrays of the state file, under prefix
+def packHistogram(prefix, hist):
+    return {f'{prefix}.counts' : hist.counts, **{f'{prefix}.edges{i}' : edges for i, edges in enumerate(hist.edges)}}
+
+def unpackHistogram(cls, prefix, arrays):
+    hist = object.__new__(cls)
+    hist.counts = arrays[f'{prefix}.counts']
+    hist.edges = [arrays[f'{prefix}.edges{i}'] for i in range(sum(name.startswith(f'{prefix}.edges') for name in arrays.files))]
+    return hist
+
+#running histograms of every capture converted so far, saved in stateDir so the monitor can be restarted without losing them
+class MonitorState:
+    def __init__(self, stateDir):
+        self.stateDir = stateDir
+        self.processed = {} #{pcapng file: [size, mtime_ns]} of the files already added to the histograms
+        self.failed = {} #{pcapng file: [size, mtime_ns]} of the files whose conversion failed, retried once the file changes
+        self.data_duration = 0.0 #live time in seconds of the data in the histograms, from the hit timestamps
+        self.hits = StripHistogram(strip_edges)
+        self.clusters = ClusterMap(strip_edges)
+        self.gains = {} #{(x vmm, y vmm): GainHistogram}
+
+    @classmethod
+    def load(cls, stateDir):
+        state = cls(stateDir)
+        stateFile = os.path.join(stateDir, 'state.npz')
+        if not os.path.exists(stateFile):
+            return state
+        with np.load(stateFile, allow_pickle=False) as arrays:
+            saved = json.loads(str(arrays['meta']))
+            state.processed = saved['processed']
+            state.failed = saved['failed']
+            state.data_duration = saved['data_duration']
+            state.hits = unpackHistogram(StripHistogram, 'hits', arrays)
+            state.clusters = unpackHistogram(ClusterMap, 'clusters', arrays)
+            for xVmm, yVmm in saved['gains']:
+                state.gains[(xVmm, yVmm)] = unpackHistogram(GainHistogram, f'gain_{xVmm}_{yVmm}', arrays)
+        return state
+
+    #the list of files and the histograms go to one file replaced atomically, so an interrupted save leaves the previous state intact and a file is never counted twice
+    def save(self):
+        os.makedirs(self.stateDir, exist_ok=True)
+        saved = {'processed' : self.processed, 'failed' : self.failed, 'data_duration' : self.data_duration, 'gains' : [list(key) for key in self.gains]}
+        arrays = {'meta' : np.array(json.dumps(saved)), **packHistogram('hits', self.hits), **packHistogram('clusters', self.clusters)}
+        for (xVmm, yVmm), hist in self.gains.items():
+            arrays.update(packHistogram(f'gain_{xVmm}_{yVmm}', hist))
+        tmpFile = os.path.join(self.stateDir, 'state.npz.tmp')
+        with open(tmpFile, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpFile, os.path.join(self.stateDir, 'state.npz'))
+
+    #merge the histograms of one converted ROOT file
+    def addRootFile(self, rootFile, x_gain, y_gain, geometry=None):
+        df_hits = read_hit(rootFile, columns=['plane', 'pos', 'time'], use_cache=False)
+        df_clusters = read_cluster(rootFile, columns=['pos0', 'pos1', 'adc0', 'adc1'], use_cache=False)
+        self.hits.fill(df_hits)
+        self.clusters.fill(df_clusters)
+        for key, hist in gainHistogramsByRegion(df_clusters, x_gain, y_gain, geometry).items():
+            if key in self.gains:
+                self.gains[key] += hist
+            else:
+                self.gains[key] = hist
+        self.data_duration += liveSeconds(df_hits['time']) #DAQ pauses inside the file are not live time
+
+#pcapng files tcpdump has finished writing: every file but the newest, since run_multiple.sh only starts a new capture once the previous one is closed
+#a slow capture can be quiet for a long time while it is still open, so the newest file is only taken with include_newest (the run has ended) and once it has not changed for settle_seconds
+def closedCaptures(captureFolder, settle_seconds=60, include_newest=False):
+    captures = sorted(glob.glob(os.path.join(captureFolder, "*.pcapng")), key=os.path.getmtime)
+    if captures and (not include_newest or time.time() - os.path.getmtime(captures[-1]) < settle_seconds):
+        captures = captures[:-1]
+    return captures
+
+#convert and add every newly closed capture to the state, returns the pcapng files added
+#failed conversions are retried when their pcapng file has changed since
+def processNewCaptures(captureFolder, config, state, x_gain, y_gain, settle_seconds=60, max_workers=None, runner=runConvertFile, geometry=None, include_newest=False):
+    new = []
+    for filePath in closedCaptures(captureFolder, settle_seconds, include_newest):
+        key = os.path.abspath(filePath)
+        if key in state.processed:
+            if state.processed[key] != fileStamp(filePath):
+                print(f'{os.path.basename(filePath)}: changed after it was added to the histograms, not added again')
+            continue
+        if state.failed.get(key) == fileStamp(filePath):
+            continue
+        new.append(filePath)
+    if not new:
+        return []
+
+    convertFolder(captureFolder, config, max_workers=max_workers, runner=runner, pcapngFiles=new)
+    journal = readJournal(os.path.join(captureFolder, config['journal']))
+    added = []
+    for filePath in new:
+        key = os.path.abspath(filePath)
+        if isUpToDate(config, filePath, journal):
+            state.addRootFile(outputPath(config, filePath), x_gain, y_gain, geometry)
+            state.processed[key] = fileStamp(filePath)
+            state.failed.pop(key, None)
+            added.append(filePath)
+        else:
+            print(f'{os.path.basename(filePath)}: conversion failed, retried once the file changes')
+            state.failed[key] = fileStamp(filePath)
+    state.save()
+    return added
+
+#draw the summary plots of everything in the state
+def renderSummary(state, plotDir, geometry=None):
+    os.makedirs(plotDir, exist_ok=True)
+    data_duration = max(state.data_duration, 1e-9)
+    for plane, axis, color in ((0, 'x', 'blue'), (1, 'y', 'orange')):
+        fig = plt.figure()
+        state.hits.plot(plane, data_duration, fill=True, color=color)
+        plt.xlabel(f"strips {axis}")
+        plt.ylabel("counts / s")
+        plt.yscale("log")
+        plt.title(f'{len(state.processed)} files, {state.data_duration / 3600:.2f} h')
+        plt.savefig(os.path.join(plotDir, f'{axis}_hit_rate.png'), bbox_inches="tight")
+        plt.close()
+
+    fig = plt.figure()
+    state.clusters.plot(data_duration, logscale=True)
+    cbar1 = plt.colorbar()
+    cbar1.set_label("Counts / s", rotation=270, labelpad=15)
+    plt.xlabel(f'x strip #')
+    plt.ylabel(f'y strip #')
+    plt.savefig(os.path.join(plotDir, 'cluster_locations.png'), bbox_inches="tight")
+    plt.close()
+
+    geometry = loadGeometry() if geometry is None else geometry
+    for area in ['a', 'b', 'c', 'd']:
+        try:
+            (_, xVmm), (_, yVmm) = geometry.regionVmms(geometry.areaCode(area))
+        except Exception: #area not covered by this geometry
+            continue
+        if (xVmm, yVmm) not in state.gains:
+            continue
+        fig = plt.figure()
+        state.gains[(xVmm, yVmm)].plot(data_duration, color='g', label=f'Region {area}')
+        plt.legend(loc='upper right')
+        plt.xlabel("Gain")
+        plt.ylabel("counts / s")
+        plt.savefig(os.path.join(plotDir, f'gain_hist_{area}.png'), bbox_inches="tight")
+        plt.close()
+
+#poll the capture folder forever (or once), converting, merging and re-rendering whenever captures close
+#include_newest also takes the newest capture once it has been quiet for settle_seconds, use it once the run has ended
+def watch(captureFolder, config, stateDir, plotDir, x_gain, y_gain, poll_seconds=30, settle_seconds=60, max_workers=None, once=False, runner=runConvertFile, geometry=None, include_newest=False):
+    state = MonitorState.load(stateDir)
+    while True:
+        added = processNewCaptures(captureFolder, config, state, x_gain, y_gain, settle_seconds, max_workers, runner, geometry, include_newest)
+        if added:
+            renderSummary(state, plotDir, geometry)
+            print(f'added {len(added)} files, {len(state.processed)} in total')
+        if once:
+            return state
+        time.sleep(poll_seconds)
+
+#runs the script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert pcapng captures as they close and keep summary plots up to date')
+    parser.add_argument('folder', help='folder run_multiple.sh writes the pcapng files to')
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_config.json'), help='JSON config with the convertFile path and parameters')
+    parser.add_argument('--state', default='monitor_state', help='folder for the running histograms')
+    parser.add_argument('--plots', default='monitor_plots', help='folder for the summary plots')
+    parser.add_argument('--x-gain', type=float, default=16.0, help='x preamp gain in mV/fC')
+    parser.add_argument('--y-gain', type=float, default=4.5, help='y preamp gain in mV/fC')
+    parser.add_argument('--geometry', default=None, help='geometry JSON file used for the regions (default Zander setup)')
+    parser.add_argument('--poll', type=float, default=30, help='seconds between checks of the folder')
+    parser.add_argument('--settle', type=float, default=60, help='seconds without changes before the newest capture counts as closed (with --final)')
+    parser.add_argument('--final', action='store_true', help='the run has ended: also convert the newest capture once it stops changing')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel conversions')
+    parser.add_argument('--once', action='store_true', help='process the closed captures once and exit')
+    options = parser.parse_args()
+
+    geometry = None if options.geometry is None else loadGeometry(options.geometry)
+    watch(options.folder, loadConfig(options.config), options.state, options.plots, options.x_gain, options.y_gain,
+        poll_seconds=options.poll, settle_seconds=options.settle, max_workers=options.jobs, once=options.once, geometry=geometry, include_newest=options.final)
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import uproot
+import matplotlib
+matplotlib.use('Agg')
+
+
+'''times and memory-profiles the main analysis steps of vmm_tools on synthetic runs of a chosen size, so speed and memory regressions show up when results are compared'''
+
+#synthetic runs use their own cache folder so the benchmarks never touch (or profit from) the user's cache
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_data')
+os.environ.setdefault('VMM_CACHE_DIR', os.path.join(BENCHMARK_DIR, 'cache'))
+
+import vmm_tools
+from vmm_tools import (combineDataFrames, fiducializeArea, calibratedCharge, fitCB, StripHistogram, ClusterMap, GainHistogram,
+    HIT_COLUMNS, CLUSTER_COLUMNS, CLUSTER_COLUMNS_MAJD, ELECTRONS_PER_FC, FE55_PRIMARY_ELECTRONS)
+from Fe55_reconstruction_single import plotXAndYHitRate, plotClusterLocations2D, plotGainAndFits
+
+strip_edges = np.arange(-0.5,499.5,1.0)
+x_y_gain = (16.0, 4.5) #preamp gains in mV/fC used to make and to read the synthetic charges
+WRITE_STEP = 1000000 #rows written to a tree at a time, keeps the generator's memory flat for large runs
+
+#one block of synthetic clusters: uniform positions over the detector, Fe55 charges (5.9 keV photopeak and argon escape peak at 2.9 keV) at the given gain with 10% resolution, shared between x and y
+def _syntheticClusters(rng, n, t0, t1, columns, gain):
+    photons = np.where(rng.random(n) < 0.15, 2.9 / 5.9, 1.0)
+    electrons = gain * FE55_PRIMARY_ELECTRONS * photons * rng.normal(1.0, 0.1, n)
+    xShare = np.clip(rng.normal(0.45, 0.03, n), 0, 1)
+    clusters = {name: rng.uniform(0, 100, n) for name in columns}
+    clusters['id'] = np.arange(n, dtype=np.int32)
+    clusters['det'] = np.ones(n, dtype=np.int32)
+    clusters['adc0'] = electrons * xShare * x_y_gain[0] / ELECTRONS_PER_FC
+    clusters['adc1'] = electrons * (1 - xShare) * x_y_gain[1] / ELECTRONS_PER_FC
+    times = np.sort(rng.uniform(t0, t1, n))
+    for plane in '012':
+        if f'pos{plane}' not in clusters:
+            continue
+        clusters[f'pos{plane}'] = rng.uniform(0, 440, n)
+        clusters[f'size{plane}'] = rng.integers(2, 8, n).astype(np.int32)
+        clusters[f'time{plane}'] = times + rng.normal(0, 20, n)
+    if 'adc2' in clusters:
+        clusters['adc2'] = np.zeros(n)
+    return clusters
+
+#one block of synthetic hits with the strip, channel and time layout of the hits tree
+def _syntheticHits(rng, n, t0, t1):
+    pos = rng.integers(0, 440, n).astype(np.int32)
+    hits = {name: np.zeros(n, dtype=np.int32) for name in HIT_COLUMNS}
+    hits['id'] = np.arange(n, dtype=np.int32)
+    hits['det'][:] = 1
+    hits['plane'] = rng.integers(0, 2, n).astype(np.int32)
+    hits['fec'][:] = 6
+    hits['vmm'] = (pos // 64 + 8 * hits['plane']).astype(np.int32)
+    hits['ch'] = (pos % 64).astype(np.int32)
+    hits['pos'] = pos
+    hits['adc'] = rng.integers(0, 1024, n).astype(np.int32)
+    hits['tdc'] = rng.integers(0, 256, n).astype(np.int32)
+    hits['bcid'] = rng.integers(0, 4096, n).astype(np.int32)
+    hits['over_threshold'][:] = 1
+    hits['time'] = np.sort(rng.uniform(t0, t1, n))
+    hits['readout_time'] = hits['time'] - hits['time'] % 102400
+    hits['chip_time'] = hits['time'] % 102400
+    return hits
+
+#writes a synthetic run folder of n_files ROOT files holding rows hits and rows clusters in total, with the hits and clusters_detector trees of convertFile
+#layout is '3plane' (CLUSTER_COLUMNS) or 'majd' (CLUSTER_COLUMNS_MAJD), every file covers file_duration seconds, gain sets the position of the Fe55 peak
+def makeSyntheticRun(folder, rows, n_files=4, layout='3plane', file_duration=600, gain=6000, seed=0):
+    columns = CLUSTER_COLUMNS if layout == '3plane' else CLUSTER_COLUMNS_MAJD
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    perFile = np.diff(np.linspace(0, rows, n_files + 1).astype(np.int64))
+    for i, nRows in enumerate(perFile):
+        t0 = i * file_duration * 1e9
+        with uproot.recreate(os.path.join(folder, f'synthetic_{i:03d}.root')) as file:
+            file.mkdir('hits')
+            file.mkdir('clusters_detector')
+            for start in range(0, max(nRows, 1), WRITE_STEP):
+                n = min(WRITE_STEP, nRows - start)
+                t1 = t0 + file_duration * 1e9 * n / max(nRows, 1)
+                hits = _syntheticHits(rng, n, t0, t1)
+                clusters = _syntheticClusters(rng, n, t0, t1, columns, gain)
+                if start == 0:
+                    file.mktree('hits/hits', {name: values.dtype for name, values in hits.items()})
+                    file.mktree('clusters_detector/clusters_detector', {name: values.dtype for name, values in clusters.items()})
+                file['hits/hits'].extend(hits)
+                file['clusters_detector/clusters_detector'].extend(clusters)
+                t0 = t1
+    with open(os.path.join(folder, 'synthetic.json'), 'w') as f:
+        json.dump({'rows' : int(rows), 'n_files' : n_files, 'layout' : layout, 'file_duration' : file_duration, 'gain' : gain, 'seed' : seed}, f)
+    return folder
+
+#folder of a synthetic run, generated the first time it is needed
+def syntheticRun(rows, n_files=4, layout='3plane', dataDir=BENCHMARK_DIR):
+    folder = os.path.join(dataDir, f'run_{int(rows)}_{n_files}_{layout}')
+    if not os.path.exists(os.path.join(folder, 'synthetic.json')):
+        print(f'writing synthetic run with {int(rows)} rows to {folder}')
+        makeSyntheticRun(folder, int(rows), n_files, layout)
+    return folder
+
+#best and median wall time of repeat calls, then the peak of memory allocated during one more call traced with tracemalloc (numpy buffers included)
+def measure(fn, repeat=3, memory=True):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return {'seconds' : min(seconds), 'seconds_median' : float(np.median(seconds)), 'repeat' : repeat, 'peak_mb' : peak}
+
+#the benchmarked steps for one run folder as (name, function) pairs, the data they work on is loaded once beforehand
+def _benchmarks(rootFolder, parallel):
+    df_hits, df_clusters = combineDataFrames(rootFolder, hit_columns=['plane', 'pos'], cluster_columns=['pos0', 'pos1', 'adc0', 'adc1'])
+    df_charge = calibratedCharge(df_clusters, *x_y_gain, memoise=False)
+    stripHist = StripHistogram.fromChunks(df_hits, strip_edges)
+    data_duration = vmm_tools.liveTime(rootFolder) #df_hits only holds plane and pos, the live time comes from the streamed time column
+    return [
+        ('combineDataFrames', lambda: combineDataFrames(rootFolder, use_cache=False)),
+        ('combineDataFrames_cached', lambda: combineDataFrames(rootFolder, use_cache=True)),
+        ('combineDataFrames_projected', lambda: combineDataFrames(rootFolder, hit_columns=['plane', 'pos'], cluster_columns=['pos0', 'pos1', 'adc0', 'adc1'])),
+        ('combineDataFrames_parallel', lambda: combineDataFrames(rootFolder, use_cache=False, parallel=parallel)),
+        ('fiducializeArea', lambda: fiducializeArea(df_clusters, 'a')),
+        ('calibratedCharge', lambda: calibratedCharge(df_clusters, *x_y_gain, memoise=False)),
+        ('fitCB', lambda: fitCB(df_charge, plot=False)),
+        ('StripHistogram', lambda: StripHistogram.fromChunks(df_hits, strip_edges)),
+        ('ClusterMap', lambda: ClusterMap.fromChunks(df_clusters, strip_edges)),
+        ('GainHistogram', lambda: GainHistogram().fill(df_charge['gain'])),
+        ('plotXAndYHitRate', lambda: plotXAndYHitRate(stripHist, strip_edges, data_duration)),
+        ('plotClusterLocations2D', lambda: plotClusterLocations2D(df_clusters, strip_edges, data_duration, logscale=True)),
+        ('plotGainAndFits', lambda: plotGainAndFits(df_clusters, x_y_gain, fiducialize=True, fid_area='a', fit=True)),
+    ]
+
+#versions and machine the results were taken with
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    import pandas, scipy
+    return {'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit' : commit, 'python' : platform.python_version(), 'platform' : platform.platform(),
+        'cpu_count' : os.cpu_count(), 'numpy' : np.__version__, 'pandas' : pandas.__version__, 'scipy' : scipy.__version__, 'uproot' : uproot.__version__}
+
+#runs every benchmark (or those named in only) on synthetic runs of each size, returns the results as a JSON ready dictionary
+def runBenchmarks(sizes, n_files=4, layout='3plane', repeat=3, memory=True, only=None, parallel='thread', dataDir=BENCHMARK_DIR):
+    results = {'environment' : _environment(), 'results' : []}
+    plotDir = tempfile.mkdtemp(prefix='vmm_benchmark_plots_')
+    os.makedirs(os.path.join(plotDir, 'Micromegas', 'plots'))
+    cwd = os.getcwd()
+    for rows in sizes:
+        rootFolder = os.path.abspath(syntheticRun(rows, n_files, layout, dataDir))
+        combineDataFrames(rootFolder) #fills the cache for the cached benchmark
+        os.chdir(plotDir) #the plotting functions save to Micromegas/plots
+        try:
+            for name, fn in _benchmarks(rootFolder, parallel):
+                if only and name not in only:
+                    continue
+                result = measure(fn, repeat=repeat if rows < 1e7 else 1, memory=memory)
+                result.update({'benchmark' : name, 'rows' : int(rows), 'layout' : layout, 'n_files' : n_files})
+                results['results'].append(result)
+                peak = '' if result['peak_mb'] is None else f"{result['peak_mb']:10.1f} MB"
+                print(f"{name:30s} {int(rows):>11d} rows {result['seconds']:10.4f} s {peak}")
+        finally:
+            os.chdir(cwd)
+    return results
+
+#compares two result files benchmark by benchmark, prints the time and memory ratios and returns the benchmarks that got more than tolerance slower (or bigger)
+def compareResults(baseline, current, tolerance=0.1):
+    old = {(r['benchmark'], r['rows'], r['layout']): r for r in baseline['results']}
+    regressions = []
+    print(f"{'benchmark':30s} {'rows':>11s} {'old s':>10s} {'new s':>10s} {'ratio':>7s} {'old MB':>9s} {'new MB':>9s}")
+    for r in current['results']:
+        key = (r['benchmark'], r['rows'], r['layout'])
+        if key not in old:
+            continue
+        ratio = r['seconds'] / max(old[key]['seconds'], 1e-12)
+        oldPeak, newPeak = old[key]['peak_mb'], r['peak_mb']
+        memoryRatio = newPeak / max(oldPeak, 1e-12) if oldPeak is not None and newPeak is not None else 1.0
+        flag = ''
+        if ratio > 1 + tolerance or memoryRatio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - tolerance:
+            flag = 'faster'
+        print(f"{r['benchmark']:30s} {r['rows']:>11d} {old[key]['seconds']:10.4f} {r['seconds']:10.4f} {ratio:7.2f} "
+            f"{oldPeak if oldPeak is not None else float('nan'):9.1f} {newPeak if newPeak is not None else float('nan'):9.1f} {flag}")
+    return regressions
+
+#runs the script
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the vmm_tools analysis steps on synthetic runs')
+    parser.add_argument('--rows', type=float, nargs='+', default=[1e5, 1e6], help='rows per tree of the synthetic runs, e.g. 1e5 1e6 1e7 1e8')
+    parser.add_argument('--files', type=int, default=4, help='ROOT files per run')
+    parser.add_argument('--layout', choices=['3plane', 'majd'], default='3plane', help='cluster tree layout')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per benchmark (1 for runs of 1e7 rows and more)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc memory measurement')
+    parser.add_argument('--only', nargs='+', default=None, help='names of the benchmarks to run')
+    parser.add_argument('--data', default=BENCHMARK_DIR, help='folder for the synthetic runs')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the results (default benchmark_<time>.json)')
+    parser.add_argument('--compare', default=None, help='results JSON to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown counted as a regression')
+    options = parser.parse_args()
+
+    results = runBenchmarks(options.rows, options.files, options.layout, options.repeat, not options.no_memory, options.only, dataDir=options.data)
+    output = options.output or f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'results saved to {output}')
+
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compareResults(baseline, results, options.tolerance) else 0)
@@ -1,286 +1,2274 @@
 import uproot
+import awkward as ak
+import ast
 import pandas as pd
 import os
+import sys
+import time
 import glob
+import hashlib
+import json
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 from scipy import stats
-from scipy.optimize import curve_fit
-from scipy.stats import crystalball
+from scipy.optimize import minimize
+from scipy.special import erf
+from dataclasses import dataclass, asdict
+try:
+    import resource #peak RSS for the profiler, not available on Windows
+except ImportError:
+    resource = None
+try:
+    import numexpr #optional, evaluates cuts in one multithreaded pass
+except ImportError:
+    numexpr = None
 
 
 '''this file is for useful functions for analyzing data from the VMMs'''
 
+#location and size limit of the columnar cache of decoded ROOT trees, can be overridden with the VMM_CACHE_DIR, VMM_CACHE_MAX_GB and VMM_CACHE environment variables
+CACHE_DIR = os.environ.get('VMM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'vmm_tools'))
+CACHE_MAX_BYTES = int(float(os.environ.get('VMM_CACHE_MAX_GB', 20)) * 1e9)
+USE_CACHE = os.environ.get('VMM_CACHE', '1') != '0' #set VMM_CACHE=0 to always decode the ROOT files with uproot
+
+#branches of the hits tree
+HIT_COLUMNS = ['id', 'det', 'plane', 'fec', 'vmm', 'readout_time', 'time', 'ch', 'pos', 'bcid', 'tdc', 'adc', 'over_threshold', 'chip_time']
+
+#branches of the clusters_detector tree for 3 plane files
+CLUSTER_COLUMNS = ['id', 'id0', 'id1', 'id2', 'det', 'size0', 'size1', 'size2', 'adc0', 'adc1', 'adc2', 'pos0', 'pos1', 'pos2', 'time0', 'time1', 'time2',
+    'pos0_utpc', 'pos1_utpc', 'pos2_utpc', 'time0_utpc', 'time1_utpc', 'time2_utpc', 'pos0_charge2', 'pos1_charge2', 'pos2_charge2',
+    'time0_charge2', 'time1_charge2', 'time2_charge2', 'pos0_algo', 'pos1_algo', 'pos2_algo', 'time0_algo', 'time1_algo', 'time2_algo',
+    'dt0', 'dt1', 'dt2', 'delta_plane_0_1', 'delta_plane_1_2', 'delta_plane_0_2', 'span_cluster0', 'span_cluster1', 'span_cluster2',
+    'max_delta_time0', 'max_delta_time1', 'max_delta_time2', 'max_missing_strip0', 'max_missing_strip1', 'max_missing_strip2']
+
+#branches of the clusters_detector tree for 2 plane files (Majd's data)
+CLUSTER_COLUMNS_MAJD = ['id', 'id0', 'id1', 'det', 'size0', 'size1', 'adc0', 'adc1', 'pos0', 'pos1', 'time0', 'time1',
+    'pos0_utpc', 'pos1_utpc', 'time0_utpc', 'time1_utpc', 'pos0_charge2', 'pos1_charge2', 'time0_charge2', 'time1_charge2',
+    'pos0_algo', 'pos1_algo', 'time0_algo', 'time1_algo', 'dt0', 'dt1', 'delta_plane', 'span_cluster0', 'span_cluster1',
+    'max_delta_time0', 'max_delta_time1', 'max_missing_strip0', 'max_missing_strip1']
+
+#opt-in per stage profiling: set VMM_PROFILE=1 (or call enableProfiling()) and every instrumented stage records its wall time, CPU time, peak RSS and rows processed, see profileReport
+#when profiling is off a stage only costs a check of PROFILE
+#stages run in pool workers (threads or processes, see _profiledWorker) nest under the stage that started the pool, in a worker process their peak RSS is that of the worker
+PROFILE = os.environ.get('VMM_PROFILE', '0') == '1'
+_profileRecords = []
+_profileState = threading.local() #per thread: depth of the open stages and, inside a pool worker, the list its stages are recorded in
+
+def enableProfiling(enabled=True):
+    global PROFILE
+    PROFILE = enabled
+
+#peak resident memory of the process so far in MB (ru_maxrss is in kB on Linux and in bytes on macOS), None where the resource module does not exist
+def _peakRss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+#number of rows in a stage's result: dataframes and arrays, dicts of columns, and tuples/lists of those (summed)
+def _countRows(result):
+    if isinstance(result, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(result)
+    if isinstance(result, dict) and result and all(isinstance(values, np.ndarray) for values in result.values()):
+        return len(next(iter(result.values())))
+    if isinstance(result, (tuple, list)):
+        counts = [_countRows(item) for item in result]
+        return sum(counts) if counts and None not in counts else None
+    return None
+
+#number of stages open in this thread
+def _stageDepth():
+    return getattr(_profileState, 'depth', 0)
+
+#one timed stage, set its rows attribute inside the with block to record how many rows it processed
+class _ProfileStage:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.depth = _stageDepth()
+        _profileState.depth = self.depth + 1
+        self.startRss = _peakRss()
+        self.startCpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.startCpu
+        _profileState.depth = self.depth
+        peakRss = _peakRss()
+        getattr(_profileState, 'records', _profileRecords).append({'stage' : self.name, 'depth' : self.depth, 'wall_s' : wall, 'cpu_s' : cpu, 'peak_rss_mb' : peakRss,
+            'rss_growth_mb' : None if peakRss is None else peakRss - self.startRss, 'rows' : None if self.rows is None else int(self.rows)})
+        return False
+
+#stand-in returned while profiling is off, does nothing
+class _NoStage:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+#context manager timing a stage of the analysis: with profileStage('concat hits') as stage: ... stage.rows = len(df)
+def profileStage(name, rows=None):
+    return _ProfileStage(name, rows) if PROFILE else _NO_STAGE
+
+#decorator recording every call of a function as a stage (named after the function unless name is given), rows are counted from the returned dataframes/arrays
+def profiled(name=None):
+    def decorate(fn):
+        stageName = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILE:
+                return fn(*args, **kwargs)
+            with _ProfileStage(stageName) as stage:
+                result = fn(*args, **kwargs)
+                stage.rows = _countRows(result)
+            return result
+        return wrapper
+    return decorate
+
+#run fn(*args) in a thread or process pool worker with the profiling setting and stage depth of the caller: submit _profiledWorker(PROFILE, _stageDepth(), fn, *args)
+#returns the result with the stages recorded in the worker, pass it to _workerResult in the caller so stages run in worker processes are not lost with the worker
+def _profiledWorker(profile, depth, fn, *args):
+    global PROFILE
+    PROFILE = profile
+    _profileState.depth, _profileState.records = depth, []
+    try:
+        return fn(*args), _profileState.records
+    finally:
+        del _profileState.records
+        _profileState.depth = 0
+
+#result of a _profiledWorker call, its stages are added to the records of this thread
+def _workerResult(outcome):
+    result, records = outcome
+    getattr(_profileState, 'records', _profileRecords).extend(records)
+    return result
+
+#summary of the recorded stages: prints a table with the calls, total wall and CPU time, highest peak RSS and rows (per second) of every stage, saves the raw records and the summary to jsonFile if given
+#returns the summary as a dataframe, reset=True clears the records afterwards
+def profileReport(jsonFile=None, reset=False):
+    records = pd.DataFrame(_profileRecords, columns=['stage', 'depth', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rss_growth_mb', 'rows'])
+    records['rows'] = records['rows'].astype('Int64') #stages without a row count stay empty
+    summary = records.groupby('stage', sort=False).agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'), rows=('rows', lambda rows: rows.sum(min_count=1))).reset_index()
+    summary['rows_per_s'] = summary['rows'] / summary['wall_s'].where(summary['wall_s'] > 0)
+    if len(summary) > 0:
+        print(summary.to_string(index=False, float_format=lambda value: f'{value:.4g}'))
+    if jsonFile is not None and len(records) > 0:
+        with open(jsonFile, 'w') as f:
+            json.dump({'records' : records.astype(object).where(records.notna(), None).to_dict('records'),
+                'summary' : summary.astype(object).where(summary.notna(), None).to_dict('records')}, f, indent=1)
+    if reset:
+        _profileRecords.clear()
+    return summary
+
+#largest absolute error (in the units of the column: ns, strips, adc) a float column may pick up when compact=True stores it as float32, columns that would lose more (e.g. absolute times) stay float64
+COMPACT_FLOAT_TOLERANCE = 1e-3
+
+#narrowest dtype that holds every value of a column: integers go to the smallest signed integer type, floats to float32 if within float_tolerance
+#integers stay signed (int8/int16 rather than uint8/uint16) even when never negative, so differences such as size0 - size1 or adc - pedestal do not wrap around
+def _compactArray(values, float_tolerance=COMPACT_FLOAT_TOLERANCE):
+    values = np.asarray(values)
+    if len(values) == 0:
+        return values
+    if values.dtype.kind in 'iu':
+        low, high = values.min(), values.max()
+        for dtype in (np.int8, np.int16, np.int32, np.int64):
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return values.astype(dtype, copy=False)
+        return values
+    if values.dtype.kind == 'f' and values.dtype.itemsize > 4:
+        single = values.astype(np.float32)
+        with np.errstate(invalid='ignore', over='ignore'):
+            error = np.abs(single - values)
+        if np.all((error <= float_tolerance) | np.isnan(values)):
+            return single
+    return values
+
+#compact (narrowest safe dtype) version of a dict of columns or of a dataframe, see read_hit(compact=True)
+def compactColumns(columns, float_tolerance=COMPACT_FLOAT_TOLERANCE):
+    if isinstance(columns, pd.DataFrame):
+        return pd.DataFrame(data = {name: _compactArray(columns[name].to_numpy(), float_tolerance) for name in columns}, index=columns.index, copy=False)
+    return {name: _compactArray(values, float_tolerance) for name, values in columns.items()}
+
+#memory held by the columns of a dataframe in bytes, printed with a label unless verbose is False
+def memoryFootprint(df, label='', verbose=True):
+    nBytes = int(df.memory_usage(index=True, deep=False).sum())
+    if verbose:
+        print(f"{label + ': ' if label else ''}{len(df)} rows, {nBytes / 1e6:.1f} MB ({nBytes / max(len(df), 1):.1f} bytes per row)")
+    return nBytes
+
+#path of the cache entry for a tree of a ROOT file, the key changes whenever the file is rewritten (path, size and modification time)
+def _cachePath(file_loc, treeName):
+    stat = os.stat(file_loc)
+    key = f'{os.path.abspath(file_loc)}|{stat.st_size}|{stat.st_mtime_ns}|{treeName}'
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+#write the columns to the cache atomically so an interrupted or concurrent write never leaves a corrupt entry behind
+def _writeCache(cachePath, columns):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpPath = f'{cachePath}.{os.getpid()}.tmp'
+    with open(tmpPath, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(tmpPath, cachePath)
+    _evictCache()
+
+#delete the least recently used cache entries until the cache is below CACHE_MAX_BYTES
+def _evictCache():
+    entries = []
+    for path in glob.glob(os.path.join(CACHE_DIR, '*.npz')):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError: #removed by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    totalSize = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if totalSize <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        totalSize -= size
+
+#default branches of a tree, the clusters_detector layout (3 planes or 2 planes) is detected from the branches present in the file
+def _defaultColumns(treeName, treeBranches):
+    if treeName == 'hits':
+        return HIT_COLUMNS
+    elif 'pos2' in treeBranches:
+        return CLUSTER_COLUMNS
+    else:
+        return CLUSTER_COLUMNS_MAJD
+
+#named cuts usable by name in read_cluster(cut=...), iterateChunks and inside other cut expressions, add more with defineCut or loadCuts (a JSON file {"name": "expression"}, loaded at import from VMM_CUTS if set)
+CUT_SETS = {
+    'two_strips' : 'size0 >= 2 and size1 >= 2',
+    'in_time' : 'max_delta_time0 < 200 and max_delta_time1 < 200',
+    'planes_in_time' : 'abs(time0 - time1) < 100',
+}
+
+#functions allowed in a cut, the first group also exists in numexpr
+_CUT_FUNCTIONS = {'abs' : np.abs, 'sqrt' : np.sqrt, 'log' : np.log, 'log10' : np.log10, 'exp' : np.exp, 'where' : np.where}
+_CUT_FUNCTIONS_NUMPY = {'minimum' : np.minimum, 'maximum' : np.maximum, 'isnan' : np.isnan}
+_CUT_OPERATORS = {ast.Add : '+', ast.Sub : '-', ast.Mult : '*', ast.Div : '/', ast.Mod : '%', ast.Pow : '**', ast.BitAnd : '&', ast.BitOr : '|',
+    ast.Lt : '<', ast.LtE : '<=', ast.Gt : '>', ast.GtE : '>=', ast.Eq : '==', ast.NotEq : '!='}
+
+#add or replace a named cut
+def defineCut(name, expression):
+    if not name.isidentifier():
+        raise Exception(f"cut name {name} is not a valid identifier")
+    CUT_SETS[name] = expression if isinstance(expression, str) else expression.expression
+    _compileCut.cache_clear()
+
+#add the named cuts of a JSON file {"name": "expression"} so the same selections can be shared by several scripts
+def loadCuts(cutsFile):
+    with open(cutsFile) as f:
+        for name, expression in json.load(f).items():
+            defineCut(name, expression)
+
+#selection of rows written as a python expression over the columns, e.g. "size0 >= 2 and abs(dt0 - dt1) < 100 and region('a')"
+#only comparisons, arithmetic, and/or/not (with python truth values, numbers count as true when not 0), the elementwise &, |, ~, numbers, the functions of _CUT_FUNCTIONS and _CUT_FUNCTIONS_NUMPY, region(area) (see fiducialMask) and names of CUT_SETS are allowed
+#the expression is translated once into a single vectorised expression, evaluated with numexpr when it is installed (and only uses its functions) and with numpy otherwise
+#cuts combine with &, | and ~, and are evaluated on dataframes, dictionaries of columns or chunk by chunk (see filterChunks)
+class Cut:
+    def __init__(self, expression, geometry=None):
+        self.expression = expression.expression if isinstance(expression, Cut) else expression
+        self.geometry = geometry
+        self.source, self.columns, self.regions, self.numexprSafe = _compileCut(self.expression)
+
+    def __repr__(self):
+        return f'Cut({self.expression!r})'
+
+    def __and__(self, other):
+        return Cut(f'({self.expression}) and ({asCut(other).expression})', self.geometry)
+
+    def __or__(self, other):
+        return Cut(f'({self.expression}) or ({asCut(other).expression})', self.geometry)
+
+    def __invert__(self):
+        return Cut(f'not ({self.expression})', self.geometry)
+
+    #boolean mask of the rows passing the cut, data is a dataframe or a dictionary of column arrays with at least the columns of the cut
+    def mask(self, data):
+        missing = [name for name in self.columns if name not in data]
+        if missing:
+            raise Exception(f"cut {self.expression} needs the columns {missing}")
+        nRows = len(data) if isinstance(data, pd.DataFrame) else len(next(iter(data.values()), []))
+        variables = {name: np.asarray(data[name]) for name in self.columns}
+        if self.regions:
+            geometry = loadGeometry() if self.geometry is None else self.geometry
+            for name, area in self.regions.items():
+                variables[name] = _regionMask(data, area, geometry)
+        if numexpr is not None and self.numexprSafe:
+            result = numexpr.evaluate(self.source, local_dict=variables)
+        else:
+            result = eval(self.source, {'__builtins__' : {}, **_CUT_FUNCTIONS, **_CUT_FUNCTIONS_NUMPY}, variables)
+        return np.broadcast_to(np.asarray(result, dtype=bool), (nRows,))
+
+    #the rows of a dataframe passing the cut (index kept)
+    def apply(self, df):
+        return df[self.mask(df)]
+
+    #the rows of every chunk passing the cut, data is a dataframe or an iterable of dataframe chunks (e.g. iterateChunks)
+    def filterChunks(self, data):
+        for chunk in asChunks(data):
+            yield self.apply(chunk)
+
+#a Cut from an expression, the name of a cut in CUT_SETS or a Cut (returned as is), None stays None
+def asCut(cut, geometry=None):
+    if cut is None or isinstance(cut, Cut):
+        return cut
+    return Cut(cut, geometry)
+
+#region membership mask of the rows (pos0 and pos1), named areas of the geometry or the 'bottom right'/'bottom left' corners of fiducialMask
+def _regionMask(data, area, geometry):
+    if area in ('bottom right', 'bottom left'):
+        return fiducialMask(data, area)
+    return geometry.regionLabels(data) == geometry.areaCode(area)
+
+#parse and check an expression, returning (vectorised source, columns used, {variable: area} of the region() calls, whether numexpr can evaluate it)
+@functools.lru_cache(maxsize=None)
+def _compileCut(expression):
+    columns, regions = set(), {}
+    state = {'numexpr' : True}
+
+    def translate(node, inlining):
+        if isinstance(node, ast.Expression):
+            return translate(node.body, inlining)
+        if isinstance(node, ast.BoolOp):
+            joiner = ' & ' if isinstance(node.op, ast.And) else ' | '
+            return '(' + joiner.join(condition(value, inlining) for value in node.values) + ')'
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return f'(~{condition(node.operand, inlining)})'
+            if isinstance(node.op, ast.Invert):
+                return f'(~{translate(node.operand, inlining)})'
+            if isinstance(node.op, (ast.USub, ast.UAdd)):
+                return f"({'-' if isinstance(node.op, ast.USub) else '+'}{translate(node.operand, inlining)})"
+        if isinstance(node, ast.BinOp) and type(node.op) in _CUT_OPERATORS:
+            return f'({translate(node.left, inlining)} {_CUT_OPERATORS[type(node.op)]} {translate(node.right, inlining)})'
+        if isinstance(node, ast.Compare) and all(type(op) in _CUT_OPERATORS for op in node.ops):
+            operands = [node.left] + node.comparators
+            parts = [f'({translate(a, inlining)} {_CUT_OPERATORS[type(op)]} {translate(b, inlining)})' for a, op, b in zip(operands, node.ops, operands[1:])]
+            return parts[0] if len(parts) == 1 else '(' + ' & '.join(parts) + ')'
+        if isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            return repr(node.value)
+        if isinstance(node, ast.Name):
+            if node.id in CUT_SETS:
+                if node.id in inlining:
+                    raise Exception(f"cut {node.id} refers to itself")
+                return translate(ast.parse(CUT_SETS[node.id], mode='eval'), inlining | {node.id})
+            if node.id in _CUT_FUNCTIONS or node.id in _CUT_FUNCTIONS_NUMPY or node.id == 'region':
+                raise Exception(f"{node.id} is a function, call it in the cut {expression}")
+            columns.add(node.id)
+            return node.id
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name = node.func.id
+            if name == 'region':
+                if len(node.args) != 1 or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                    raise Exception("region takes one area name, e.g. region('a')")
+                columns.update(('pos0', 'pos1'))
+                variable = f'_region{len(regions)}'
+                regions[variable] = node.args[0].value
+                return variable
+            if name in _CUT_FUNCTIONS or name in _CUT_FUNCTIONS_NUMPY:
+                state['numexpr'] &= name in _CUT_FUNCTIONS
+                return f"{name}({', '.join(translate(arg, inlining) for arg in node.args)})"
+        raise Exception(f"{ast.unparse(node)} is not allowed in a cut ({expression})")
+
+    #operand of and/or/not: and/or/not become the elementwise &, |, ~, which are only logical on booleans, so numbers are compared to 0 first as python would
+    def condition(node, inlining):
+        isCondition = (isinstance(node, (ast.Compare, ast.BoolOp)) or (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not))
+            or (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('region', 'isnan'))
+            or (isinstance(node, ast.Name) and node.id in CUT_SETS) or (isinstance(node, ast.Constant) and isinstance(node.value, bool)))
+        return translate(node, inlining) if isCondition else f'({translate(node, inlining)} != 0)'
+
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise Exception(f"cut {expression} is not a valid expression: {e.msg}")
+    source = translate(tree, frozenset())
+    return source, tuple(sorted(columns)), regions, state['numexpr']
+
+#the columns to read so a cut can be evaluated, added to the requested ones (None, all default branches, stays None)
+def _withCutColumns(columns, cut):
+    if cut is None or columns is None:
+        return columns
+    return list(columns) + [name for name in cut.columns if name not in columns]
+
+#apply a cut to a dictionary of column arrays and keep only the requested columns (None keeps every column)
+def _cutColumns(columns, cut, keep=None):
+    keep = list(columns) if keep is None else keep
+    if cut is None:
+        return {name: columns[name] for name in keep}
+    mask = cut.mask(columns)
+    return {name: columns[name][mask] for name in keep}
+
+if os.environ.get('VMM_CUTS'):
+    loadCuts(os.environ['VMM_CUTS'])
+
+#read branches of a tree as numpy arrays in one batched uproot call, going through the cache if use_cache is True (rebuild=True forces the ROOT file to be decoded again)
+#branches=None reads the default branches of the detected layout, only the requested branches are decoded or loaded from the cache
+@profiled('read tree')
+def _readTree(file_loc, treeName, branches=None, use_cache=USE_CACHE, rebuild=False):
+    cached = None
+    treeBranches = None
+    if use_cache:
+        cachePath = _cachePath(file_loc, treeName)
+        if not rebuild and os.path.exists(cachePath):
+            try:
+                cached = np.load(cachePath, allow_pickle=False)
+                treeBranches = list(cached['__branches__'])
+                os.utime(cachePath) #mark as recently used for the eviction policy
+            except (OSError, ValueError, KeyError): #unreadable entry, decode the ROOT file again
+                cached = None
+
+    try:
+        cachedBranches = [] if cached is None else [name for name in cached.files if name != '__branches__']
+        if branches is None and treeBranches is not None:
+            branches = _defaultColumns(treeName, treeBranches)
+        if branches is not None and all(branch in cachedBranches for branch in branches):
+            return {branch: cached[branch] for branch in branches}
+
+        with uproot.open(file_loc) as file:
+            tree = file[treeName][treeName]
+            treeBranches = tree.keys()
+            if branches is None:
+                branches = _defaultColumns(treeName, treeBranches)
+            missing = [branch for branch in branches if branch not in cachedBranches]
+            columns = tree.arrays(missing, library='np')
+
+        if use_cache: #keeps every branch read so far so other selections of the same tree also hit the cache
+            columns.update({name: cached[name] for name in cachedBranches})
+            _writeCache(cachePath, dict(columns, __branches__=np.array(treeBranches)))
+    finally:
+        if cached is not None:
+            cached.close()
+
+    return {branch: columns[branch] for branch in branches}
+
+#remove cached trees, either all of them or only those belonging to the given ROOT file or folder of ROOT files
+#the entries of ROOT files that no longer exist are skipped (they are keyed on the file's size and modification time), they are removed by the size limit eviction or by clearCache()
+def clearCache(rootPath=None):
+    if rootPath is None:
+        paths = glob.glob(os.path.join(CACHE_DIR, '*.npz'))
+    else:
+        rootFiles = sorted(glob.glob(os.path.join(rootPath, "*.root"))) if os.path.isdir(rootPath) else [rootPath]
+        paths = []
+        for filePath in rootFiles:
+            try:
+                paths += [_cachePath(filePath, treeName) for treeName in ('hits', 'clusters_detector', 'clusters_detector/jagged')]
+            except FileNotFoundError: #deleted or renamed file, its entries can not be found without its size and modification time
+                continue
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+#read the columns of a tree and keep only the rows passing cut (see Cut), the branches the cut needs are read too but not returned
+#top level so it can run in a worker process
+def _readTreeCut(file_loc, treeName, columns=None, use_cache=USE_CACHE, rebuild=False, cut=None):
+    columnsRead = _readTree(file_loc, treeName, _withCutColumns(columns, cut), use_cache=use_cache, rebuild=rebuild)
+    if cut is None:
+        return columnsRead
+    keep = list(columnsRead) if columns is None else columns
+    missing = [name for name in cut.columns if name not in columnsRead]
+    if missing: #cut on branches outside the default ones
+        columnsRead.update(_readTree(file_loc, treeName, missing, use_cache=use_cache, rebuild=rebuild))
+    return _cutColumns(columnsRead, cut, keep)
+
 #this opens the ROOT file and returns the hits as a Pandas dataframe
-def read_hit(file_loc):
-    
-    file = uproot.open(file_loc)
-    hits = file['hits']['hits']
-
-    dict = {
-        'id' : hits['id'].array(),
-        'det' : hits['det'].array(),
-        'plane' : hits['plane'].array(),
-        'fec' : hits['fec'].array(),
-        'vmm' : hits['vmm'].array(),
-        'readout_time' : hits['readout_time'].array(),
-        'time' : hits['time'].array(),
-        'ch' : hits['ch'].array(),
-        'pos' : hits['pos'].array(),
-        'bcid' : hits['bcid'].array(),
-        'tdc' : hits['tdc'].array(),
-        'adc' : hits['adc'].array(),
-        'over_threshold' : hits['over_threshold'].array(),
-        'chip_time' : hits['chip_time'].array()
-        }
-
-    df = pd.DataFrame(data = dict)
+#columns is an optional list of branches to read (default HIT_COLUMNS), only those are decoded
+#compact=True stores every column in the narrowest dtype that holds its values (e.g. int8 for plane/vmm/ch, int16 for adc/pos, float32 where precision allows), see memoryFootprint
+#cut is an optional Cut, expression or name of CUT_SETS (e.g. 'adc > 50'), rows failing it are dropped before the dataframe is built
+def read_hit(file_loc, columns=None, use_cache=USE_CACHE, rebuild=False, compact=False, cut=None):
+    dict = _readTreeCut(file_loc, 'hits', columns, use_cache=use_cache, rebuild=rebuild, cut=asCut(cut))
+    if compact:
+        dict = compactColumns(dict)
+
+    df = pd.DataFrame(data = dict, copy=False)
 
     return df
 
 #this opens the ROOT file and returns the clusters as a Pandas dataframe
-def read_cluster(file_loc):
-
-    file = uproot.open(file_loc)
-
-    clusters_detector = file['clusters_detector']['clusters_detector']
-
-    dict = {
-    'id' : clusters_detector['id'].array(),
-    'id0' : clusters_detector['id0'].array(),
-    'id1' : clusters_detector['id1'].array(),
-    'id2' : clusters_detector['id2'].array(),
-    'det' : clusters_detector['det'].array(),
-    'size0' : clusters_detector['size0'].array(),
-    'size1' : clusters_detector['size1'].array(),
-    'size2' : clusters_detector['size2'].array(),
-    'adc0' : clusters_detector['adc0'].array(),
-    'adc1' : clusters_detector['adc1'].array(),
-    'adc2' : clusters_detector['adc2'].array(),
-    'pos0' : clusters_detector['pos0'].array(),
-    'pos1' : clusters_detector['pos1'].array(),
-    'pos2' : clusters_detector['pos2'].array(),
-    'time0' : clusters_detector['time0'].array(),
-    'time1' : clusters_detector['time1'].array(),
-    'time2' : clusters_detector['time2'].array(),
-    'pos0_utpc' : clusters_detector['pos0_utpc'].array(),
-    'pos1_utpc' : clusters_detector['pos1_utpc'].array(),
-    'pos2_utpc' : clusters_detector['pos2_utpc'].array(),
-    'time0_utpc' : clusters_detector['time0_utpc'].array(),
-    'time1_utpc' : clusters_detector['time1_utpc'].array(),
-    'time2_utpc' : clusters_detector['time2_utpc'].array(),
-    'pos0_charge2' : clusters_detector['pos0_charge2'].array(),
-    'pos1_charge2' : clusters_detector['pos1_charge2'].array(),
-    'pos2_charge2' : clusters_detector['pos2_charge2'].array(),
-    'time0_charge2' : clusters_detector['time0_charge2'].array(),
-    'time1_charge2' : clusters_detector['time1_charge2'].array(),
-    'time2_charge2' : clusters_detector['time2_charge2'].array(),
-    'pos0_algo' : clusters_detector['pos0_algo'].array(),
-    'pos1_algo' : clusters_detector['pos1_algo'].array(),
-    'pos2_algo' : clusters_detector['pos2_algo'].array(),
-    'time0_algo' : clusters_detector['time0_algo'].array(),
-    'time1_algo' : clusters_detector['time1_algo'].array(),
-    'time2_algo' : clusters_detector['time2_algo'].array(),
-    'dt0' : clusters_detector['dt0'].array(),
-    'dt1' : clusters_detector['dt1'].array(),
-    'dt2' : clusters_detector['dt2'].array(),
-    'delta_plane_0_1' : clusters_detector['delta_plane_0_1'].array(),
-    'delta_plane_1_2' : clusters_detector['delta_plane_1_2'].array(),
-    'delta_plane_0_2' : clusters_detector['delta_plane_0_2'].array(),
-    'span_cluster0' : clusters_detector['span_cluster0'].array(),
-    'span_cluster1' : clusters_detector['span_cluster1'].array(),
-    'span_cluster2' : clusters_detector['span_cluster2'].array(),
-    'max_delta_time0' : clusters_detector['max_delta_time0'].array(),
-    'max_delta_time1' : clusters_detector['max_delta_time1'].array(),
-    'max_delta_time2' : clusters_detector['max_delta_time2'].array(),
-    'max_missing_strip0' : clusters_detector['max_missing_strip0'].array(),
-    'max_missing_strip1' : clusters_detector['max_missing_strip1'].array(),
-    'max_missing_strip2' : clusters_detector['max_missing_strip2'].array(),
-    }
-
-    df = pd.DataFrame(data = dict)
+#works for both the 3 plane and the 2 plane (Majd's data) layouts, columns=None reads every branch of the detected layout
+#cut (e.g. "two_strips and region('a')") drops the rejected clusters before the dataframe is built, see read_hit
+def read_cluster(file_loc, columns=None, use_cache=USE_CACHE, rebuild=False, compact=False, cut=None):
+    dict = _readTreeCut(file_loc, 'clusters_detector', columns, use_cache=use_cache, rebuild=rebuild, cut=asCut(cut))
+    if compact:
+        dict = compactColumns(dict)
+
+    df = pd.DataFrame(data = dict, copy=False)
 
     return df
 
-'''    'strips0' : clusters_detector['strips0'].array(),
-    'strips1' : clusters_detector['strips1'].array(),
-    'strips2' : clusters_detector['strips2'].array(),
-    'adcs0' : clusters_detector['adcs0'].array(),
-    'adcs1' : clusters_detector['adcs1'].array(),
-    'adcs2' : clusters_detector['adcs2'].array(),
-    'times0' : clusters_detector['times0'].array(),
-    'times1' : clusters_detector['times1'].array(),
-    'times2' : clusters_detector['times2'].array(),  '''
+#per strip branches of the clusters_detector tree (one variable length array per cluster and plane)
+JAGGED_CLUSTER_COLUMNS = ['strips0', 'strips1', 'strips2', 'adcs0', 'adcs1', 'adcs2', 'times0', 'times1', 'times2']
+
+#variable length rows stored as one flat values array and offsets (row i is values[offsets[i]:offsets[i + 1]]), the CSR layout awkward uses
+#per row reductions are segment operations over the flat values, so millions of rows are reduced without a python loop or object columns
+class JaggedArray:
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or self.offsets[-1] != len(self.values):
+            raise Exception("offsets must start at 0 and end at the number of values")
+
+    #rows of values given by their start index (e.g. the hitOrder, hitStarts of clusterPlanes with return_hits=True)
+    @classmethod
+    def fromStarts(cls, values, starts):
+        return cls(values, np.append(np.asarray(starts, dtype=np.int64), len(values)))
+
+    @classmethod
+    def fromCounts(cls, values, counts):
+        return cls(values, np.concatenate(([0], np.cumsum(counts, dtype=np.int64))))
+
+    #from an awkward array of one level of nesting, or the object array of arrays uproot returns with library='np'
+    @classmethod
+    def fromArrays(cls, arrays):
+        if isinstance(arrays, ak.Array):
+            return cls.fromCounts(ak.to_numpy(ak.flatten(arrays)), ak.to_numpy(ak.num(arrays, axis=1)))
+        counts = np.fromiter((len(row) for row in arrays), dtype=np.int64, count=len(arrays))
+        return cls.fromCounts(np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0), counts)
+
+    #rows of several arrays one after the other (e.g. the same branch of every file of a run)
+    @classmethod
+    def concatenate(cls, jaggedArrays):
+        jaggedArrays = list(jaggedArrays)
+        shifts = np.cumsum([0] + [len(array.values) for array in jaggedArrays[:-1]])
+        offsets = [array.offsets[:-1] + shift for array, shift in zip(jaggedArrays, shifts)]
+        values = np.concatenate([array.values for array in jaggedArrays])
+        return cls(values, np.append(np.concatenate(offsets), len(values)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    #row of every value
+    def parents(self):
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    #rows start to stop as a JaggedArray sharing the values
+    def rows(self, start, stop):
+        first, last = self.offsets[start], self.offsets[stop]
+        return JaggedArray(self.values[first:last], self.offsets[start:stop + 1] - first)
+
+    #the same rows with other values of the same layout (e.g. adcs0 for strips0)
+    def withValues(self, values):
+        return JaggedArray(values, self.offsets)
+
+    #the selected rows, given as a boolean mask or row indices
+    def take(self, rows):
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows, dtype=np.int64)
+        counts = self.counts[rows]
+        index = np.repeat(self.offsets[rows] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts) + np.arange(counts.sum())
+        return JaggedArray.fromCounts(self.values[index], counts)
+
+    #sum of the values (or of values * weights) of every row, 0 for empty rows
+    def sum(self, weights=None):
+        values = self.values if weights is None else self.values * weights
+        return np.bincount(self.parents(), weights=values, minlength=len(self)) if len(values) > 0 else np.zeros(len(self))
+
+    #mean (weighted mean with weights) of every row, NaN for empty rows or rows without weight
+    def mean(self, weights=None):
+        norm = self.counts if weights is None else self.withValues(weights).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(weights) / np.where(norm != 0, norm, np.nan)
+
+    #minimum and maximum of every row with np.minimum.reduceat / np.maximum.reduceat, fill for empty rows
+    def min(self, fill=np.nan):
+        return self._reduceat(np.minimum, fill)
+
+    def max(self, fill=np.nan):
+        return self._reduceat(np.maximum, fill)
+
+    def _reduceat(self, ufunc, fill):
+        result = np.full(len(self), fill, dtype=np.result_type(self.values.dtype, np.asarray(fill).dtype))
+        filled = self.counts > 0
+        if filled.any():
+            result[filled] = ufunc.reduceat(self.values, self.offsets[:-1][filled])
+        return result
+
+    #standard deviation (weighted with weights) of every row around its mean, NaN for empty rows
+    def std(self, weights=None):
+        mean = self.mean(weights)
+        deviation = self.values - np.repeat(mean, self.counts)
+        return np.sqrt(self.withValues(deviation * deviation).mean(weights))
+
+#read the per strip branches (strips0, adcs0, times0, ...) of the clusters of a ROOT file as JaggedArrays, {branch: JaggedArray} in cluster order (the rows of read_cluster)
+#there is no cut here: with read_cluster(..., cut=...) the dataframe only keeps the passing clusters and its rows no longer line up with the strips, apply cut.mask to the uncut clusters and JaggedArray.take instead
+#branches=None reads the ones present for the detected layout, the flat values and offsets are cached next to the other branches (see _readTree)
+@profiled('read jagged')
+def read_cluster_strips(file_loc, branches=None, use_cache=USE_CACHE, rebuild=False):
+    cachePath = _cachePath(file_loc, 'clusters_detector/jagged')
+    cached = {}
+    if use_cache and not rebuild and os.path.exists(cachePath):
+        try:
+            with np.load(cachePath, allow_pickle=False) as f:
+                cached = {name: f[name] for name in f.files}
+            os.utime(cachePath)
+        except (OSError, ValueError, KeyError):
+            cached = {}
+
+    if branches is None and '__branches__' in cached:
+        branches = [branch for branch in JAGGED_CLUSTER_COLUMNS if branch in cached['__branches__']]
+    if branches is None or not all(f'{branch}.values' in cached for branch in branches):
+        with uproot.open(file_loc) as file:
+            tree = file['clusters_detector']['clusters_detector']
+            treeBranches = tree.keys()
+            if branches is None:
+                branches = [branch for branch in JAGGED_CLUSTER_COLUMNS if branch in treeBranches]
+            missing = [branch for branch in branches if f'{branch}.values' not in cached]
+            arrays = tree.arrays(missing, library='ak')
+        for branch in missing:
+            jagged = JaggedArray.fromArrays(arrays[branch])
+            cached[f'{branch}.values'], cached[f'{branch}.offsets'] = jagged.values, jagged.offsets
+        cached['__branches__'] = np.array(treeBranches)
+        if use_cache:
+            _writeCache(cachePath, cached)
+
+    return {branch: JaggedArray(cached[f'{branch}.values'], cached[f'{branch}.offsets']) for branch in branches}
+
+#read_cluster_strips of every ROOT file in a folder, concatenated in the order of combineDataFrames
+def combineClusterStrips(rootFolder, branches=None, use_cache=USE_CACHE, rebuild=False):
+    perFile = [read_cluster_strips(filePath, branches, use_cache, rebuild) for filePath in sorted(glob.glob(os.path.join(rootFolder, "*.root")))]
+    if not perFile:
+        raise Exception(f"No ROOT files found in {rootFolder}")
+    return {branch: JaggedArray.concatenate([strips[branch] for strips in perFile]) for branch in perFile[0]}
+
+#per cluster reductions of the strips of one plane from read_cluster_strips: number of strips, charge weighted centroid (strip units),
+#charge weighted mean time, time spread (last minus first strip time) and charge weighted rms of the times, as a dataframe with one row per cluster
+@profiled()
+def clusterStripSummary(strips, plane=0):
+    positions, adcs, times = strips[f'strips{plane}'], strips[f'adcs{plane}'].values.astype(np.float64), strips[f'times{plane}']
+    return pd.DataFrame(data = {
+        f'n_strips{plane}' : positions.counts,
+        f'centroid{plane}' : positions.mean(adcs),
+        f'time_mean{plane}' : times.mean(adcs),
+        f'time_spread{plane}' : times.max() - times.min(),
+        f'time_rms{plane}' : times.std(adcs),
+    }, copy=False)
+
+#index of the hit (row of df_hits) behind every strip of the clusters of one plane, as a JaggedArray with the layout of strips[f'strips{plane}'] (-1 where no hit matches)
+#a strip matches the hit on the same strip (pos) whose time is nearest to the strip time and at most time_tolerance (ns) away, so strip times stored as float32 or recomputed from the hit time still match
+#hits and strips are matched by sorting both together, no per cluster loop, df_hits needs the det, plane, pos and time columns
+#prints a warning when less than min_match of the strips found a hit (e.g. a time_tolerance below the precision of the stored times)
+#the strips follow the rows of read_cluster without a cut, with cut= the clusters dataframe is a subset and its rows no longer line up with the strips
+@profiled()
+def clusterHitIndex(df_hits, strips, plane=0, det=None, time_tolerance=1., min_match=0.9):
+    positions, times = strips[f'strips{plane}'], strips[f'times{plane}']
+    hitMask = np.asarray(df_hits['plane']) == plane
+    if det is not None:
+        hitMask &= np.asarray(df_hits['det']) == det
+    hitRows = np.flatnonzero(hitMask)
+
+    nHits = len(hitRows)
+    pos = np.concatenate((np.asarray(df_hits['pos'], dtype=np.int64)[hitRows], positions.values.astype(np.int64)))
+    time = np.concatenate((np.asarray(df_hits['time'], dtype=np.float64)[hitRows], times.values.astype(np.float64)))
+    isStrip = np.arange(len(pos)) >= nHits
+    order = np.lexsort((isStrip, time, pos)) #a hit sorts right before the strips with the same key
+    sortedAt = np.arange(len(order))
+    lastHit = np.maximum.accumulate(np.where(~isStrip[order], sortedAt, -1)) #sorted position of the last hit at or before each entry
+    nextHit = np.minimum.accumulate(np.where(~isStrip[order], sortedAt, len(order))[::-1])[::-1] #and of the first hit at or after it
+    stripAt = np.flatnonzero(isStrip[order])
+    stripPos, stripTime = pos[order[stripAt]], time[order[stripAt]]
+
+    matched = np.full(len(stripAt), -1, dtype=np.int64)
+    bestGap = np.full(len(stripAt), np.inf)
+    for neighbour in (lastHit[stripAt], nextHit[stripAt]):
+        valid = (neighbour >= 0) & (neighbour < len(order))
+        candidate = order[np.where(valid, neighbour, 0)]
+        gap = np.abs(time[candidate] - stripTime)
+        better = valid & (pos[candidate] == stripPos) & (gap <= time_tolerance) & (gap < bestGap)
+        matched[better], bestGap[better] = candidate[better], gap[better]
+
+    found = matched >= 0
+    index = np.full(len(stripAt), -1, dtype=np.int64)
+    index[order[stripAt] - nHits] = np.where(found, hitRows[np.where(found, matched, 0)], -1)
+    if len(index) > 0 and found.mean() < min_match:
+        print(f"warning: only {found.sum()} of {len(index)} strips of plane {plane} matched a hit within {time_tolerance} ns")
+    return positions.withValues(index)
+
+#decode one tree from every file in a thread or process pool and copy each file into its slice of preallocated columns as soon as it is done
+#the row counts are read from the ROOT headers first, so the files keep their order and only the final table plus the files in flight are held in memory (no list of dataframes to concat)
+#with a cut the number of rows of each file is only known once it is read, the files are then concatenated in order at the end
+def _combineTreeParallel(rootFiles, treeName, branches, parallel, max_workers, use_cache, rebuild, compact=False, cut=None):
+    if parallel == 'thread':
+        executorClass = ThreadPoolExecutor
+    elif parallel == 'process':
+        executorClass = ProcessPoolExecutor
+    else:
+        raise Exception("Pick a valid value for parallel, either None, 'thread' or 'process'")
+
+    if cut is None:
+        nEntries = []
+        for filePath in rootFiles:
+            with uproot.open(filePath) as file:
+                nEntries.append(file[treeName][treeName].num_entries)
+        offsets = np.concatenate(([0], np.cumsum(nEntries))).astype(np.int64)
+
+    columns = {}
+    pieces = {} #files passed through the cut, by position
+    with executorClass(max_workers=max_workers) as executor:
+        futures = {executor.submit(_profiledWorker, PROFILE, _stageDepth(), _readTreeCut, filePath, treeName, branches, use_cache, rebuild, cut): i for i, filePath in enumerate(rootFiles)}
+        for future in as_completed(futures):
+            i = futures.pop(future)
+            fileColumns = _workerResult(future.result())
+            if branches is None: #default branches of the layout detected in the files
+                branches = list(fileColumns)
+            if compact: #each file is compacted on its own, the full width table is never built
+                fileColumns = compactColumns(fileColumns)
+            if cut is not None:
+                pieces[i] = fileColumns
+                continue
+            for branch in branches:
+                if branch not in columns:
+                    columns[branch] = np.empty(offsets[-1], dtype=fileColumns[branch].dtype)
+                elif np.result_type(columns[branch].dtype, fileColumns[branch].dtype) != columns[branch].dtype: #a later file needs a wider compact dtype
+                    columns[branch] = columns[branch].astype(np.result_type(columns[branch].dtype, fileColumns[branch].dtype))
+                columns[branch][offsets[i]:offsets[i + 1]] = fileColumns[branch]
+            del fileColumns, future
+
+    if pieces:
+        columns = {branch: np.concatenate([pieces[i][branch] for i in sorted(pieces)]) for branch in branches}
+    if not columns: #no files in the folder
+        columns = {branch: np.empty(0) for branch in (branches or [])}
+        branches = list(columns)
+
+    return pd.DataFrame(data = {branch: columns[branch] for branch in branches}, copy=False)
 
 #combine the hit and cluster data of every ROOT file in a folder and return Pandas dataframes
-def combineDataFrames(rootFolder): #input is string with the name of the folder
+#hit_columns/cluster_columns select the branches to read (None reads all of them, [] skips the tree without opening or caching it and returns an empty dataframe)
+#parallel='thread' or 'process' decodes the files in a pool of max_workers instead of one at a time
+#compact=True keeps the columns in the narrowest safe dtypes (see read_hit), the files are then compacted one at a time so the full width tables are never held together
+#hit_cut/cluster_cut are applied to each file as it is read (see read_hit), so the rejected rows of the run are never held in memory
+@profiled()
+def combineDataFrames(rootFolder, hit_columns=None, cluster_columns=None, use_cache=USE_CACHE, rebuild=False, parallel=None, max_workers=None, compact=False, hit_cut=None, cluster_cut=None): #input is string with the name of the folder
     rootFiles = sorted(glob.glob(os.path.join(rootFolder, "*.root"))) #using the sorted feature assuming the filenames have a meaning (e.g., chronological)
+    hit_cut, cluster_cut = asCut(hit_cut), asCut(cluster_cut)
+    readHits, readClusters = hit_columns != [], cluster_columns != []
+    if parallel is not None:
+        df_hits = _combineTreeParallel(rootFiles, 'hits', hit_columns, parallel, max_workers, use_cache, rebuild, compact, hit_cut) if readHits else pd.DataFrame()
+        df_clusters = _combineTreeParallel(rootFiles, 'clusters_detector', cluster_columns, parallel, max_workers, use_cache, rebuild, compact, cluster_cut) if readClusters else pd.DataFrame()
+        return df_hits, df_clusters
+
     hits = []
     clusters = []
     for filePath in rootFiles:
-        hits.append(read_hit(filePath))
-        clusters.append(read_cluster(filePath))
+        if readHits:
+            hits.append(read_hit(filePath, columns=hit_columns, use_cache=use_cache, rebuild=rebuild, compact=compact, cut=hit_cut))
+        if readClusters:
+            clusters.append(read_cluster(filePath, columns=cluster_columns, use_cache=use_cache, rebuild=rebuild, compact=compact, cut=cluster_cut))
 
-    df_hits = pd.concat(hits, ignore_index=True)
-    df_clusters = pd.concat(clusters, ignore_index=True)
+    with profileStage('concat') as stage:
+        df_hits = pd.concat(hits, ignore_index=True) if hits else pd.DataFrame()
+        df_clusters = pd.concat(clusters, ignore_index=True) if clusters else pd.DataFrame()
+        stage.rows = len(df_hits) + len(df_clusters)
     return df_hits, df_clusters
 
-# Fit a Crystal Ball function to fe55 events
-def fitCB(df, plot=True, saveFig=True):
+#names accepted for the trees by iterateChunks
+TREE_NAMES = {'hits' : 'hits', 'clusters' : 'clusters_detector', 'clusters_detector' : 'clusters_detector'}
+
+#iterate over the hits or clusters of every ROOT file in a folder in dataframe chunks of step_size rows (the last chunk may be shorter), so memory depends on step_size and not on the length of the run
+#columns selects the branches (None reads all of them), cut is an optional Cut, expression or name of CUT_SETS (e.g. 'size0 >= 2') applied to every chunk before the rows reach a dataframe
+#chunks are filled up to step_size rows after the cut
+def iterateChunks(rootFolder, tree='hits', columns=None, cut=None, step_size=1000000):
+    treeName = TREE_NAMES[tree]
+    cut = asCut(cut)
+    rootFiles = sorted(glob.glob(os.path.join(rootFolder, "*.root"))) #using the sorted feature assuming the filenames have a meaning (e.g., chronological)
+
+    pending = [] #pieces of files waiting to be combined into a full chunk, chunks span file boundaries
+    nPending = 0
+    for filePath in rootFiles:
+        with uproot.open(filePath) as file:
+            treeObj = file[treeName][treeName]
+            branches = _defaultColumns(treeName, treeObj.keys()) if columns is None else columns
+            for arrays in treeObj.iterate(_withCutColumns(branches, cut), step_size=step_size, library='np'):
+                arrays = _cutColumns(arrays, cut, branches)
+                pending.append(arrays)
+                nPending += len(arrays[branches[0]]) if branches else 0
+                while nPending >= step_size:
+                    chunk, pending = _splitPending(pending, step_size)
+                    nPending -= step_size
+                    yield pd.DataFrame(data = chunk, copy=False)
+
+    if nPending > 0:
+        chunk, pending = _splitPending(pending, nPending)
+        yield pd.DataFrame(data = chunk, copy=False)
+
+#yield the rows of the tree of one ROOT file as dataframes of up to step_size rows, without combining chunks across files like iterateChunks, compact as in read_hit
+def iterateFileChunks(filePath, tree='hits', columns=None, cut=None, step_size=1000000, compact=False):
+    treeName = TREE_NAMES[tree]
+    cut = asCut(cut)
+    with uproot.open(filePath) as file:
+        treeObj = file[treeName][treeName]
+        branches = _defaultColumns(treeName, treeObj.keys()) if columns is None else columns
+        for arrays in treeObj.iterate(_withCutColumns(branches, cut), step_size=step_size, library='np'):
+            arrays = _cutColumns(arrays, cut, branches)
+            yield pd.DataFrame(data = compactColumns(arrays) if compact else arrays, copy=False)
+
+#take the first nRows rows out of a list of column dictionaries, returning them as one dictionary and the remaining pieces
+def _splitPending(pending, nRows):
+    columns = {name: np.concatenate([piece[name] for piece in pending]) for name in pending[0]}
+    chunk = {name: values[:nRows] for name, values in columns.items()}
+    rest = {name: values[nRows:] for name, values in columns.items()}
+    return chunk, [rest] if len(next(iter(rest.values()), [])) > 0 else []
+
+#lets the analysis functions take either a whole dataframe or an iterable of dataframe chunks (e.g. from iterateChunks)
+def asChunks(data):
+    if isinstance(data, pd.DataFrame):
+        return [data]
+    return data
+
+#bin index of each value for the given bin edges (-1 outside the edges), uniform bins are computed arithmetically instead of searched
+#as in np.histogram the bins are half open except the last one, which also holds values equal to the last edge
+def _binIndex(values, edges):
+    values = np.asarray(values, dtype=float)
+    widths = np.diff(edges)
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    if np.allclose(widths, widths[0]):
+        index = np.floor((values - edges[0]) / widths[0])
+    else:
+        index = np.searchsorted(edges, values, side='right') - 1
+    index = np.where(inside, np.clip(index, 0, len(edges) - 2), -1).astype(np.int64)
+    return index
+
+#common parts of the histogram accumulators: filled chunk by chunk, merged with + or merge(), saved to and loaded from .npz, drawn without the raw data
+class _Accumulator:
+    #fill a new accumulator from a dataframe or an iterable of dataframe chunks
+    @classmethod
+    def fromChunks(cls, data, *args, **kwargs):
+        hist = cls(*args, **kwargs)
+        for chunk in asChunks(data):
+            hist.fill(chunk)
+        return hist
+
+    def merge(self, other):
+        if type(other) is not type(self) or self.counts.shape != other.counts.shape or not all(np.array_equal(a, b) for a, b in zip(self.edges, other.edges)):
+            raise Exception("can only merge histograms of the same type and binning")
+        self.counts += other.counts
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        hist = self.copy()
+        return hist.merge(other)
+
+    def copy(self):
+        hist = object.__new__(type(self))
+        hist.edges = [edges.copy() for edges in self.edges]
+        hist.counts = self.counts.copy()
+        return hist
+
+    def save(self, path):
+        np.savez(path, counts=self.counts, **{f'edges{i}': edges for i, edges in enumerate(self.edges)})
+
+    @classmethod
+    def load(cls, path):
+        hist = object.__new__(cls)
+        with np.load(path, allow_pickle=False) as f:
+            hist.counts = f['counts']
+            hist.edges = [f[f'edges{i}'] for i in range(len(f.files) - 1)]
+        return hist
+
+#hit counts per plane and strip bin, counts[plane, bin]
+class StripHistogram(_Accumulator):
+    def __init__(self, strip_edges, n_planes=2):
+        self.edges = [np.asarray(strip_edges, dtype=float)]
+        self.counts = np.zeros((n_planes, len(strip_edges) - 1), dtype=np.int64)
+
+    def fill(self, df_hits):
+        nPlanes, nBins = self.counts.shape
+        plane = np.asarray(df_hits['plane'], dtype=np.int64)
+        index = _binIndex(df_hits['pos'], self.edges[0])
+        valid = (index >= 0) & (plane >= 0) & (plane < nPlanes)
+        self.counts += np.bincount(plane[valid] * nBins + index[valid], minlength=nPlanes * nBins).reshape(nPlanes, nBins)
+
+    #draw the hit rate of one plane as a step histogram, kwargs go to plt.stairs
+    def plot(self, plane, data_duration=1.0, **kwargs):
+        return plt.stairs(self.counts[plane] / data_duration, self.edges[0], **kwargs)
+
+    #the same as a series for figureSpec/renderFigures
+    def series(self, plane, data_duration=1.0, **style):
+        return stairsSeries(self.counts[plane], self.edges[0], 1. / data_duration, **style)
+
+#cluster counts in bins of (pos0, pos1), counts[x bin, y bin]
+class ClusterMap(_Accumulator):
+    def __init__(self, x_edges, y_edges=None):
+        self.edges = [np.asarray(x_edges, dtype=float), np.asarray(x_edges if y_edges is None else y_edges, dtype=float)]
+        self.counts = np.zeros((len(self.edges[0]) - 1, len(self.edges[1]) - 1), dtype=np.int64)
+
+    def fill(self, df_clusters):
+        nX, nY = self.counts.shape
+        xIndex = _binIndex(df_clusters['pos0'], self.edges[0])
+        yIndex = _binIndex(df_clusters['pos1'], self.edges[1])
+        valid = (xIndex >= 0) & (yIndex >= 0)
+        self.counts += np.bincount(xIndex[valid] * nY + yIndex[valid], minlength=nX * nY).reshape(nX, nY)
+
+    #draw the cluster rate with empty bins masked, kwargs go to plt.pcolormesh
+    def plot(self, data_duration=1.0, logscale=False, cmap=plt.cm.jet, **kwargs):
+        rate = np.ma.masked_equal(self.counts, 0).T / data_duration
+        return plt.pcolormesh(self.edges[0], self.edges[1], rate, cmap=cmap, norm=LogNorm() if logscale else None, **kwargs)
+
+    #the same as a series for figureSpec/renderFigures, cmap is a colormap name
+    def series(self, data_duration=1.0, logscale=False, cmap='jet', colorbar_label="Counts / s"):
+        return imageSeries(self.counts, self.edges[0], self.edges[1], 1. / data_duration, logscale, cmap, colorbar_label)
+
+#counts of gain values, filled from an array of gains (e.g. a chunk's gain column)
+class GainHistogram(_Accumulator):
+    def __init__(self, xmin=2000, xmax=15000, nbins=100):
+        self.edges = [np.linspace(xmin, xmax, nbins + 1)]
+        self.counts = np.zeros(nbins, dtype=np.int64)
+
+    def fill(self, gain):
+        index = _binIndex(gain, self.edges[0])
+        self.counts += np.bincount(index[index >= 0], minlength=len(self.counts))
+
+    #draw as a step histogram in counts / s (data_duration given), probability density (density=True) or counts, kwargs go to plt.stairs
+    def plot(self, data_duration=None, density=False, **kwargs):
+        if density:
+            values = self.counts / (self.counts.sum() * np.diff(self.edges[0]))
+        elif data_duration is not None:
+            values = self.counts / data_duration
+        else:
+            values = self.counts
+        return plt.stairs(values, self.edges[0], **kwargs)
+
+    #the same as a series for figureSpec/renderFigures
+    def series(self, data_duration=None, density=False, **style):
+        if density:
+            return stairsSeries(self.counts, self.edges[0], 1. / (max(self.counts.sum(), 1) * np.diff(self.edges[0])), **style)
+        return stairsSeries(self.counts, self.edges[0], 1. if data_duration is None else 1. / data_duration, **style)
+
+#result of a Crystal Ball fit, parameters as in scipy.stats.crystalball (beta, m, loc = mu, scale = sigma) with their errors
+#amplitude is the fitted number of events, success is False (with the reason in message and NaN parameters) when the fit did not converge or was rejected
+#covariance_ok is False when the errors could not be estimated from the Hessian (they are then NaN), the parameters of such a converged fit are still valid
+#fitCB also fills the charge sharing and the mean number of electrons on x and y of the fitted clusters
+@dataclass
+class CBFitResult:
+    beta: float = np.nan
+    beta_err: float = np.nan
+    m: float = np.nan
+    m_err: float = np.nan
+    mu: float = np.nan
+    mu_err: float = np.nan
+    sigma: float = np.nan
+    sigma_err: float = np.nan
+    amplitude: float = np.nan
+    success: bool = False
+    covariance_ok: bool = False
+    message: str = ''
+    nll: float = np.nan
+    ndf: int = 0
+    charge_sharing: float = np.nan
+    mu_e_x: float = np.nan
+    mu_e_y: float = np.nan
+
+    @property
+    def params(self):
+        return self.beta, self.m, self.mu, self.sigma
+
+    def pdf(self, x):
+        return crystalBallPdf(x, *self.params)
+
+#log of the Crystal Ball probability density (same normalisation as scipy.stats.crystalball.pdf), with gradient=True also its derivatives with respect to (beta, m, mu, sigma)
+def crystalBallLogPdf(x, beta, m, mu, sigma, gradient=False):
+    z = (np.asarray(x, dtype=np.float64) - mu) / sigma
+    expBeta = np.exp(-0.5 * beta**2)
+    norm = m / (beta * (m - 1)) * expBeta + np.sqrt(np.pi / 2) * (1 + erf(beta / np.sqrt(2)))
+    tail = z <= -beta
+    bMinusZ = m / beta - beta - np.where(tail, z, -beta) #(m/beta - beta - z) on the power law tail, >= m/beta elsewhere so the logs stay finite
+    g = np.where(tail, m * np.log(m / beta) - 0.5 * beta**2 - m * np.log(bMinusZ), -0.5 * z**2)
+    logPdf = g - np.log(norm) - np.log(sigma)
+    if not gradient:
+        return logPdf
+
+    dNorm_dbeta = expBeta * (1 - m / (m - 1) * (1 + 1 / beta**2))
+    dNorm_dm = -expBeta / (beta * (m - 1)**2)
+    dg_dz = np.where(tail, m / bMinusZ, -z)
+    dBeta = np.where(tail, -m / beta - beta + m * (m / beta**2 + 1) / bMinusZ, 0) - dNorm_dbeta / norm
+    dM = np.where(tail, np.log(m / beta) + 1 - np.log(bMinusZ) - m / (beta * bMinusZ), 0) - dNorm_dm / norm
+    dMu = -dg_dz / sigma
+    dSigma = -(1 + dg_dz * z) / sigma
+    return logPdf, np.array([dBeta, dM, dMu, dSigma])
 
+#Crystal Ball probability density, vectorised over x
+def crystalBallPdf(x, beta, m, mu, sigma):
+    return np.exp(crystalBallLogPdf(x, beta, m, mu, sigma))
+
+#Poisson negative log likelihood of the bin counts and its gradient, theta = (log amplitude, beta, m, mu, sigma) in the scaled units of the fit
+def _binnedCBNll(theta, centers, widths, counts):
+    logPdf, dLogPdf = crystalBallLogPdf(centers, *theta[1:], gradient=True)
+    logExpected = theta[0] + logPdf + np.log(widths)
+    expected = np.exp(logExpected)
+    nll = np.sum(expected - counts * logExpected)
+    residual = expected - counts
+    grad = np.concatenate(([residual.sum()], dLogPdf @ residual))
+    return nll, grad
+
+#data driven starting point: peak position from the (3 bin smoothed) histogram maximum and width from its full width at half maximum
+def _guessCB(counts, centers):
+    smooth = np.convolve(counts, np.ones(3) / 3, mode='same')
+    peak = int(np.argmax(smooth))
+    above = smooth >= smooth[peak] / 2
+    left = peak
+    while left > 0 and above[left - 1]:
+        left -= 1
+    right = peak
+    while right < len(smooth) - 1 and above[right + 1]:
+        right += 1
+    fwhm = max(centers[right] - centers[left], centers[1] - centers[0])
+    return 1.5, 3.0, centers[peak], fwhm / 2.355
+
+#binned maximum likelihood fit of a Crystal Ball to a histogram (counts per bin and bin edges, e.g. np.histogram output or GainHistogram.counts/edges[0])
+#p0 is a (beta, m, mu, sigma) starting point or a previous CBFitResult to warm start from, otherwise it is guessed from the histogram
+def fitCrystalBall(counts, bin_edges, p0=None, min_counts=100):
+    counts = np.asarray(counts, dtype=np.float64)
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    centers = (bin_edges[1:] + bin_edges[:-1]) / 2.
+    if counts.sum() < min_counts:
+        return CBFitResult(message=f"Poor fit: fewer than {min_counts} entries")
+
+    if isinstance(p0, CBFitResult):
+        p0 = p0.params if p0.success else None
+    beta0, m0, mu0, sigma0 = _guessCB(counts, centers) if p0 is None else p0
+
+    #fit in units of the starting width around the starting peak so all parameters are of order 1 for the minimiser
+    shift, scale = mu0, sigma0
+    args = ((centers - shift) / scale, np.diff(bin_edges) / scale, counts)
+    theta0 = np.array([np.log(counts.sum()), beta0, m0, 0.0, 1.0])
+    bounds = [(None, None), (0.05, 20.), (1.01, 100.), (None, None), (1e-3, None)]
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        fit = minimize(_binnedCBNll, theta0, args=args, jac=True, method='L-BFGS-B', bounds=bounds)
+    if not fit.success or not np.all(np.isfinite(fit.x)):
+        return CBFitResult(message=f"Poor fit: {fit.message}")
+
+    #errors from the inverse Hessian of the negative log likelihood, differentiating the analytic gradient numerically
+    steps = 1e-5 * np.maximum(1., np.abs(fit.x))
+    hessian = np.empty((len(fit.x), len(fit.x)))
+    for i, step in enumerate(steps):
+        delta = np.zeros(len(fit.x))
+        delta[i] = step
+        hessian[i] = (_binnedCBNll(fit.x + delta, *args)[1] - _binnedCBNll(fit.x - delta, *args)[1]) / (2 * step)
+    #a converged fit stays successful (and usable as a warm start) when the covariance cannot be estimated, e.g. with a tail parameter at its bound, its errors are then NaN and covariance_ok False
     try:
-        # Get gain values
-        gain = df.gain
-        # Keep only gain entries with z-score < 3 (exclude outlier which may be cosmic tracks or nuclear recoils)
-        gain =  gain[(np.abs(stats.zscore(gain)) < 3)]
-
-        # Do not attempt fit if there are less then 100 examples
-        if len(gain) < 100:
-            raise Exception("Poor fit")
-
-        xmin = 0
-        xmax = gain.max()
-        nbins = 100
-
-        hist, bin_edges = np.histogram(gain,nbins,(xmin,xmax))
-        bin_centers = (bin_edges[1:]+bin_edges[:-1])/2.
-        # Find Non-zero bins in Histogram
-        nz = hist>0
-        # Get error bars for bins
-        n_err = np.sqrt(hist[nz])
-
-        # Create numpy Histogram, use density this time
-        hist2, bin_edges2 = np.histogram(gain,nbins,(xmin,xmax), density = True)
-        bin_centers2 = (bin_edges2[1:]+bin_edges2[:-1])/2.
-
-        # Guess mu as bin_center with most hits
-        mu_guess = bin_centers2[np.argmax(hist2)]
-
-        # Find Non-zero bins in Histogram
-        nz2 = hist2>0
-        # Get error bars for bins
-        n_err2 = (np.sqrt(hist[nz])/hist[nz]) * hist2[nz2] # Fractional error times hist value
-
-        # Define Range and Fit :
-        try:
-            coeff, covar = curve_fit(crystalball.pdf, bin_centers2[nz2], hist2[nz2], sigma=n_err2, absolute_sigma=True, p0=(1, 2,mu_guess,1600)) #p0 = beta, m, mu, sigma
-        except:
-            coeff, covar = curve_fit(crystalball.pdf, bin_centers2[nz2], hist2[nz2], sigma=n_err2, absolute_sigma=True, p0=(2, 2,mu_guess,1600))
+        with np.errstate(invalid='ignore'):
+            errors = np.sqrt(np.diag(np.linalg.inv((hessian + hessian.T) / 2)))
+    except np.linalg.LinAlgError:
+        errors = np.full(len(fit.x), np.nan)
+    covarianceOk = bool(np.all(np.isfinite(errors)))
+
+    logAmplitude, beta, m, mu, sigma = fit.x
+    _, beta_err, m_err, mu_err, sigma_err = errors
+    return CBFitResult(beta=float(beta), beta_err=float(beta_err), m=float(m), m_err=float(m_err), mu=float(shift + scale * mu), mu_err=float(scale * mu_err),
+        sigma=float(scale * sigma), sigma_err=float(scale * sigma_err), amplitude=float(np.exp(logAmplitude)), success=True, covariance_ok=covarianceOk,
+        message='' if covarianceOk else 'singular covariance, errors not available', nll=float(fit.fun), ndf=int(np.count_nonzero(counts)) - len(fit.x))
+
+# Fit a Crystal Ball function to fe55 events, df needs the gain, electrons_x and electrons_y columns (see calibratedCharge)
+# returns a CBFitResult, p0 is an optional starting point or previous CBFitResult for a warm start
+@profiled()
+def fitCB(df, plot=True, saveFig=True, p0=None):
+    # Get gain values
+    gain = np.asarray(df.gain)
+    # Keep only gain entries with z-score < 3 (exclude outlier which may be cosmic tracks or nuclear recoils)
+    if len(gain) > 1:
+        gain = gain[(np.abs(stats.zscore(gain)) < 3)]
 
+    xmin = 0
+    xmax = gain.max() if len(gain) > 0 else 1
+    nbins = 100
 
-        f_opti = crystalball.pdf(bin_centers,*coeff)
+    hist, bin_edges = np.histogram(gain,nbins,(xmin,xmax))
+    bin_centers = (bin_edges[1:]+bin_edges[:-1])/2.
 
-        perr = np.sqrt(np.diag(covar))
+    # Do not attempt fit if there are less then 100 examples
+    result = fitCrystalBall(hist, bin_edges, p0=p0, min_counts=100)
+    if result.success and np.absolute(result.mu_err) > np.absolute(result.mu):
+        result.success = False
+        result.message = "Poor fit: mu error larger than mu"
 
-        if np.absolute(perr[2]) > np.absolute(coeff[2]):
-            raise Exception("Poor fit")
+    if len(df) > 0:
+        result.charge_sharing = float(1.0*np.mean(df.electrons_x/df.electrons_y))
+        result.mu_e_x = float(np.mean(df.electrons_x))
+        result.mu_e_y = float(np.mean(df.electrons_y))
 
+    if not result.success:
+        print(f"-fit failed- {result.message}")
+        return result
 
-        if plot == True and saveFig == True:
+    if plot == True:
+        if saveFig == True:
             plt.figure()
-            hist2, bin_edges2, patches2 = plt.hist(gain,nbins,(xmin,xmax), density = True, color='g',alpha=0.6)
-            bin_centers2 = (bin_edges2[1:]+bin_edges2[:-1])/2.
-            plt.xlabel("Gain")
-            plt.ylabel("Probability Density")
-            plt.plot(bin_centers, f_opti, 'r--', linewidth=2, label='CB Fit')
+        plt.stairs(hist / (hist.sum() * np.diff(bin_edges)), bin_edges, fill=True, color='g', alpha=0.6)
+        plt.xlabel("Gain")
+        plt.ylabel("Probability Density")
+        plt.plot(bin_centers, result.pdf(bin_centers), 'r--', linewidth=2, label='CB Fit')
+        if saveFig == True:
             plt.legend(loc='upper right')
             plt.savefig('gain_fit_CB.png', bbox_inches="tight")
             plt.close()
-        elif plot == True and saveFig == False: #if saveFig is False, user will need to add plt.figure() before calling this function
-            hist2, bin_edges2, patches2 = plt.hist(gain,nbins,(xmin,xmax), density = True, color='g',alpha=0.6)
-            bin_centers2 = (bin_edges2[1:]+bin_edges2[:-1])/2.
-            plt.xlabel("Gain")
-            plt.ylabel("Probability Density")
-            plt.plot(bin_centers, f_opti, 'r--', linewidth=2, label='CB Fit')
+        #if saveFig is False, user will need to add plt.figure() before calling this function
 
-        charge_sharing = 1.0*np.mean(df.electrons_x/df.electrons_y)
-        mu_e_x = np.mean(df.electrons_x)
-        mu_e_y = np.mean(df.electrons_y)
+    return result
 
+#fit one (key, counts, bin_edges, p0) item, top level so it can run in a worker process
+def _fitGainItem(item):
+    key, counts, bin_edges, p0 = item
+    return key, fitCrystalBall(counts, bin_edges, p0=p0)
 
-        return coeff[0], perr[0], coeff[1], perr[1], coeff[2], perr[2], coeff[3], perr[3], charge_sharing, mu_e_x, mu_e_y
+#fit many gain spectra concurrently in a process pool and return a tidy dataframe with one row per spectrum
+#histograms is a dict {key: GainHistogram or (counts, bin_edges)}, keys can be anything (run, preamp gain, region, tile, ...), tuple keys are split into the key_names columns
+#p0 is an optional starting point (or CBFitResult) for every fit or a dict {key: p0}, max_workers=1 fits serially in this process
+@profiled()
+def fitGainSpectra(histograms, key_names=None, max_workers=None, p0=None):
+    items = []
+    for key, hist in histograms.items():
+        counts, bin_edges = (hist.counts, hist.edges[0]) if isinstance(hist, GainHistogram) else hist
+        items.append((key, counts, bin_edges, p0.get(key) if isinstance(p0, dict) else p0))
 
-    except:
-        print("-fit failed-")
-        return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+    if max_workers == 1 or len(items) <= 1:
+        fits = [_fitGainItem(item) for item in items]
+    else:
+        workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outcomes = executor.map(_profiledWorker, [PROFILE] * len(items), [_stageDepth()] * len(items), [_fitGainItem] * len(items), items, chunksize=max(1, len(items) // (4 * workers)))
+            fits = [_workerResult(outcome) for outcome in outcomes]
 
-# Fiducializes dataframe so that clusters are contained in a specified area
-def fiducializeArea(df_cluster, area):
-
-    #this is based on the Zander_setup geometry file (VMM 8-15 on x, VMM 0-7 on y)
-    if area == 'd': #VMM 10, 2
-        df_fid = df_cluster.loc[(df_cluster.pos0 >= 156)  & (df_cluster.pos0 <= 217) & (df_cluster.pos1 >= 280) & (df_cluster.pos1 <=  342)].reset_index()
-    elif area == 'c': #VMM 10, 5
-        df_fid = df_cluster.loc[(df_cluster.pos0 >= 156)  & (df_cluster.pos0 <= 217) & (df_cluster.pos1 >= 156) & (df_cluster.pos1 <=  217)].reset_index()
-    elif area == 'b': #VMM 13, 2
-        df_fid = df_cluster.loc[(df_cluster.pos0 >= 280)  & (df_cluster.pos0 <= 342) & (df_cluster.pos1 >= 280) & (df_cluster.pos1 <=  342)].reset_index()
-    elif area == 'a': #VMM 13, 5
-        df_fid = df_cluster.loc[(df_cluster.pos0 >= 280)  & (df_cluster.pos0 <= 342) & (df_cluster.pos1 >= 156) & (df_cluster.pos1 <=  217)].reset_index()
-    elif area == 'bottom right': 
-        df_fid = df_cluster.loc[(df_cluster.pos0 >= 280) & (df_cluster.pos1 <=  217)].reset_index()
-    elif area == 'bottom left': 
-        df_fid = df_cluster.loc[(df_cluster.pos0 <= 217) & (df_cluster.pos1 <=  217)].reset_index()
+    rows = []
+    for key, result in fits:
+        if key_names is None:
+            row = {'key' : key}
+        else:
+            row = dict(zip(key_names, key if isinstance(key, tuple) else (key,)))
+        row.update(asdict(result))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+#gain histogram of every region of the geometry in one pass over the clusters, {(x vmm, y vmm): GainHistogram}
+@profiled()
+def gainHistogramsByRegion(df_clusters, x_gain, y_gain, geometry=None, xmin=2000, xmax=15000, nbins=100):
+    geometry = loadGeometry() if geometry is None else geometry
+    gain = calibratedCharge(df_clusters, x_gain, y_gain)['gain'].to_numpy()
+    labels = regionLabels(df_clusters, geometry).astype(np.int64)
+    nRegions = len(geometry.planeVmms[(geometry.detector, 0)]) * len(geometry.planeVmms[(geometry.detector, 1)])
+
+    index = _binIndex(gain, np.linspace(xmin, xmax, nbins + 1))
+    valid = (index >= 0) & (labels >= 0)
+    counts = np.bincount(labels[valid] * nbins + index[valid], minlength=nRegions * nbins).reshape(nRegions, nbins)
+
+    histograms = {}
+    for code in np.flatnonzero(counts.sum(axis=1)):
+        hist = GainHistogram(xmin, xmax, nbins)
+        hist.counts += counts[code]
+        (_, xVmm), (_, yVmm) = geometry.regionVmms(code)
+        histograms[(xVmm, yVmm)] = hist
+    return histograms
+
+#draw a gain spectrum as a probability density with its fitted Crystal Ball, hist is a GainHistogram or (counts, bin_edges), result a CBFitResult (or a row of fitGainSpectra)
+def plotGainFit(hist, result, color='g', label=None):
+    counts, bin_edges = (hist.counts, hist.edges[0]) if isinstance(hist, GainHistogram) else hist
+    bin_centers = (bin_edges[1:]+bin_edges[:-1])/2.
+    plt.stairs(counts / (counts.sum() * np.diff(bin_edges)), bin_edges, fill=True, color=color, alpha=0.6, label=label)
+    if result.success:
+        plt.plot(bin_centers, crystalBallPdf(bin_centers, result.beta, result.m, result.mu, result.sigma), '--', color=color, linewidth=2)
+    plt.xlabel("Gain")
+    plt.ylabel("Probability Density")
+
+#figures drawn from summaries: a figure is a dict of file name, axis settings and series of plain numbers and arrays (binned counts, fitted curves), never raw dataframes,
+#so it can be hashed to skip figures whose inputs did not change and drawn in worker processes, see renderFigures
+#step histogram series, values are counts * scale (e.g. scale=1/data_duration for counts / s), style goes to Axes.stairs (color, label, fill, ...)
+def stairsSeries(counts, edges, scale=1.0, **style):
+    return {'type' : 'stairs', 'values' : np.asarray(counts, dtype=float) * scale, 'edges' : np.asarray(edges, dtype=float), 'style' : style}
+
+#line or marker series, fmt and style go to Axes.plot
+def lineSeries(x, y, fmt='-', **style):
+    return {'type' : 'plot', 'x' : np.asarray(x, dtype=float), 'y' : np.asarray(y, dtype=float), 'fmt' : fmt, 'style' : style}
+
+#vertical (axis='x') or horizontal (axis='y') reference line
+def referenceLine(value, axis='x', **style):
+    return {'type' : 'axvline' if axis == 'x' else 'axhline', 'value' : float(value), 'style' : style}
+
+#text at data coordinates
+def textSeries(x, y, text, **style):
+    return {'type' : 'text', 'x' : float(x), 'y' : float(y), 'text' : str(text), 'style' : style}
+
+#2D map of counts (x bins along the first axis) * scale with empty bins masked, drawn with pcolormesh and a colorbar labelled colorbar_label
+def imageSeries(counts, x_edges, y_edges, scale=1.0, logscale=False, cmap='jet', colorbar_label=None):
+    return {'type' : 'image', 'values' : np.asarray(counts, dtype=float) * scale, 'x_edges' : np.asarray(x_edges, dtype=float), 'y_edges' : np.asarray(y_edges, dtype=float),
+        'logscale' : logscale, 'cmap' : cmap, 'colorbar_label' : colorbar_label}
+
+#the description of one figure, fileName is relative to the plot folder
+def figureSpec(fileName, series, xlabel=None, ylabel=None, title=None, logy=False, xlim=None, ylim=None, legend=None):
+    return {'file' : fileName, 'series' : list(series), 'xlabel' : xlabel, 'ylabel' : ylabel, 'title' : title, 'logy' : logy,
+        'xlim' : None if xlim is None else list(xlim), 'ylim' : None if ylim is None else list(ylim), 'legend' : legend}
+
+#feed a figure description into a hash, arrays by dtype, shape and bytes
+def _hashSpec(value, digest):
+    if isinstance(value, dict):
+        for key in sorted(value):
+            digest.update(repr(key).encode())
+            _hashSpec(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[%d' % len(value))
+        for item in value:
+            _hashSpec(item, digest)
+    elif isinstance(value, np.ndarray):
+        digest.update(f'{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
     else:
-        raise Exception("provide valid area")
+        digest.update(repr(value).encode())
+
+def figureHash(spec):
+    digest = hashlib.sha1()
+    _hashSpec(spec, digest)
+    return digest.hexdigest()
+
+#draw one figure description with matplotlib's object oriented API and the Agg canvas (no pyplot state, safe in worker processes) and save it to plotDir
+def renderFigure(spec, plotDir='.'):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.add_subplot()
+    for series in spec['series']:
+        kind = series['type']
+        if kind == 'stairs':
+            ax.stairs(series['values'], series['edges'], **series['style'])
+        elif kind == 'plot':
+            ax.plot(series['x'], series['y'], series['fmt'], **series['style'])
+        elif kind in ('axvline', 'axhline'):
+            getattr(ax, kind)(series['value'], **series['style'])
+        elif kind == 'text':
+            ax.text(series['x'], series['y'], series['text'], **series['style'])
+        elif kind == 'image':
+            values = np.ma.masked_equal(series['values'], 0).T
+            mesh = ax.pcolormesh(series['x_edges'], series['y_edges'], values, cmap=series['cmap'], norm=LogNorm() if series['logscale'] else None)
+            cbar = fig.colorbar(mesh, ax=ax)
+            if series['colorbar_label']:
+                cbar.set_label(series['colorbar_label'], rotation=270, labelpad=15)
+        else:
+            raise Exception(f"unknown series type {kind}")
+    if spec['logy']:
+        ax.set_yscale('log')
+    if spec['xlim'] is not None:
+        ax.set_xlim(*spec['xlim'])
+    if spec['ylim'] is not None:
+        ax.set_ylim(*spec['ylim'])
+    if spec['xlabel']:
+        ax.set_xlabel(spec['xlabel'])
+    if spec['ylabel']:
+        ax.set_ylabel(spec['ylabel'])
+    if spec['title']:
+        ax.set_title(spec['title'])
+    if spec['legend']:
+        ax.legend(loc=spec['legend'])
+    path = os.path.join(plotDir, spec['file'])
+    fig.savefig(path, bbox_inches="tight")
+    return path
+
+#draw a list of figure descriptions into plotDir in a pool of max_workers processes (default: number of cores), the workers only receive the summaries
+#a hash of every figure's description is kept in plotDir/.render_manifest.json and figures whose description and file are unchanged are skipped unless force is True
+#returns the file names that were drawn
+@profiled()
+def renderFigures(specs, plotDir='.', max_workers=None, force=False):
+    os.makedirs(plotDir, exist_ok=True)
+    manifestFile = os.path.join(plotDir, '.render_manifest.json')
+    manifest = {}
+    if os.path.exists(manifestFile):
+        try:
+            with open(manifestFile) as f:
+                manifest = json.load(f)
+        except ValueError:
+            manifest = {}
+
+    hashes = {spec['file'] : figureHash(spec) for spec in specs}
+    todo = [spec for spec in specs if force or manifest.get(spec['file']) != hashes[spec['file']] or not os.path.exists(os.path.join(plotDir, spec['file']))]
+    if len(todo) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(todo))) as executor:
+            for outcome in executor.map(_profiledWorker, [PROFILE] * len(todo), [_stageDepth()] * len(todo), [renderFigure] * len(todo), todo, [plotDir] * len(todo)):
+                _workerResult(outcome)
+    else:
+        for spec in todo:
+            renderFigure(spec, plotDir)
+
+    manifest.update({spec['file'] : hashes[spec['file']] for spec in todo})
+    tmpFile = manifestFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmpFile, manifestFile)
+    return [spec['file'] for spec in todo]
+
+_derivedCache = {} #columns derived from a dataframe keyed by (id of the dataframe, name, parameters), entries are dropped when the dataframe is garbage collected
+_derivedCacheOwners = set()
+
+#return compute() memoised per dataframe and key, compute again (memoise=False in the callers) if the source columns were changed in place
+def _memoised(df, key, compute):
+    fullKey = (id(df),) + key
+    if fullKey in _derivedCache:
+        return _derivedCache[fullKey]
+
+    value = compute()
+    if id(df) not in _derivedCacheOwners:
+        _derivedCacheOwners.add(id(df))
+        weakref.finalize(df, _dropDerived, id(df))
+    _derivedCache[fullKey] = value
+    return value
+
+def _dropDerived(dfId):
+    _derivedCacheOwners.discard(dfId)
+    for key in [key for key in _derivedCache if key[0] == dfId]:
+        del _derivedCache[key]
+
+#directory with the geometry JSON files given to convertFile, the fiducial areas default to the Zander setup
+GEOMETRY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Geometry Files')
+DEFAULT_GEOMETRY = os.path.join(GEOMETRY_DIR, 'small_detector_geo_Zander_setup.json')
+
+#named fiducial areas as a (x strip, y strip) inside them, the area is the pair of VMMs reading out these strips so the names work for every small detector geometry
+AREA_STRIPS = {'a' : (311, 186), 'b' : (311, 311), 'c' : (186, 186), 'd' : (186, 311)}
+
+#strip windows of every VMM read from a geometry JSON file (vmm_geometry entries with the id0 strip of each channel, -1 for unconnected channels)
+class DetectorGeometry:
+    def __init__(self, geoFile=DEFAULT_GEOMETRY):
+        self.geoFile = os.path.abspath(geoFile)
+        with open(geoFile) as f:
+            self.vmm_geometry = json.load(f)['vmm_geometry']
+
+        #(fec, vmm) of every VMM per (detector, plane), and the contiguous runs of strips they read out as sorted (first strip, last strip, VMM index) arrays
+        self.planeVmms = {}
+        windows = {}
+        for entry in self.vmm_geometry:
+            key = (entry['detector'], entry['plane'])
+            vmms = self.planeVmms.setdefault(key, [])
+            vmms.append((entry['fec'], entry['vmm']))
+            strips = np.sort([strip for strip in entry['id0'] if strip >= 0])
+            if len(strips) == 0:
+                continue
+            breaks = np.flatnonzero(np.diff(strips) > 1) + 1
+            firsts = strips[np.concatenate(([0], breaks))]
+            lasts = strips[np.concatenate((breaks - 1, [len(strips) - 1]))]
+            windows.setdefault(key, []).extend((first, last, len(vmms) - 1) for first, last in zip(firsts, lasts))
+
+        #dense (fec, vmm, ch) -> detector, plane, strip lookup table of the whole readout, -1 for unconnected channels
+        shape = (max(entry['fec'] for entry in self.vmm_geometry) + 1, max(entry['vmm'] for entry in self.vmm_geometry) + 1, 64)
+        self.channelTable = np.full((3,) + shape, -1, dtype=np.int16)
+        for entry in self.vmm_geometry:
+            strips = np.asarray(entry['id0'][:64], dtype=np.int16)
+            connected = strips >= 0
+            self.channelTable[0, entry['fec'], entry['vmm'], :len(strips)] = np.where(connected, entry['detector'], -1)
+            self.channelTable[1, entry['fec'], entry['vmm'], :len(strips)] = np.where(connected, entry['plane'], -1)
+            self.channelTable[2, entry['fec'], entry['vmm'], :len(strips)] = strips
+
+        self._windows = {}
+        for key, planeWindows in windows.items():
+            planeWindows = np.array(sorted(planeWindows))
+            self._windows[key] = (planeWindows[:, 0], planeWindows[:, 1], planeWindows[:, 2])
+        self.detector = min(det for det, _ in self.planeVmms)
+
+    #detector, plane and strip of every (fec, vmm, ch) with one fancy index into channelTable, -1 for unconnected channels and VMMs not in the geometry
+    def channelMap(self, fec, vmm, ch):
+        fec, vmm, ch = (np.asarray(values, dtype=np.int64) for values in (fec, vmm, ch))
+        _, nFec, nVmm, nCh = self.channelTable.shape
+        known = (fec >= 0) & (fec < nFec) & (vmm >= 0) & (vmm < nVmm) & (ch >= 0) & (ch < nCh)
+        flat = self.channelTable.reshape(3, -1)[:, np.where(known, (fec * nVmm + vmm) * nCh + ch, 0)]
+        return np.where(known, flat, -1)
+
+    #index in planeVmms[(det, plane)] of the VMM reading out each position, -1 outside every strip window (windows include their first and last strip)
+    def planeLabels(self, pos, plane, det=None):
+        firsts, lasts, owners = self._windows[(self.detector if det is None else det, plane)]
+        pos = np.asarray(pos, dtype=np.float64)
+        i = np.maximum(np.searchsorted(firsts, pos, side='right') - 1, 0)
+        inside = (pos >= firsts[i]) & (pos <= lasts[i])
+        return np.where(inside, owners[i], -1)
+
+    #compact region label of every cluster from its (pos0, pos1) in a single pass: x VMM index * number of y VMMs + y VMM index, -1 if outside
+    def regionLabels(self, df_clusters, det=None):
+        det = self.detector if det is None else det
+        xLabels = self.planeLabels(df_clusters['pos0'], 0, det)
+        yLabels = self.planeLabels(df_clusters['pos1'], 1, det)
+        nY = len(self.planeVmms[(det, 1)])
+        return np.where((xLabels >= 0) & (yLabels >= 0), xLabels * nY + yLabels, -1).astype(np.int16)
+
+    #region label of a named area ('a', 'b', 'c', 'd') or of a (x vmm, y vmm) pair
+    def areaCode(self, area, det=None):
+        det = self.detector if det is None else det
+        if area in AREA_STRIPS:
+            xStrip, yStrip = AREA_STRIPS[area]
+            xLabel = self.planeLabels([xStrip], 0, det)[0]
+            yLabel = self.planeLabels([yStrip], 1, det)[0]
+        else:
+            try:
+                xVmm, yVmm = area
+                xLabel = [vmm for _, vmm in self.planeVmms[(det, 0)]].index(xVmm)
+                yLabel = [vmm for _, vmm in self.planeVmms[(det, 1)]].index(yVmm)
+            except (TypeError, ValueError):
+                raise Exception("provide valid area")
+        if xLabel < 0 or yLabel < 0:
+            raise Exception(f"area {area} is not covered by {os.path.basename(self.geoFile)}")
+        return xLabel * len(self.planeVmms[(det, 1)]) + yLabel
+
+    #(fec, vmm) of the x and y VMMs of a region label
+    def regionVmms(self, code, det=None):
+        det = self.detector if det is None else det
+        nY = len(self.planeVmms[(det, 1)])
+        return self.planeVmms[(det, 0)][code // nY], self.planeVmms[(det, 1)][code % nY]
+
+    #strip windows (first strip, last strip) on x and on y of a named area or region label, e.g. to draw it
+    def areaWindows(self, area, det=None):
+        det = self.detector if det is None else det
+        code = area if isinstance(area, (int, np.integer)) else self.areaCode(area, det)
+        nY = len(self.planeVmms[(det, 1)])
+        windows = []
+        for plane, label in ((0, code // nY), (1, code % nY)):
+            firsts, lasts, owners = self._windows[(det, plane)]
+            windows.append([(int(first), int(last)) for first, last in zip(firsts[owners == label], lasts[owners == label])])
+        return windows
+
+#geometry files are parsed once per path
+@functools.lru_cache(maxsize=None)
+def loadGeometry(geoFile=DEFAULT_GEOMETRY):
+    return DetectorGeometry(geoFile)
+
+#returns a copy of a hits dataframe (or chunk) with det, plane and pos taken from the geometry file instead of the mapping convertFile used, so switching geometry does not need a reconversion
+#hits on channels the geometry leaves unconnected are dropped unless drop_unconnected is False (they then get -1)
+@profiled()
+def remapHits(df_hits, geometry=None, drop_unconnected=True):
+    geometry = loadGeometry() if geometry is None else geometry
+    if isinstance(geometry, str):
+        geometry = loadGeometry(geometry)
+    det, plane, strip = geometry.channelMap(df_hits['fec'], df_hits['vmm'], df_hits['ch'])
+    df_hits = df_hits.assign(det=det, plane=plane, pos=strip)
+    if drop_unconnected:
+        df_hits = df_hits[strip >= 0].reset_index(drop=True)
+    return df_hits
+
+#region label of every cluster for a geometry (see DetectorGeometry.regionLabels), memoised per dataframe so repeated area selections do not redo it
+def regionLabels(df_clusters, geometry=None, memoise=True):
+    geometry = loadGeometry() if geometry is None else geometry
+    if not memoise:
+        return geometry.regionLabels(df_clusters)
+    return _memoised(df_clusters, ('regionLabels', geometry.geoFile), lambda: geometry.regionLabels(df_clusters))
+
+#row positions of the clusters in every region, {region label: positions}, so per region analyses are index slices (e.g. values[positions]) instead of filtered copies
+def regionIndices(df_clusters, geometry=None):
+    labels = regionLabels(df_clusters, geometry)
+    order = np.argsort(labels, kind='stable')
+    codes, starts = np.unique(labels[order], return_index=True)
+    return {int(code): positions for code, positions in zip(codes, np.split(order, starts[1:])) if code >= 0}
+
+# Boolean mask of the clusters contained in a specified area
+# area is a named area ('a', 'b', 'c', 'd', 'bottom right', 'bottom left') or a (x vmm, y vmm) pair of the geometry (default Zander setup)
+@profiled()
+def fiducialMask(df_cluster, area, geometry=None):
+    if area == 'bottom right':
+        return (np.asarray(df_cluster['pos0']) >= 280) & (np.asarray(df_cluster['pos1']) <=  217)
+    elif area == 'bottom left':
+        return (np.asarray(df_cluster['pos0']) <= 217) & (np.asarray(df_cluster['pos1']) <=  217)
+
+    geometry = loadGeometry() if geometry is None else geometry
+    return regionLabels(df_cluster, geometry) == geometry.areaCode(area)
+
+# Fiducializes dataframe so that clusters are contained in a specified area
+def fiducializeArea(df_cluster, area, geometry=None):
+    df_fid = df_cluster.loc[fiducialMask(df_cluster, area, geometry)].reset_index()
 
     return df_fid
 
-#this opens the ROOT file and returns the clusters as a Pandas dataframe, works only for Majd's data
-def read_cluster_Majd(file_loc):
-
-    file = uproot.open(file_loc)
-
-    clusters_detector = file['clusters_detector']['clusters_detector']
-
-    dict = {
-    'id' : clusters_detector['id'].array(),
-    'id0' : clusters_detector['id0'].array(),
-    'id1' : clusters_detector['id1'].array(),
-    'det' : clusters_detector['det'].array(),
-    'size0' : clusters_detector['size0'].array(),
-    'size1' : clusters_detector['size1'].array(),
-    'adc0' : clusters_detector['adc0'].array(),
-    'adc1' : clusters_detector['adc1'].array(),
-    'pos0' : clusters_detector['pos0'].array(),
-    'pos1' : clusters_detector['pos1'].array(),
-    'time0' : clusters_detector['time0'].array(),
-    'time1' : clusters_detector['time1'].array(),
-    'pos0_utpc' : clusters_detector['pos0_utpc'].array(),
-    'pos1_utpc' : clusters_detector['pos1_utpc'].array(),
-    'time0_utpc' : clusters_detector['time0_utpc'].array(),
-    'time1_utpc' : clusters_detector['time1_utpc'].array(),
-    'pos0_charge2' : clusters_detector['pos0_charge2'].array(),
-    'pos1_charge2' : clusters_detector['pos1_charge2'].array(),
-    'time0_charge2' : clusters_detector['time0_charge2'].array(),
-    'time1_charge2' : clusters_detector['time1_charge2'].array(),
-    'pos0_algo' : clusters_detector['pos0_algo'].array(),
-    'pos1_algo' : clusters_detector['pos1_algo'].array(),
-    'time0_algo' : clusters_detector['time0_algo'].array(),
-    'time1_algo' : clusters_detector['time1_algo'].array(),
-    'dt0' : clusters_detector['dt0'].array(),
-    'dt1' : clusters_detector['dt1'].array(),
-    'delta_plane' : clusters_detector['delta_plane'].array(),
-    'span_cluster0' : clusters_detector['span_cluster0'].array(),
-    'span_cluster1' : clusters_detector['span_cluster1'].array(),
-    'max_delta_time0' : clusters_detector['max_delta_time0'].array(),
-    'max_delta_time1' : clusters_detector['max_delta_time1'].array(),
-    'max_missing_strip0' : clusters_detector['max_missing_strip0'].array(),
-    'max_missing_strip1' : clusters_detector['max_missing_strip1'].array(),
-    }
-
-    df = pd.DataFrame(data = dict)
+#hit and cluster times written by convertFile are in ns
+TIME_UNIT_S = 1e-9
 
-    return df
+#gaps between consecutive hits longer than this (in seconds) count as dead time (between files, DAQ stopped), shorter gaps as live time
+LIVE_MAX_GAP_S = 10.0
 
-#combine the hit and cluster data of every ROOT file in a folder and return Pandas dataframes, works only for Majd's data
-def combineDataFramesMajd(rootFolder): #input is string with the name of the folder
-    rootFiles = sorted(glob.glob(os.path.join(rootFolder, "*.root"))) #using the sorted feature assuming the filenames have a meaning (e.g., chronological)
-    hits = []
-    clusters = []
-    for filePath in rootFiles:
-        hits.append(read_hit(filePath))
-        clusters.append(read_cluster_Majd(filePath))
+#start times and lengths in seconds of the live gaps between consecutive (sorted) times, previous is the last time of the preceding chunk of the same file (None at the start of a file)
+#returns the gap starts, the gap lengths and the last time, to pass on as previous with the next chunk
+def _liveGaps(times, previous=None, max_gap_s=LIVE_MAX_GAP_S):
+    times = np.sort(np.asarray(times, dtype=np.float64))
+    if previous is not None:
+        times = np.concatenate(([previous], times))
+    if len(times) == 0:
+        return times, times, previous
+    gaps = np.diff(times) * TIME_UNIT_S
+    live = (gaps >= 0) & (gaps <= max_gap_s)
+    return times[:-1][live], gaps[live], max(times[-1], previous) if previous is not None else times[-1]
+
+#running live time of hit times that arrive in chunks (ROOT chunks, decoded pcapng windows), the gaps between chunks of the same file are counted, call startFile before every new file
+#seconds holds the live time so far, add returns the starts and lengths of the live gaps of the chunk (see _liveGaps) for binning them in time
+class LiveTimeCounter:
+    def __init__(self, max_gap_s=LIVE_MAX_GAP_S):
+        self.max_gap_s = max_gap_s
+        self.seconds = 0.0
+        self.last = None #last hit time of the current file
+
+    #live time gaps never span two files
+    def startFile(self):
+        self.last = None
+
+    def add(self, times):
+        starts, gaps, self.last = _liveGaps(times, self.last, self.max_gap_s)
+        self.seconds += float(gaps.sum())
+        return starts, gaps
+
+#live time in seconds of the hit times of one file (or any stretch of continuous data taking): the sum of the gaps between consecutive hits up to max_gap_s, so DAQ pauses inside the file are not counted
+def liveSeconds(times, max_gap_s=LIVE_MAX_GAP_S):
+    counter = LiveTimeCounter(max_gap_s)
+    counter.add(times)
+    return counter.seconds
+
+#live time in seconds of the hits of every ROOT file in a folder, from the hit timestamps instead of an assumed file duration: the sum of the gaps between consecutive hits of each file up to max_gap_s
+#streams the time column file by file, so the memory does not depend on the size of the run
+@profiled()
+def liveTime(rootFolder, max_gap_s=LIVE_MAX_GAP_S, step_size=1000000):
+    counter = LiveTimeCounter(max_gap_s)
+    for filePath in sorted(glob.glob(os.path.join(rootFolder, "*.root"))):
+        counter.startFile()
+        for chunk in iterateFileChunks(filePath, 'hits', ['time'], step_size=step_size):
+            counter.add(chunk['time'].to_numpy())
+    return counter.seconds
+
+#hit rates, cluster rates, live time and region gain spectra in fixed time intervals, filled chunk by chunk so a run of any length is analysed in one pass with bounded memory
+#intervals are interval_s long and aligned to multiples of interval_s of the timestamps, hits are binned on their time and clusters on time0, live time as in liveTime (a gap is counted in the interval it starts in)
+#gain spectra are only filled when x_gain and y_gain (preamp gains in mV/fC) are given, per region of geometry (default Zander setup)
+class StabilityMonitor:
+    def __init__(self, interval_s=600, x_gain=None, y_gain=None, geometry=None, gain_edges=np.linspace(2000, 15000, 101), n_planes=2, max_gap_s=LIVE_MAX_GAP_S):
+        self.interval_s = float(interval_s)
+        self.x_gain, self.y_gain = x_gain, y_gain
+        self.geometry = loadGeometry() if geometry is None else geometry
+        self.gain_edges = np.asarray(gain_edges, dtype=float)
+        self.max_gap_s = max_gap_s
+        self.nRegions = len(self.geometry.planeVmms[(self.geometry.detector, 0)]) * len(self.geometry.planeVmms[(self.geometry.detector, 1)])
+        self.first = None #interval number (timestamp // interval) of the first row of the arrays
+        self.hits = np.zeros((0, n_planes), dtype=np.int64) #[interval, plane]
+        self.vmmHits = np.zeros((0, 0), dtype=np.int64) #[interval, vmm]
+        self.clusters = np.zeros(0, dtype=np.int64) #[interval]
+        self.live = np.zeros(0) #[interval] seconds
+        self.gains = np.zeros((0, self.nRegions, len(self.gain_edges) - 1), dtype=np.int64) #[interval, region, gain bin]
+        self._liveCounter = LiveTimeCounter(max_gap_s)
+
+    #extend the arrays so they cover the interval numbers lo to hi
+    def _cover(self, lo, hi):
+        if self.first is None:
+            self.first = lo
+        before = max(self.first - lo, 0)
+        after = max(hi - (self.first + len(self.live) - 1), 0)
+        if before or after:
+            for name in ('hits', 'vmmHits', 'clusters', 'live', 'gains'):
+                values = getattr(self, name)
+                setattr(self, name, np.pad(values, [(before, after)] + [(0, 0)] * (values.ndim - 1)))
+            self.first -= before
+
+    #row of every time in the arrays
+    def _rows(self, times):
+        numbers = np.floor(np.asarray(times, dtype=np.float64) * TIME_UNIT_S / self.interval_s).astype(np.int64)
+        if len(numbers) > 0:
+            self._cover(numbers.min(), numbers.max())
+        return numbers - (self.first if self.first is not None else 0)
+
+    #live time gaps never span two files, call before the first chunk of every file
+    def startFile(self):
+        self._liveCounter.startFile()
+
+    #add a chunk of hits (plane, time and optionally vmm)
+    def fillHits(self, df_hits):
+        rows = self._rows(df_hits['time'])
+        nRows, nPlanes = self.hits.shape
+        plane = np.asarray(df_hits['plane'], dtype=np.int64)
+        valid = (plane >= 0) & (plane < nPlanes)
+        self.hits += np.bincount(rows[valid] * nPlanes + plane[valid], minlength=nRows * nPlanes).reshape(nRows, nPlanes)
+        if 'vmm' in df_hits:
+            vmm = np.asarray(df_hits['vmm'], dtype=np.int64)
+            if len(vmm) > 0 and vmm.max() >= self.vmmHits.shape[1]:
+                self.vmmHits = np.pad(self.vmmHits, [(0, 0), (0, vmm.max() + 1 - self.vmmHits.shape[1])])
+            nVmms = self.vmmHits.shape[1]
+            self.vmmHits += np.bincount(rows * nVmms + vmm, minlength=nRows * nVmms).reshape(nRows, nVmms)
+        starts, gaps = self._liveCounter.add(df_hits['time'])
+        self.live += np.bincount(self._rows(starts), weights=gaps, minlength=len(self.live))
+
+    #add a chunk of clusters (time0, and pos0, pos1, adc0, adc1 for the gain spectra)
+    def fillClusters(self, df_clusters):
+        rows = self._rows(df_clusters['time0'])
+        self.clusters += np.bincount(rows, minlength=len(self.clusters))
+        if self.x_gain is None or self.y_gain is None:
+            return
+        gain = calibratedCharge(df_clusters, self.x_gain, self.y_gain, memoise=False)['gain'].to_numpy()
+        labels = self.geometry.regionLabels(df_clusters).astype(np.int64)
+        index = _binIndex(gain, self.gain_edges)
+        valid = (index >= 0) & (labels >= 0)
+        nBins = len(self.gain_edges) - 1
+        key = (rows[valid] * self.nRegions + labels[valid]) * nBins + index[valid]
+        self.gains += np.bincount(key, minlength=self.gains.size).reshape(self.gains.shape)
+
+    #stream the hits and clusters of every ROOT file of a folder through the monitor, one chunk of step_size rows at a time
+    @profiled('StabilityMonitor.processFolder')
+    def processFolder(self, rootFolder, step_size=1000000):
+        for filePath in sorted(glob.glob(os.path.join(rootFolder, "*.root"))):
+            self.startFile()
+            for chunk in iterateFileChunks(filePath, 'hits', ['plane', 'vmm', 'time'], step_size=step_size):
+                self.fillHits(chunk)
+            clusterColumns = ['time0'] + ([] if self.x_gain is None or self.y_gain is None else ['pos0', 'pos1', 'adc0', 'adc1'])
+            for chunk in iterateFileChunks(filePath, 'clusters', clusterColumns, step_size=step_size):
+                self.fillClusters(chunk)
+        return self
+
+    #start of every interval in seconds of the timestamp clock
+    def intervalStarts(self):
+        return (np.arange(len(self.live)) + (self.first or 0)) * self.interval_s
+
+    #one row per interval: start_s, live_s, hit rate per plane (hits_plane0, ...), per VMM (hits_vmm0, ...) and cluster rate in counts / s of live time (NaN without live time)
+    def rates(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            perLive = 1. / np.where(self.live > 0, self.live, np.nan)
+        columns = {'start_s' : self.intervalStarts(), 'live_s' : self.live}
+        columns.update({f'hits_plane{plane}' : self.hits[:, plane] * perLive for plane in range(self.hits.shape[1])})
+        columns.update({f'hits_vmm{vmm}' : self.vmmHits[:, vmm] * perLive for vmm in range(self.vmmHits.shape[1]) if self.vmmHits[:, vmm].any()})
+        columns['clusters'] = self.clusters * perLive
+        return pd.DataFrame(data = columns)
+
+    #Crystal Ball fit of the gain spectrum of every region in every interval with at least min_counts clusters (see fitGainSpectra), one row per (start_s, x_vmm, y_vmm)
+    def gainPeaks(self, min_counts=100, max_workers=None):
+        histograms = {}
+        starts = self.intervalStarts()
+        for row, code in zip(*np.nonzero(self.gains.sum(axis=2) >= min_counts)):
+            (_, xVmm), (_, yVmm) = self.geometry.regionVmms(code)
+            histograms[(starts[row], xVmm, yVmm)] = (self.gains[row, code], self.gain_edges)
+        if not histograms:
+            return pd.DataFrame(columns=['start_s', 'x_vmm', 'y_vmm', 'mu', 'mu_err'])
+        return fitGainSpectra(histograms, key_names=['start_s', 'x_vmm', 'y_vmm'], max_workers=max_workers)
+
+    #rate and gain peak versus time figures for renderFigures (time in hours from the first interval)
+    def figures(self, gain_peaks=None, prefix='stability'):
+        rates = self.rates()
+        hours = (rates['start_s'] - rates['start_s'].min()) / 3600. if len(rates) > 0 else rates['start_s']
+        planes = [lineSeries(hours, rates[name], '.-', label=name.replace('hits_', '')) for name in rates if name.startswith('hits_plane')]
+        vmms = [lineSeries(hours, rates[name], '.-', label=name.replace('hits_', '')) for name in rates if name.startswith('hits_vmm')]
+        figures = [
+            figureSpec(f'{prefix}_hit_rate_planes.png', planes, xlabel='time (h)', ylabel='hits / s', legend='best'),
+            figureSpec(f'{prefix}_hit_rate_vmms.png', vmms, xlabel='time (h)', ylabel='hits / s', legend='best' if len(vmms) <= 16 else None),
+            figureSpec(f'{prefix}_cluster_rate.png', [lineSeries(hours, rates['clusters'], '.-')], xlabel='time (h)', ylabel='clusters / s'),
+            figureSpec(f'{prefix}_live_fraction.png', [lineSeries(hours, rates['live_s'] / self.interval_s, '.-')], xlabel='time (h)', ylabel='live fraction'),
+        ]
+        if gain_peaks is not None and len(gain_peaks) > 0:
+            start = rates['start_s'].min()
+            series = []
+            for (xVmm, yVmm), fits in gain_peaks[gain_peaks['success'].astype(bool)].groupby(['x_vmm', 'y_vmm']):
+                series.append(lineSeries((fits['start_s'] - start) / 3600., fits['mu'], '.-', label=f'VMM {xVmm}/{yVmm}'))
+            if series:
+                figures.append(figureSpec(f'{prefix}_gain_peak.png', series, xlabel='time (h)', ylabel='gain peak (mu)', legend='best'))
+        return figures
+
+#SRS/VMM3a readout constants used by the pcapng decoder: UDP port the FEC sends to, SRS timestamp clock period, data id marker in the payload header and end of frame marker
+VMM_UDP_PORT = 6006
+SRS_CLOCK_NS = 22.5
+VMM3_DATA_ID = 0x564D3300 #'VM3' followed by the FEC id in bits 4-7
+END_OF_FRAME = 0xFAFAFAFA
+
+#big endian unsigned integers of nBytes bytes at the given byte offsets of a byte buffer
+def _readBigEndian(buffer, offsets, nBytes):
+    value = np.zeros(len(offsets), dtype=np.uint64)
+    for i in range(nBytes):
+        value = (value << np.uint64(8)) | buffer[offsets + i].astype(np.uint64)
+    return value
+
+#12 bit gray code to binary (bcid)
+def _grayToBinary(gray):
+    binary = gray.copy()
+    for shift in (1, 2, 4, 8):
+        binary ^= binary >> shift
+    return binary
+
+#decode the SRS/VMM3a hits of a pcapng capture (run_single.sh/run_multiple.sh) in chunks, yielding dataframes with the columns of read_hit
+#the file is memory mapped and searched for Enhanced Packet Blocks with numpy (a block is accepted when its leading and trailing lengths agree and it holds an IPv4/UDP packet to udp_port with a VM3 payload), so there is no per packet python loop
+#assumes Ethernet link layer captures without VLAN tags, times are uncalibrated (bc_clock_mhz and tac_ns as given to convertFile with -bc and -tac)
+#det, plane and pos come from geometry (a DetectorGeometry or geometry file, see remapHits) if given, otherwise they are -1
+def iteratePcapngHits(pcapngFile, udp_port=VMM_UDP_PORT, bc_clock_mhz=40, tac_ns=60, window_bytes=1 << 26, geometry=None):
+    data = np.memmap(pcapngFile, dtype=np.uint8, mode='r')
+    if len(data) < 28 or int(_readBigEndian(data, np.array([0]), 4)[0]) != 0x0A0D0D0A:
+        raise Exception(f"{pcapngFile} is not a pcapng file")
+    endian = '<' if data[8:12].view('<u4')[0] == 0x1A2B3C4D else '>' #byte order of the pcapng block fields
+    words = data[:len(data) // 4 * 4].view(endian + 'u4')
+    bcPeriod = 1000. / bc_clock_mhz
+
+    lastMarker = np.zeros(16 * 32, dtype=np.uint64) #latest marker timestamp of every (fec, vmm), carried across windows
+    nextId = 0
+    windowWords = max(window_bytes // 4, 1)
+    for start in range(0, len(words), windowWords):
+        #candidate packet blocks: type 6 at a 4 byte boundary with a consistent total length
+        blocks = start + np.flatnonzero(words[start:start + windowWords] == 6)
+        blocks = blocks[blocks + 7 < len(words)]
+        length = words[blocks + 1].astype(np.int64)
+        good = (length % 4 == 0) & (length >= 32) & (blocks + length // 4 <= len(words))
+        blocks, length = blocks[good], length[good]
+        good = words[blocks + length // 4 - 1] == length
+        blocks, length = blocks[good], length[good]
+        capLength = words[blocks + 5].astype(np.int64)
+
+        #Ethernet + IPv4 + UDP headers, only read in blocks whose captured packet can hold them (short or empty packets are skipped first)
+        good = (capLength >= 14 + 20 + 8 + 16) & (capLength <= length - 32)
+        blocks, length, capLength = blocks[good], length[good], capLength[good]
+        packet = blocks * 4 + 28
+        ipHeader = packet + 14
+        ihl = (data[ipHeader] & 0x0F).astype(np.int64) * 4
+        udp = ipHeader + ihl
+        good = (_readBigEndian(data, packet + 12, 2) == 0x0800) & (data[ipHeader + 9] == 17) & (ihl >= 20) & (udp + 8 + 16 <= packet + capLength)
+        packet, udp, capLength = packet[good], udp[good], capLength[good]
+        good = _readBigEndian(data, udp + 2, 2) == udp_port
+        packet, udp, capLength = packet[good], udp[good], capLength[good]
+        payload = udp + 8
+        payloadLength = np.minimum(_readBigEndian(data, udp + 4, 2).astype(np.int64) - 8, packet + capLength - payload)
+
+        #SRS header: frame counter, data id with the FEC id, UDP timestamp, offset overflow
+        frameCounter = _readBigEndian(data, payload, 4)
+        dataId = _readBigEndian(data, payload + 4, 4)
+        good = ((dataId & 0xFFFFFF00) == VMM3_DATA_ID) & (frameCounter != END_OF_FRAME) & (payloadLength >= 16)
+        payload, payloadLength, dataId = payload[good], payloadLength[good], dataId[good]
+        fecPerPacket = ((dataId >> np.uint64(4)) & np.uint64(0x0F)).astype(np.int64)
+
+        #6 byte words after the header, expanded without a loop over packets
+        nWords = (payloadLength - 16) // 6
+        packetOfWord = np.repeat(np.arange(len(payload)), nWords)
+        firstWord = np.cumsum(nWords) - nWords
+        wordOffset = payload[packetOfWord] + 16 + 6 * (np.arange(len(packetOfWord)) - firstWord[packetOfWord])
+        data1 = _readBigEndian(data, wordOffset, 4)
+        data2 = _readBigEndian(data, wordOffset + 4, 2)
+        fec = fecPerPacket[packetOfWord]
+
+        isHit = ((data2 >> np.uint64(15)) & np.uint64(1)).astype(bool)
+        vmm = np.where(isHit, (data1 >> np.uint64(22)) & np.uint64(0x1F), (data2 >> np.uint64(10)) & np.uint64(0x1F)).astype(np.int64)
+        markerTime = (data1 << np.uint64(10)) | (data2 & np.uint64(0x3FF))
+
+        #trigger timestamp of every word: the latest marker of the same (fec, vmm) before it
+        key = fec * 32 + vmm
+        order = np.argsort(key, kind='stable')
+        sortedKey = key[order]
+        latest = np.maximum.accumulate(np.where(~isHit[order], np.arange(len(order)), -1))
+        hasMarker = (latest >= 0) & (sortedKey[np.maximum(latest, 0)] == sortedKey)
+        triggerTime = np.empty(len(order), dtype=np.uint64)
+        triggerTime[order] = np.where(hasMarker, markerTime[order][np.maximum(latest, 0)], lastMarker[sortedKey])
+        markers = np.flatnonzero(~isHit)
+        markerKeys, lastIndex = np.unique(key[markers][::-1], return_index=True)
+        lastMarker[markerKeys] = markerTime[markers][::-1][lastIndex]
+
+        hits = np.flatnonzero(isHit)
+        if len(hits) == 0:
+            continue
+        data1, data2 = data1[hits], data2[hits]
+        tdc = (data2 & np.uint64(0xFF)).astype(np.int64)
+        bcid = _grayToBinary((data1 & np.uint64(0xFFF)).astype(np.int64))
+        triggerOffset = ((data1 >> np.uint64(27)) & np.uint64(0x1F)).astype(np.int64)
+        chip_time = bcid * bcPeriod + (1.5 * bcPeriod - tdc * tac_ns / 255.)
+        readout_time = triggerTime[hits].astype(np.float64) * SRS_CLOCK_NS + triggerOffset * 4096 * bcPeriod
+        unmapped = np.full(len(hits), -1, dtype=np.int64)
+
+        df_hits = pd.DataFrame(data = {
+            'id' : np.arange(nextId, nextId + len(hits)),
+            'det' : unmapped,
+            'plane' : unmapped,
+            'fec' : fec[hits],
+            'vmm' : vmm[hits],
+            'readout_time' : readout_time,
+            'time' : readout_time + chip_time,
+            'ch' : ((data2 >> np.uint64(8)) & np.uint64(0x3F)).astype(np.int64),
+            'pos' : unmapped,
+            'bcid' : bcid,
+            'tdc' : tdc,
+            'adc' : ((data1 >> np.uint64(12)) & np.uint64(0x3FF)).astype(np.int64),
+            'over_threshold' : ((data2 >> np.uint64(14)) & np.uint64(1)).astype(bool),
+            'chip_time' : chip_time,
+            }, copy=False)
+        nextId += len(hits)
+        yield df_hits if geometry is None else remapHits(df_hits, geometry)
+
+#decode all SRS/VMM3a hits of a pcapng capture into one dataframe with the columns of read_hit, see iteratePcapngHits
+@profiled()
+def readPcapngHits(pcapngFile, **kwargs):
+    chunks = list(iteratePcapngHits(pcapngFile, **kwargs))
+    if not chunks:
+        return pd.DataFrame(columns=HIT_COLUMNS)
+    return pd.concat(chunks, ignore_index=True)
+
+#clustering parameters of convertFile (-cs, -ccs, -mst, -dt, -spc, -dp), the defaults are the ones in convert_config.json
+CLUSTER_PARAMETERS = {'cs' : 2, 'ccs' : 4, 'mst' : 1, 'dt' : 200, 'spc' : 1500, 'dp' : 200}
+
+#weighted mean of values over contiguous segments, NaN where the weights sum to zero
+def _segmentMean(values, weights, starts, weightSum=None):
+    weightSum = np.add.reduceat(weights, starts) if weightSum is None else weightSum
+    total = np.add.reduceat(values * weights, starts)
+    return np.divide(total, weightSum, out=np.full(len(starts), np.nan), where=weightSum > 0)
+
+#largest difference between consecutive values inside every contiguous segment, 0 for single hit segments
+def _segmentMaxStep(values, starts):
+    step = np.diff(values, prepend=values[:1])
+    step[starts] = 0
+    return np.maximum.reduceat(step, starts)
+
+#builds the plane clusters of a hits dataframe (read_hit, readPcapngHits, remapHits) like convertFile does, without any loop over hits
+#hits of each (det, plane) are sorted in time and split wherever consecutive hits are more than dt ns apart, each of these groups is sorted by strip and split wherever more than mst strips are missing
+#clusters with fewer than cs hits or spanning more than spc ns are dropped
+#returns one row per cluster (id, det, plane, size, adc, pos, time, pos_utpc, time_utpc, pos_charge2, time_charge2, dt, span_cluster, max_delta_time, max_missing_strip)
+#pos and time are adc weighted, charge2 weighted by adc squared, utpc are the strip and time of the latest hit; with return_hits=True the order of the hits grouped by cluster and the start of every cluster in it are returned as well
+@profiled()
+def clusterPlanes(df_hits, dt=CLUSTER_PARAMETERS['dt'], mst=CLUSTER_PARAMETERS['mst'], spc=CLUSTER_PARAMETERS['spc'], cs=CLUSTER_PARAMETERS['cs'], return_hits=False):
+    det = np.asarray(df_hits['det'], dtype=np.int64)
+    plane = np.asarray(df_hits['plane'], dtype=np.int64)
+    pos = np.asarray(df_hits['pos'], dtype=np.float64)
+    time = np.asarray(df_hits['time'], dtype=np.float64)
+    adc = np.asarray(df_hits['adc'], dtype=np.float64)
+    planeKey = det * 4 + plane
+
+    #time groups: sort by (det, plane, time), new group at every plane change or time gap above dt
+    byTime = np.argsort(time)
+    byTime = byTime[np.argsort(planeKey[byTime], kind='stable')]
+    timeKey, timeSorted, timePos = planeKey[byTime], time[byTime], pos[byTime]
+    newGroup = np.ones(len(byTime), dtype=bool)
+    newGroup[1:] = (timeKey[1:] != timeKey[:-1]) | (np.diff(timeSorted) > dt)
+    group = np.cumsum(newGroup)
+
+    #clusters: sort every time group by strip (stable, so hits on one strip stay in time order), new cluster at every group change or gap of more than mst missing strips
+    #strips are whole numbers, so (group, strip) packs into one integer key, which sorts much faster than a lexsort
+    if len(timePos) > 0 and np.all(timePos == np.round(timePos)):
+        stripKey = group * (int(timePos.max() - timePos.min()) + 1) + (timePos - timePos.min()).astype(np.int64)
+        byStrip = np.argsort(stripKey, kind='stable')
+    else:
+        byStrip = np.lexsort((timePos, group))
+    order = byTime[byStrip]
+    sortedGroup, sortedPos = group[byStrip], timePos[byStrip]
+    newCluster = np.ones(len(order), dtype=bool)
+    newCluster[1:] = (sortedGroup[1:] != sortedGroup[:-1]) | (np.diff(sortedPos) > mst + 1)
+    cluster = np.cumsum(newCluster) - 1
+    starts = np.flatnonzero(newCluster)
+    if len(starts) == 0:
+        empty = pd.DataFrame(columns=['id', 'det', 'plane', 'size', 'adc', 'pos', 'time', 'pos_utpc', 'time_utpc', 'pos_charge2', 'time_charge2',
+            'dt', 'span_cluster', 'max_delta_time', 'max_missing_strip'])
+        return (empty, order, starts) if return_hits else empty
+
+    size = np.diff(np.append(starts, len(order)))
+    sortedAdc, sortedTime = adc[order], timeSorted[byStrip]
+    adcSum = np.add.reduceat(sortedAdc, starts)
+    adc2 = sortedAdc ** 2
+    adc2Sum = np.add.reduceat(adc2, starts)
+    ends = np.append(starts[1:], len(order)) - 1
+    firstStrip, lastStrip = sortedPos[starts], sortedPos[ends]
+    maxMissing = _segmentMaxStep(sortedPos, starts) - 1
+
+    #time ordered view of every cluster for the time span, the latest hit and the largest time step: a stable sort of the cluster numbers in time order
+    clusterInTime = np.empty(len(order), dtype=np.int64)
+    clusterInTime[byStrip] = cluster
+    inTime = np.argsort(clusterInTime, kind='stable')
+    timeOrdered = timeSorted[inTime]
+    firstTime, lastTime = timeOrdered[starts], timeOrdered[ends]
+
+    clusters = pd.DataFrame(data = {
+        'det' : det[order][starts],
+        'plane' : plane[order][starts],
+        'size' : size,
+        'adc' : adcSum,
+        'pos' : _segmentMean(sortedPos, sortedAdc, starts, adcSum),
+        'time' : _segmentMean(sortedTime, sortedAdc, starts, adcSum),
+        'pos_utpc' : timePos[inTime][ends],
+        'time_utpc' : lastTime,
+        'pos_charge2' : _segmentMean(sortedPos, adc2, starts, adc2Sum),
+        'time_charge2' : _segmentMean(sortedTime, adc2, starts, adc2Sum),
+        'dt' : lastTime - firstTime,
+        'span_cluster' : lastStrip - firstStrip + 1,
+        'max_delta_time' : _segmentMaxStep(timeOrdered, starts),
+        'max_missing_strip' : np.maximum(maxMissing, 0),
+        }, copy=False)
+    keep = (size >= cs) & (clusters['dt'].to_numpy() <= spc)
+    clusters = clusters[keep].reset_index(drop=True)
+    clusters.insert(0, 'id', np.arange(len(clusters)))
+    if return_hits:
+        kept = np.repeat(keep, size)
+        hitOrder = order[kept]
+        hitStarts = np.cumsum(np.append(0, size[keep]))[:-1]
+        return clusters, hitOrder, hitStarts
+    return clusters
+
+#index of the nearest value of sortedValues to every value (sortedValues must be sorted and not empty)
+def _nearest(sortedValues, values):
+    if len(sortedValues) == 1:
+        return np.zeros(len(values), dtype=np.int64)
+    i = np.clip(np.searchsorted(sortedValues, values), 1, len(sortedValues) - 1)
+    left = np.abs(values - sortedValues[i - 1]) <= np.abs(sortedValues[i] - values)
+    return np.where(left, i - 1, i)
+
+#pairs the x (plane 0) and y (plane 1) clusters of every detector into detector clusters with the columns of read_cluster for 2 plane files
+#an x and a y cluster are paired when each is the other's nearest cluster in time, less than dp ns apart, and together have at least ccs hits
+@profiled()
+def matchPlanes(df_planes, dp=CLUSTER_PARAMETERS['dp'], ccs=CLUSTER_PARAMETERS['ccs']):
+    matched = []
+    for det in np.unique(df_planes['det']):
+        x = df_planes[(df_planes['det'] == det) & (df_planes['plane'] == 0)].sort_values('time', kind='stable')
+        y = df_planes[(df_planes['det'] == det) & (df_planes['plane'] == 1)].sort_values('time', kind='stable')
+        if len(x) == 0 or len(y) == 0:
+            continue
+        xTime, yTime = x['time'].to_numpy(), y['time'].to_numpy()
+        xToY, yToX = _nearest(yTime, xTime), _nearest(xTime, yTime)
+        xIndex = np.flatnonzero(yToX[xToY] == np.arange(len(xTime)))
+        yIndex = xToY[xIndex]
+        good = (np.abs(xTime[xIndex] - yTime[yIndex]) <= dp) & (x['size'].to_numpy()[xIndex] + y['size'].to_numpy()[yIndex] >= ccs)
+        matched.append((x.iloc[xIndex[good]].reset_index(drop=True), y.iloc[yIndex[good]].reset_index(drop=True)))
+
+    if not matched:
+        return pd.DataFrame(columns=CLUSTER_COLUMNS_MAJD)
+    x = pd.concat([pair[0] for pair in matched], ignore_index=True)
+    y = pd.concat([pair[1] for pair in matched], ignore_index=True)
+    columns = {'id' : np.arange(len(x)), 'id0' : x['id'].to_numpy(), 'id1' : y['id'].to_numpy(), 'det' : x['det'].to_numpy()}
+    for name in ['size', 'adc', 'pos', 'time']:
+        columns[f'{name}0'], columns[f'{name}1'] = x[name].to_numpy(), y[name].to_numpy()
+    #convertFile's algo position/time is the adc weighted one in the default reconstruction
+    for name in ['pos', 'time']:
+        for method, source in (('utpc', f'{name}_utpc'), ('charge2', f'{name}_charge2'), ('algo', name)):
+            columns[f'{name}0_{method}'], columns[f'{name}1_{method}'] = x[source].to_numpy(), y[source].to_numpy()
+    columns['dt0'], columns['dt1'] = x['dt'].to_numpy(), y['dt'].to_numpy()
+    columns['delta_plane'] = x['time'].to_numpy() - y['time'].to_numpy()
+    for name in ['span_cluster', 'max_delta_time', 'max_missing_strip']:
+        columns[f'{name}0'], columns[f'{name}1'] = x[name].to_numpy(), y[name].to_numpy()
+    return pd.DataFrame(data = columns, copy=False)[CLUSTER_COLUMNS_MAJD]
+
+#clusters a hits dataframe in memory with convertFile's clustering parameters, e.g. to scan them without reconverting the captures
+#returns the detector clusters (columns of read_cluster for 2 plane files, see matchPlanes) and the plane clusters (see clusterPlanes)
+def clusterHits(df_hits, cs=CLUSTER_PARAMETERS['cs'], ccs=CLUSTER_PARAMETERS['ccs'], mst=CLUSTER_PARAMETERS['mst'], dt=CLUSTER_PARAMETERS['dt'], spc=CLUSTER_PARAMETERS['spc'], dp=CLUSTER_PARAMETERS['dp']):
+    df_planes = clusterPlanes(df_hits, dt=dt, mst=mst, spc=spc, cs=cs)
+    return matchPlanes(df_planes, dp=dp, ccs=ccs), df_planes
+
+#uTPC track reconstruction: the drift time of each strip of a cluster gives the depth of its charge, so a straight line fit of time vs strip position gives the track angle in each plane
+#the fits of all clusters run at once from segment sums of the strips (see JaggedArray), chunk_size clusters at a time to bound the memory
+
+#charge weighted least squares fit of time (ns) vs position (mm) of every row, with positions and times shifted by the row's first strip so the sums keep their precision
+#returns (number of strips, slope in ns/mm, intercept in ns at position 0, weighted chi2), NaN slope for rows with fewer than 2 distinct positions
+def _fitSegments(positions, times, weights):
+    counts = positions.counts
+    parents = positions.parents()
+    firsts = np.minimum(positions.offsets[:-1], max(len(positions.values) - 1, 0))
+    x0 = positions.values[firsts] if len(positions.values) > 0 else np.zeros(len(counts))
+    y0 = times.values[firsts] if len(times.values) > 0 else np.zeros(len(counts))
+    x = positions.values - np.repeat(x0, counts)
+    y = times.values - np.repeat(y0, counts)
+
+    def segmentSum(values):
+        return np.bincount(parents, weights=values, minlength=len(counts))
+    S, Sx, Sy = segmentSum(weights), segmentSum(weights * x), segmentSum(weights * y)
+    Sxx, Sxy, Syy = segmentSum(weights * x * x), segmentSum(weights * x * y), segmentSum(weights * y * y)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        det = S * Sxx - Sx * Sx
+        det = np.where(det > 1e-9 * np.maximum(S * Sxx, 1e-300), det, np.nan)
+        slope = (S * Sxy - Sx * Sy) / det
+        shiftedIntercept = (Sy - slope * Sx) / S
+        chi2 = np.maximum(Syy - shiftedIntercept * Sy - slope * Sxy, 0.)
+    return counts, slope, y0 + shiftedIntercept - slope * x0, chi2
+
+#charge asymmetry of every row along its strips, (charge below the middle of the cluster - charge above) / total charge, in [-1, 1]
+#takes the integer strip numbers, so the middle strip of an odd width cluster lies exactly on the middle and counts on neither side
+def _chargeAsymmetry(positions, weights):
+    middle = np.repeat((positions.min() + positions.max()) / 2., positions.counts)
+    side = np.sign(middle - positions.values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return positions.withValues(weights * side).sum() / positions.withValues(weights).sum()
+
+#fit the track of every cluster from the strips of the x (plane 0) and y (plane 1) planes (see read_cluster_strips), pitch in mm per strip and drift_velocity in mm/ns of the gas and field used
+#per plane columns: n_fit, slope (ns/mm), intercept (ns), chi2 of the charge weighted fit (NaN slope for fewer than 2 strips) and headtail, the charge asymmetry along the strips
+#track columns: dir_x, dir_y, dir_z unit direction, theta (polar angle from the drift axis) and phi (azimuth from the x strips axis) in radians
+#the direction of a line is only known up to its sign, it is oriented so it points away from the end with more charge (the start of a low energy recoil track, where the ionisation density is higher),
+#headtail is the asymmetry projected on that direction, near 0 when the sign could not be told apart; clusters without a fit in both planes get NaN
+@profiled()
+def fitTracks(strips, pitch, drift_velocity, planes=(0, 1), chunk_size=1000000):
+    nClusters = len(strips[f'strips{planes[0]}'])
+    results = []
+    for start in range(0, max(nClusters, 1), chunk_size):
+        stop = min(start + chunk_size, nClusters)
+        columns = {}
+        slopes, asymmetries = [], []
+        for plane in planes:
+            stripNumbers = strips[f'strips{plane}'].rows(start, stop)
+            positions = stripNumbers.withValues(stripNumbers.values * float(pitch))
+            times = strips[f'times{plane}'].rows(start, stop)
+            weights = strips[f'adcs{plane}'].rows(start, stop).values.astype(np.float64)
+            count, slope, intercept, chi2 = _fitSegments(positions, times.withValues(times.values.astype(np.float64)), weights)
+            asymmetry = _chargeAsymmetry(stripNumbers, weights)
+            columns.update({f'n_fit{plane}' : count, f'slope{plane}' : slope, f'intercept{plane}' : intercept, f'chi2{plane}' : chi2, f'headtail{plane}' : asymmetry})
+            #dz/dx = b / a of the track in this plane, a cluster on a single strip is a track along the drift axis in this projection (a = 0)
+            single = (count > 0) & (stripNumbers.min() == stripNumbers.max())
+            slopes.append((np.where(single, 0., 1.), np.where(single, 1., slope * drift_velocity)))
+            asymmetries.append(asymmetry)
+
+        #the track z = z0 + (bx / ax) x = z0' + (by / ay) y has the direction (by ax, bx ay, bx by), which also covers tracks parallel to one plane (b = 0) or to the drift axis (a = 0)
+        (ax, bx), (ay, by) = slopes
+        direction = np.stack((by * ax, bx * ay, bx * by))
+        direction *= np.where(bx * by < 0, -1., 1.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            direction /= np.linalg.norm(direction, axis=0)
+            headtail = asymmetries[0] * direction[0] + asymmetries[1] * direction[1]
+        direction *= np.where(headtail < 0, -1., 1.)
+        columns.update({'dir_x' : direction[0], 'dir_y' : direction[1], 'dir_z' : direction[2],
+            'theta' : np.arccos(np.clip(direction[2], -1, 1)), 'phi' : np.arctan2(direction[1], direction[0]), 'headtail' : np.abs(headtail)})
+        results.append(pd.DataFrame(data = columns, copy=False))
+    return pd.concat(results, ignore_index=True) if len(results) > 1 else results[0]
+
+#returns a copy of the clusters dataframe with the fitTracks columns added, strips are the per strip branches of the same clusters (read_cluster_strips of the same file)
+def addTrackColumns(df_clusters, strips, pitch, drift_velocity, planes=(0, 1), chunk_size=1000000):
+    tracks = fitTracks(strips, pitch, drift_velocity, planes, chunk_size)
+    if len(tracks) != len(df_clusters):
+        raise Exception(f"{len(df_clusters)} clusters but {len(tracks)} rows of strips, read both from the same file")
+    tracks.index = df_clusters.index
+    return pd.concat([df_clusters, tracks], axis=1)
+
+#1 fC = 6240 electrons, 167.5 is the average number of primary electrons created by a 5.9 keV X-ray in Ar/CO2 70:30
+ELECTRONS_PER_FC = 6240
+FE55_PRIMARY_ELECTRONS = 167.5
+
+#compute the number of electrons seen by each plane and the avalanche gain of every cluster from the x and y preamp gains in mV/fC (Per Lucian 1 ADC ~ 1 mV)
+#returns a new dataframe (electrons_x, electrons_y, electrons, gain) with the same index as df_clusters, which is left unmodified
+#the result is memoised per (dataframe, x_gain, y_gain), so compute it again with memoise=False if adc0/adc1 of the dataframe were changed in place
+@profiled()
+def calibratedCharge(df_clusters, x_gain, y_gain, memoise=True):
+    def compute():
+        electrons_x = np.asarray(df_clusters['adc0'], dtype=np.float64) * (ELECTRONS_PER_FC / x_gain)
+        electrons_y = np.asarray(df_clusters['adc1'], dtype=np.float64) * (ELECTRONS_PER_FC / y_gain)
+        electrons = electrons_x + electrons_y
+        return pd.DataFrame(data = {'electrons_x' : electrons_x, 'electrons_y' : electrons_y, 'electrons' : electrons, 'gain' : electrons / FE55_PRIMARY_ELECTRONS}, index=df_clusters.index, copy=False)
+
+    if not memoise:
+        return compute()
+    return _memoised(df_clusters, ('calibratedCharge', float(x_gain), float(y_gain)), compute)
+
+#this opens the ROOT file and returns the clusters as a Pandas dataframe, kept for Majd's data scripts (read_cluster detects the 2 plane layout itself)
+def read_cluster_Majd(file_loc, columns=None, use_cache=USE_CACHE, rebuild=False, compact=False, cut=None):
+    return read_cluster(file_loc, columns=columns, use_cache=use_cache, rebuild=rebuild, compact=compact, cut=cut)
+
+#combine the hit and cluster data of every ROOT file in a folder and return Pandas dataframes, kept for Majd's data scripts (combineDataFrames detects the 2 plane layout itself)
+def combineDataFramesMajd(rootFolder, hit_columns=None, cluster_columns=None, use_cache=USE_CACHE, rebuild=False, parallel=None, max_workers=None, compact=False, hit_cut=None, cluster_cut=None): #input is string with the name of the folder
+    return combineDataFrames(rootFolder, hit_columns=hit_columns, cluster_columns=cluster_columns, use_cache=use_cache, rebuild=rebuild, parallel=parallel, max_workers=max_workers, compact=compact, hit_cut=hit_cut, cluster_cut=cluster_cut)
+
+#bump when the contents of a RunSummary change, so summaries cached by an older version are recomputed
+RUN_SUMMARY_VERSION = 1
+RUN_STRIP_EDGES = np.arange(-0.5, 499.5, 1.0)
+RUN_GAIN_EDGES = np.linspace(2000, 15000, 101)
+
+#reduced data of a run (or of one of its files) that the overlay plots need: hit rate histograms, cluster map, gain spectrum and charge sharing of every region, and live time
+#summaries of files are merged with + into the summary of the run, so the raw hits and clusters never have to be in memory together
+class RunSummary:
+    def __init__(self, geometry=None, strip_edges=RUN_STRIP_EDGES, gain_edges=RUN_GAIN_EDGES):
+        self.geometry = loadGeometry() if geometry is None else geometry
+        self.hits = StripHistogram(strip_edges)
+        self.clusters = ClusterMap(strip_edges)
+        nRegions = len(self.geometry.planeVmms[(self.geometry.detector, 0)]) * len(self.geometry.planeVmms[(self.geometry.detector, 1)])
+        self.gain_edges = np.asarray(gain_edges, dtype=float)
+        self.gains = np.zeros((nRegions, len(self.gain_edges) - 1), dtype=np.int64) #[region, gain bin]
+        self.sharing_sum = np.zeros(nRegions) #sum of electrons_x / electrons_y of the clusters of every region
+        self.sharing_n = np.zeros(nRegions, dtype=np.int64)
+        self.live_s = 0.0
+        self.n_files = 0
+        self.run = {} #metadata of the run (see RunRegistry.add), filled by RunRegistry
+
+    def merge(self, other):
+        if self.gains.shape != other.gains.shape or not np.array_equal(self.gain_edges, other.gain_edges):
+            raise Exception("can only merge run summaries of the same geometry and binning")
+        self.hits += other.hits
+        self.clusters += other.clusters
+        self.gains += other.gains
+        self.sharing_sum += other.sharing_sum
+        self.sharing_n += other.sharing_n
+        self.live_s += other.live_s
+        self.n_files += other.n_files
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    #the run's label and duration in seconds (given in the registry, otherwise the live time from the hit timestamps)
+    @property
+    def label(self):
+        return self.run.get('label') or self.run.get('name', '')
+
+    @property
+    def data_duration(self):
+        return self.run.get('duration') or self.live_s
+
+    #add a chunk of hits (plane, pos and time) of the file being summarised, previous is the last hit time of the previous chunk, returns the last hit time
+    def fillHits(self, df_hits, previous=None, max_gap_s=LIVE_MAX_GAP_S):
+        self.hits.fill(df_hits)
+        _, gaps, previous = _liveGaps(df_hits['time'], previous, max_gap_s)
+        self.live_s += float(gaps.sum())
+        return previous
+
+    #add a chunk of clusters (pos0, pos1, adc0 and adc1)
+    def fillClusters(self, df_clusters, x_gain, y_gain):
+        self.clusters.fill(df_clusters)
+        charge = calibratedCharge(df_clusters, x_gain, y_gain, memoise=False)
+        labels = self.geometry.regionLabels(df_clusters).astype(np.int64)
+        nRegions, nBins = self.gains.shape
+        index = _binIndex(charge['gain'].to_numpy(), self.gain_edges)
+        valid = (index >= 0) & (labels >= 0)
+        self.gains += np.bincount(labels[valid] * nBins + index[valid], minlength=nRegions * nBins).reshape(nRegions, nBins)
+        inRegion = labels >= 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = charge['electrons_x'].to_numpy()[inRegion] / charge['electrons_y'].to_numpy()[inRegion]
+        self.sharing_sum += np.bincount(labels[inRegion], weights=ratio, minlength=nRegions)
+        self.sharing_n += np.bincount(labels[inRegion], minlength=nRegions)
+
+    #gain histogram of a named area (see DetectorGeometry.areaCode), the same as histGain with fiducialize=True
+    def gainHistogram(self, area):
+        hist = GainHistogram(self.gain_edges[0], self.gain_edges[-1], len(self.gain_edges) - 1)
+        hist.counts += self.gains[self.geometry.areaCode(area)]
+        return hist
+
+    #gain histogram of every region with clusters, {(x vmm, y vmm): GainHistogram} as returned by gainHistogramsByRegion
+    def regionGainHistograms(self):
+        histograms = {}
+        for code in np.flatnonzero(self.gains.sum(axis=1)):
+            hist = GainHistogram(self.gain_edges[0], self.gain_edges[-1], len(self.gain_edges) - 1)
+            hist.counts += self.gains[code]
+            (_, xVmm), (_, yVmm) = self.geometry.regionVmms(code)
+            histograms[(xVmm, yVmm)] = hist
+        return histograms
+
+    #mean electrons_x / electrons_y of the clusters of a named area, NaN without clusters
+    def chargeSharing(self, area):
+        code = self.geometry.areaCode(area)
+        return self.sharing_sum[code] / self.sharing_n[code] if self.sharing_n[code] > 0 else np.nan
+
+    def save(self, path):
+        _writeCache(path, {'hits' : self.hits.counts, 'strip_edges' : self.hits.edges[0], 'clusters' : self.clusters.counts, 'gains' : self.gains,
+            'gain_edges' : self.gain_edges, 'sharing_sum' : self.sharing_sum, 'sharing_n' : self.sharing_n, 'live_s' : np.float64(self.live_s), 'n_files' : np.int64(self.n_files)})
+
+    @classmethod
+    def load(cls, path, geometry=None):
+        with np.load(path, allow_pickle=False) as f:
+            summary = cls(geometry, f['strip_edges'], f['gain_edges'])
+            summary.hits.counts = f['hits']
+            summary.clusters.counts = f['clusters']
+            summary.gains = f['gains']
+            summary.sharing_sum = f['sharing_sum']
+            summary.sharing_n = f['sharing_n']
+            summary.live_s = float(f['live_s'])
+            summary.n_files = int(f['n_files'])
+        return summary
+
+#path of the cached summary of one ROOT file, the key changes whenever the file, the gains, the geometry, the binning or compact change
+def _summaryPath(filePath, x_gain, y_gain, geometry, strip_edges, gain_edges, compact=False):
+    stat = os.stat(filePath)
+    geoStat = os.stat(geometry.geoFile)
+    key = (f'{os.path.abspath(filePath)}|{stat.st_size}|{stat.st_mtime_ns}|summary{RUN_SUMMARY_VERSION}|{float(x_gain)}|{float(y_gain)}|'
+        f'{geometry.geoFile}|{geoStat.st_mtime_ns}|{np.asarray(strip_edges, dtype=float).tobytes().hex()}|{np.asarray(gain_edges, dtype=float).tobytes().hex()}'
+        f'{"|compact" if compact else ""}')
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+#summarise one ROOT file chunk by chunk and cache the result, top level so it can run in a worker process
+#verbose prints the memory footprint of the first hit and cluster chunk of the file (see memoryFootprint)
+def _summarizeFile(item):
+    filePath, x_gain, y_gain, geoFile, strip_edges, gain_edges, step_size, compact, verbose = item
+    geometry = loadGeometry(geoFile)
+    summary = RunSummary(geometry, strip_edges, gain_edges)
+    last = None
+    for i, chunk in enumerate(iterateFileChunks(filePath, 'hits', ['plane', 'pos', 'time'], step_size=step_size, compact=compact)):
+        if verbose and i == 0:
+            memoryFootprint(chunk, f'{os.path.basename(filePath)} hits chunk{" (compact)" if compact else ""}')
+        last = summary.fillHits(chunk, last)
+    for i, chunk in enumerate(iterateFileChunks(filePath, 'clusters', ['pos0', 'pos1', 'adc0', 'adc1'], step_size=step_size, compact=compact)):
+        if verbose and i == 0:
+            memoryFootprint(chunk, f'{os.path.basename(filePath)} clusters chunk{" (compact)" if compact else ""}')
+        summary.fillClusters(chunk, x_gain, y_gain)
+    summary.n_files = 1
+    summary.save(_summaryPath(filePath, x_gain, y_gain, geometry, strip_edges, gain_edges, compact))
+    return summary
+
+#summary of every ROOT file in a folder merged into one, files summarised before are loaded from the cache and only new or changed files are read (in a process pool)
+#compact=True reads the chunks in the narrowest dtypes (see compactColumns), verbose prints the memory footprint of the chunks of every file read (default: when profiling is on)
+@profiled()
+def summarizeRun(rootFolder, x_gain, y_gain, geometry=None, strip_edges=RUN_STRIP_EDGES, gain_edges=RUN_GAIN_EDGES, max_workers=None, step_size=1000000, rebuild=False, compact=False, verbose=None):
+    verbose = PROFILE if verbose is None else verbose
+    geometry = loadGeometry() if geometry is None else geometry
+    if isinstance(geometry, str):
+        geometry = loadGeometry(geometry)
+    summary = RunSummary(geometry, strip_edges, gain_edges)
+    todo = []
+    for filePath in sorted(glob.glob(os.path.join(rootFolder, "*.root"))):
+        cachePath = _summaryPath(filePath, x_gain, y_gain, geometry, strip_edges, gain_edges, compact)
+        if not rebuild and os.path.exists(cachePath):
+            try:
+                summary += RunSummary.load(cachePath, geometry)
+                os.utime(cachePath) #mark as recently used for the cache eviction
+                continue
+            except (OSError, KeyError, ValueError): #unreadable or from an incompatible version, summarise the file again
+                pass
+        todo.append((filePath, x_gain, y_gain, geometry.geoFile, strip_edges, gain_edges, step_size, compact, verbose))
+
+    if max_workers == 1 or len(todo) <= 1:
+        fileSummaries = [_summarizeFile(item) for item in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            outcomes = executor.map(_profiledWorker, [PROFILE] * len(todo), [_stageDepth()] * len(todo), [_summarizeFile] * len(todo), todo)
+            fileSummaries = [_workerResult(outcome) for outcome in outcomes]
+    for fileSummary in fileSummaries:
+        summary += fileSummary
+    return summary
+
+#runs to overlay, with their metadata saved in a JSON file so each run is described once instead of in lists that must be kept parallel
+#summaries are computed on first use and cached per file (see summarizeRun), so adding a run to an overlay only costs reading the new run
+class RunRegistry:
+    def __init__(self, registryFile=None):
+        self.registryFile = registryFile
+        self.runs = {} #{name: metadata}
+        self._summaries = {}
+        if registryFile is not None and os.path.exists(registryFile):
+            with open(registryFile) as f:
+                self.runs = json.load(f)
+
+    #add or update a run, folder holds its ROOT files, x_gain and y_gain are the preamp gains in mV/fC, geometry a geometry JSON file (default Zander setup)
+    #duration in seconds replaces the live time from the hit timestamps, label is used in the legends (default the name), extra keywords are kept as metadata
+    def add(self, name, folder, x_gain, y_gain, geometry=None, duration=None, label=None, **metadata):
+        run = {'name' : name, 'folder' : folder, 'x_gain' : float(x_gain), 'y_gain' : float(y_gain), 'geometry' : geometry, 'duration' : duration, 'label' : label, **metadata}
+        if self.runs.get(name) != run:
+            self._summaries.pop(name, None)
+        self.runs[name] = run
+        return run
+
+    def remove(self, name):
+        self.runs.pop(name)
+        self._summaries.pop(name, None)
+
+    def save(self, registryFile=None):
+        registryFile = self.registryFile if registryFile is None else registryFile
+        if registryFile is None:
+            raise Exception("Give a file to save the run registry to")
+        tmpFile = f'{registryFile}.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(self.runs, f, indent=2)
+        os.replace(tmpFile, registryFile)
+
+    #summary of a run, computed once per registry and otherwise loaded from the per-file cache, compact and verbose as in summarizeRun
+    def summary(self, name, max_workers=None, rebuild=False, compact=False, verbose=None):
+        if rebuild or name not in self._summaries:
+            run = self.runs[name]
+            geometry = loadGeometry() if run['geometry'] is None else loadGeometry(run['geometry'])
+            summary = summarizeRun(run['folder'], run['x_gain'], run['y_gain'], geometry, max_workers=max_workers, rebuild=rebuild, compact=compact, verbose=verbose)
+            summary.run = run
+            self._summaries[name] = summary
+        return self._summaries[name]
 
-    df_hits = pd.concat(hits, ignore_index=True)
-    df_clusters = pd.concat(clusters, ignore_index=True)
-    return df_hits, df_clusters
\ No newline at end of file
+    #summaries of several runs (default all, in the order they were added)
+    def summaries(self, names=None, max_workers=None, rebuild=False, compact=False, verbose=None):
+        return [self.summary(name, max_workers, rebuild, compact, verbose) for name in (self.runs if names is None else names)]
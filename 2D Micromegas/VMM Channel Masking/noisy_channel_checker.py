@@ -1,39 +1,89 @@
+import os
+import glob
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')
-from vmm_tools import combineDataFrames
+from vmm_tools import read_hit, iteratePcapngHits, liveSeconds, LiveTimeCounter, stairsSeries, lineSeries, figureSpec, renderFigures
 
 
 '''purpose of this script is to find noisy channels by identifying which ones produce significantly more events than the others (for no other apparent reason)'''
 
-#this function has two purposes: make a histogram of the number of events in each VMM channel, and print the noisy channels that need masking in the slow control
-def channelPlotterPerVMM(df_hits, vmmID, tooManyCounts):
-    vmmNumber = df_hits['vmm']
-    channelNumber = df_hits['ch']
+N_CHANNELS = 64 #channels per VMM
 
-    hitInVMMIndices = np.where(vmmNumber == vmmID)[0]
-    channelNumber = channelNumber[hitInVMMIndices]
+#add the hits of one dataframe (chunk) to the (vmm, channel) count matrix with a single bincount over vmm * 64 + ch, growing the matrix if a higher VMM number shows up
+def addChannelCounts(counts, df_hits):
+    key = df_hits['vmm'].to_numpy(np.int64) * N_CHANNELS + df_hits['ch'].to_numpy(np.int64)
+    if len(key) == 0:
+        return counts
+    flat = np.bincount(key)
+    if len(flat) > counts.size:
+        counts = np.vstack([counts, np.zeros((-(-len(flat) // N_CHANNELS) - len(counts), N_CHANNELS), dtype=np.int64)])
+    counts += np.pad(flat, (0, counts.size - len(flat))).reshape(counts.shape)
+    return counts
 
-    #makes and saves a histogram of the events per channel for the VMM (that matches the number of vmmID)
-    fig = plt.figure()
+#count the hits per (vmm, channel) of every ROOT file in the folder, one file in memory at a time, returns the (vmm, channel) count matrix and the live time in seconds
+#the live time is the sum of the gaps between consecutive hits of each file (see vmm_tools.liveTime), so DAQ pauses do not lower the rates
+def scanRootFolder(rootFolder, n_vmms=16):
+    counts = np.zeros((n_vmms, N_CHANNELS), dtype=np.int64)
+    live_time = 0.0
+    for filePath in sorted(glob.glob(os.path.join(rootFolder, "*.root"))):
+        df_hits = read_hit(filePath, columns=['vmm', 'ch', 'time'])
+        counts = addChannelCounts(counts, df_hits)
+        live_time += liveSeconds(df_hits['time'])
+    return counts, live_time
 
-    binning = np.arange(-0.5, 64.5, 1)
-    counts, bin_edges, _ = plt.hist(channelNumber, bins=binning, color='red', histtype='step')
-    
-    print(vmmID, (bin_edges[np.where(counts > tooManyCounts)[0]]+0.5).astype(int)) #prints the VMM and the channels that have counts higher than tooManyCounts (these are noisy channels)
+#same as scanRootFolder for a pcapng capture decoded directly, without convertFile, the live time gaps are carried from one decoded window to the next
+def scanPcapng(pcapngFile, n_vmms=16):
+    counts = np.zeros((n_vmms, N_CHANNELS), dtype=np.int64)
+    liveTime = LiveTimeCounter()
+    for df_hits in iteratePcapngHits(pcapngFile):
+        counts = addChannelCounts(counts, df_hits)
+        liveTime.add(df_hits['time'].to_numpy())
+    return counts, liveTime.seconds
 
-    plt.xlabel(f'ch')
-    plt.ylabel('Events')
-    plt.title(f'VMM {vmmID}')
-    plt.savefig(f'hits_per_channel_hist_VMM{vmmID}.png')
-    plt.close()
+#median of the neighbouring channels (n_neighbours on each side, the channel itself excluded) for every channel of every VMM
+def neighbourMedian(counts, n_neighbours=2):
+    padded = np.pad(counts.astype(float), ((0, 0), (n_neighbours, n_neighbours)), constant_values=np.nan)
+    shifts = [padded[:, n_neighbours + i : n_neighbours + i + N_CHANNELS] for i in range(-n_neighbours, n_neighbours + 1) if i != 0]
+    return np.nanmedian(np.stack(shifts), axis=0)
+
+#flag channels whose counts stand out from both their neighbours and the median of their VMM
+#a channel is noisy when it exceeds each reference by more than n_sigma robust standard deviations (the larger of the Poisson error of the reference and 1.4826 * median absolute deviation of the VMM) and by more than a factor min_ratio
+def findNoisyChannels(counts, n_sigma=5.0, min_ratio=3.0, n_neighbours=2):
+    counts = np.asarray(counts, dtype=float)
+    vmmMedian = np.median(counts, axis=1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(counts - vmmMedian), axis=1, keepdims=True)
+    noisy = np.ones(counts.shape, dtype=bool)
+    for reference in (neighbourMedian(counts, n_neighbours), vmmMedian):
+        sigma = np.maximum(np.maximum(np.sqrt(reference), mad), 1.0)
+        noisy &= (counts > reference + n_sigma * sigma) & (counts > min_ratio * reference)
+    return noisy
+
+#save the noisy channels in the VMM,Channel format of bad_channels.csv, ready to mask in the slow control
+def saveMask(noisy, maskFile="noisy_channels.csv"):
+    vmm, channel = np.nonzero(noisy)
+    np.savetxt(maskFile, np.transpose(np.array((vmm, channel))), delimiter=",", header="VMM,Channel", comments='', fmt='%d')
+
+#histogram of the rate in each channel of one VMM from the count matrix, marking the noisy channels, as a figure for renderFigures
+def channelFigure(counts, vmmID, noisy, live_time):
+    scale = 1. / live_time if live_time > 0 else 1.
+    flagged = np.nonzero(noisy[vmmID])[0]
+    series = [stairsSeries(counts[vmmID], np.arange(-0.5, N_CHANNELS, 1), scale, color='red')]
+    if len(flagged) > 0:
+        series.append(lineSeries(flagged, counts[vmmID][flagged] * scale, 'kx', label='noisy'))
+    return figureSpec(f'hits_per_channel_hist_VMM{vmmID}.png', series, xlabel='ch', ylabel='Events / s' if live_time > 0 else 'Events',
+        title=f'VMM {vmmID}', legend='upper right' if len(flagged) > 0 else None)
 
 #runs the script
 if __name__ == '__main__':
     rootFolder = "Micromegas/July10" #folder containing the ROOT files
-    df_hits, df_clusters = combineDataFrames(rootFolder)
+    pcapngFile = None #set to a pcapng capture to look at its hits right away, without converting it with convertFile first
+    if pcapngFile is None:
+        counts, live_time = scanRootFolder(rootFolder)
+    else:
+        counts, live_time = scanPcapng(pcapngFile)
 
-    #plots events per channel histogram for each of the VMMs in the micromegas
-    for i in range(0, 16):
-        channelPlotterPerVMM(df_hits, i, 100000)
\ No newline at end of file
+    noisy = findNoisyChannels(counts)
+    saveMask(noisy)
+    print(f'live time {live_time:.1f} s')
+    for i in range(len(counts)):
+        print(i, np.nonzero(noisy[i])[0]) #prints the VMM and its noisy channels
+    renderFigures([channelFigure(counts, i, noisy, live_time) for i in range(len(counts))], '.') #drawn in parallel, unchanged figures are skipped
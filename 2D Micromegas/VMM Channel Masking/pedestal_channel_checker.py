@@ -1,4 +1,8 @@
+import os
+import re
+import glob
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('Agg')
@@ -6,27 +10,27 @@ matplotlib.use('Agg')
 
 '''purpose of this script is to find broken channels by identifying which ones have pedestals that are way too high'''
 
-#fetches the vmm #, channel #, pedestal, and measured threshold from CSV files
-def fetch_pedestal_and_threshold_info(pedestalCSV, thresholdCSV):
-    rawPedestalCSV = np.genfromtxt(pedestalCSV, delimiter=',', unpack=True)
-    rawThresholdMeasureCSV = np.genfromtxt(thresholdCSV, delimiter=',', unpack=True)
+N_CHANNELS = 64 #channels per VMM
 
-    vmm = rawPedestalCSV[2]
-    channel = rawPedestalCSV[3]
-    pedestal = rawPedestalCSV[4]
-    threshold = rawThresholdMeasureCSV[4]
+#reads the vmm #, channel # and measured value (columns 2, 3 and 4) of a slow control scan CSV with the pandas C parser
+#the usual file has one header line and parses straight to numbers, otherwise every row that is not numbers (e.g. repeated headers) gets dropped
+def read_scan_csv(scanCSV):
+    raw = pd.read_csv(scanCSV, header=0, usecols=[2, 3, 4], skipinitialspace=True)
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in raw.dtypes):
+        raw = pd.read_csv(scanCSV, header=None, usecols=[2, 3, 4], dtype=str, skipinitialspace=True).apply(pd.to_numeric, errors='coerce')
+    values = raw.dropna().to_numpy(dtype=float)
+    return values[:, 0], values[:, 1], values[:, 2]
 
-    #takes out the headers inside the arrays which got converted to NaN values in the np.genfromtxt step
-    vmm = vmm[~np.isnan(vmm)]
-    channel = channel[~np.isnan(channel)]
-    pedestal = pedestal[~np.isnan(pedestal)]
-    threshold = threshold[~np.isnan(threshold)]
+#fetches the vmm #, channel #, pedestal, and measured threshold from CSV files
+def fetch_pedestal_and_threshold_info(pedestalCSV, thresholdCSV):
+    vmm, channel, pedestal = read_scan_csv(pedestalCSV)
+    _, _, threshold = read_scan_csv(thresholdCSV)
 
     return vmm, channel, pedestal, threshold
 
 #make plots of the pedestal, threshold, and the theoretical threshold for each VMM
 def plot_pedestal_and_threshold(vmm, channel, pedestal, threshold, theoreticalThreshold):
-    for i in range(0, 4):
+    for i in np.unique(vmm).astype(int):
         indices = np.where(vmm == i)[0]
 
         vmmChannels = channel[indices]
@@ -48,9 +52,14 @@ def plot_pedestal_and_threshold(vmm, channel, pedestal, threshold, theoreticalTh
         plt.savefig(f'pedestal_threshold_vmm{i}.png')
         plt.close()
 
+#bad channel criteria, works element-wise on arrays of any shape (e.g. scan x vmm x channel), missing (NaN) channels are never bad
+def bad_channel_mask(pedestal, threshold):
+    with np.errstate(invalid='ignore'):
+        return (pedestal > 250) | (pedestal > threshold) | (np.abs(threshold - pedestal) < 70) | (pedestal < 140)
+
 #find the bad channels and return their number and corresponding VMM number
 def find_bad_channels(vmm, channel, pedestal, threshold, theoreticalThreshold):
-    badChannelIndices = np.where((pedestal > 250) | (pedestal > threshold) | (np.abs(threshold - pedestal) < 70) | (pedestal < 140))[0]
+    badChannelIndices = np.where(bad_channel_mask(pedestal, threshold))[0]
     badChannelVMMNumber = vmm[badChannelIndices]
     badChannels = channel[badChannelIndices]
 
@@ -73,6 +82,132 @@ def main(pedestalCSV, thresholdCSV, theoreticalThreshold, plot=True, savetoCSV=T
         badChannelVMMNumber, badChannels = find_bad_channels(vmm, channel, pedestal, threshold, theoreticalThreshold)
         save_bad_channels_to_csv(badChannelVMMNumber, badChannels)
 
+#time of a scan file in seconds since the epoch (UTC), from the _HHMMSS stamp in its name and a YYYYMMDD or YYYY-MM-DD date in the name or one of its directories
+#the file modification time is never used since copying or archiving a scan folder rewrites it, pass scanDate ('YYYY-MM-DD') when the date is nowhere in the path
+def scan_time(scanCSV, scanDate=None):
+    name = os.path.splitext(os.path.basename(scanCSV))[0]
+    stamp = re.search(r'_(\d{6})$', name)
+    if stamp is None:
+        raise Exception(f"{scanCSV} has no _HHMMSS time stamp in its name")
+    hh, mm, ss = int(stamp.group(1)[:2]), int(stamp.group(1)[2:4]), int(stamp.group(1)[4:])
+    if hh > 23 or mm > 59 or ss > 59:
+        raise Exception(f"{scanCSV} has an invalid time stamp {stamp.group(1)}")
+    if scanDate is None:
+        for part in reversed(os.path.abspath(os.path.dirname(scanCSV)).split(os.sep) + [name[:stamp.start()]]):
+            date = re.search(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)', part)
+            if date is not None:
+                scanDate = '-'.join(date.groups())
+                break
+        else:
+            raise Exception(f"no date in the path of {scanCSV}, pass scanDate or an explicit pairing")
+    day = np.datetime64(scanDate, 'D').astype('datetime64[s]').astype(np.int64)
+    return float(day + 3600 * hh + 60 * mm + ss)
+
+#pairs every pedestal scan in the folder (Pedestal_*.csv) one-to-one with the threshold scan (Threshold_*.csv) taken closest in time, the times come from the file names (see scan_time)
+#pairs can instead be given explicitly as a list of (pedestal file, threshold file) names relative to the folder
+#raises if a threshold scan would be used by two pedestal scans or if a pedestal and its threshold scan are more than maxGap seconds apart
+#returns the scan times (seconds since the epoch) and the pedestal and threshold files, sorted in time
+def pair_scans(scanFolder, pedestalPattern="Pedestal_*.csv", thresholdPattern="Threshold_*.csv", pairs=None, maxGap=600., scanDate=None):
+    if pairs is not None:
+        pedestalFiles = [os.path.join(scanFolder, pedestalCSV) for pedestalCSV, _ in pairs]
+        pairedFiles = [os.path.join(scanFolder, thresholdCSV) for _, thresholdCSV in pairs]
+    else:
+        pedestalFiles = glob.glob(os.path.join(scanFolder, pedestalPattern))
+        thresholdFiles = glob.glob(os.path.join(scanFolder, thresholdPattern))
+        if not pedestalFiles or not thresholdFiles:
+            raise Exception(f"no pedestal or threshold scans in {scanFolder}")
+        thresholdTimes = np.array([scan_time(filePath, scanDate) for filePath in thresholdFiles])
+        pedestalTimes = np.array([scan_time(filePath, scanDate) for filePath in pedestalFiles])
+        closest = np.argmin(np.abs(pedestalTimes[:, None] - thresholdTimes[None, :]), axis=1)
+        pairedFiles = [thresholdFiles[i] for i in closest]
+
+    reused = sorted({filePath for filePath in pairedFiles if pairedFiles.count(filePath) > 1})
+    if reused:
+        raise Exception(f"threshold scans paired with more than one pedestal scan: {reused}, pass the pairs explicitly")
+    scanTimes = np.array([scan_time(filePath, scanDate) for filePath in pedestalFiles])
+    gaps = np.abs(scanTimes - np.array([scan_time(filePath, scanDate) for filePath in pairedFiles]))
+    if np.any(gaps > maxGap):
+        far = [os.path.basename(pedestalFiles[i]) for i in np.nonzero(gaps > maxGap)[0]]
+        raise Exception(f"no threshold scan within {maxGap} s of {far}")
+
+    order = np.argsort(scanTimes, kind='stable')
+    return scanTimes[order], [pedestalFiles[i] for i in order], [pairedFiles[i] for i in order]
+
+#stacks the given scan CSV files into a (scan x vmm x channel) array, channels missing from a scan are NaN
+def stack_scans(scanCSVs, n_vmms=None):
+    scans = [read_scan_csv(scanCSV) for scanCSV in scanCSVs]
+    if n_vmms is None:
+        n_vmms = int(max((vmm.max() for vmm, _, _ in scans if len(vmm) > 0), default=-1)) + 1
+    stacked = np.full((len(scans), n_vmms, N_CHANNELS), np.nan)
+    for i, (vmm, channel, value) in enumerate(scans):
+        stacked[i, vmm.astype(int), channel.astype(int)] = value
+    return stacked
+
+#least squares slope of every channel against time (per day), ignoring scans where the channel is missing, NaN with fewer than two scans
+def drift_slopes(scanTimes, values):
+    days = (np.asarray(scanTimes) - np.min(scanTimes)) / 86400.
+    days = np.broadcast_to(days[:, None, None], values.shape)
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanDays = np.where(valid, days, 0).sum(axis=0) / n
+        meanValue = np.where(valid, values, 0).sum(axis=0) / n
+        dDays = np.where(valid, days - meanDays, 0)
+        slope = (dDays * np.where(valid, values - meanValue, 0)).sum(axis=0) / (dDays ** 2).sum(axis=0)
+    return np.where(n >= 2, slope, np.nan)
+
+#plot the pedestal of every channel of every VMM against the scan number
+def plot_pedestal_drift(pedestal):
+    for i in range(pedestal.shape[1]):
+        if np.all(np.isnan(pedestal[:, i])):
+            continue
+        fig = plt.figure()
+        plt.imshow(pedestal[:, i], aspect='auto', origin='lower', interpolation='none', extent=(-0.5, N_CHANNELS - 0.5, -0.5, len(pedestal) - 0.5))
+        cbar = plt.colorbar()
+        cbar.set_label("Pedestal (mV)", rotation=270, labelpad=15)
+        plt.xlabel(f'Channel Number')
+        plt.ylabel('Scan')
+        plt.title(f'VMM {i}')
+        plt.savefig(f'pedestal_drift_vmm{i}.png')
+        plt.close()
+
+#analyses every pedestal/threshold scan pair in a folder at once: the bad channel criteria are applied to the whole (scan x vmm x channel) stack and the drift of every channel is fitted
+#saves every channel that was bad in at least one scan with the fraction of scans it was bad in, its pedestal and threshold drift (mV/day) and how far its measured threshold sits from the theoretical one (pedestal + theoreticalThreshold) on average
+#pairs, maxGap and scanDate are passed on to pair_scans, returns the stacks and the per channel summary
+def batch_main(scanFolder, theoreticalThreshold, n_vmms=None, plot=True, savetoCSV=True, csvName="bad_channels_batch.csv", pairs=None, maxGap=600., scanDate=None):
+    scanTimes, pedestalFiles, thresholdFiles = pair_scans(scanFolder, pairs=pairs, maxGap=maxGap, scanDate=scanDate)
+    pedestal = stack_scans(pedestalFiles, n_vmms)
+    threshold = stack_scans(thresholdFiles, pedestal.shape[1])
+
+    bad = bad_channel_mask(pedestal, threshold)
+    nScans = (~np.isnan(pedestal)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        badFraction = bad.sum(axis=0) / nScans
+        offset = threshold - (pedestal + theoreticalThreshold)
+        thresholdError = np.where(np.isnan(offset), 0, offset).sum(axis=0) / (~np.isnan(offset)).sum(axis=0)
+    pedestalSlope = drift_slopes(scanTimes, pedestal)
+    thresholdSlope = drift_slopes(scanTimes, threshold)
+
+    vmm, channel = np.nonzero(bad.any(axis=0))
+    summary = pd.DataFrame(data = {
+        'VMM' : vmm,
+        'Channel' : channel,
+        'BadFraction' : badFraction[vmm, channel],
+        'PedestalSlope' : pedestalSlope[vmm, channel],
+        'ThresholdSlope' : thresholdSlope[vmm, channel],
+        'ThresholdMinusTheoretical' : thresholdError[vmm, channel],
+        })
+    print(f'{len(pedestalFiles)} scans, {len(summary)} channels bad in at least one scan')
+
+    if plot == True:
+        plot_pedestal_drift(pedestal)
+
+    if savetoCSV == True:
+        summary.to_csv(csvName, index=False, float_format='%.4g')
+
+    return pedestal, threshold, summary
+
 #runs the script
 if __name__ == "__main__":
-    main('Micromegas/Pedestal_111154.csv', 'Micromegas/Threshold_111138.csv', 100, plot=True, savetoCSV=True) #just need to edit the filenames, theoretical threshold value, and whether or not to plot and save to CSV
\ No newline at end of file
+    main('Micromegas/Pedestal_111154.csv', 'Micromegas/Threshold_111138.csv', 100, plot=True, savetoCSV=True) #just need to edit the filenames, theoretical threshold value, and whether or not to plot and save to CSV
+    #batch_main('Micromegas/Scans', 100, plot=True, savetoCSV=True) #analyse every scan in a folder at once, with drift tracking
\ No newline at end of file